@@ -0,0 +1,219 @@
+from boto3.dynamodb.conditions import Key
+from decimal import Decimal
+
+import base64
+import boto3
+import heapq
+import itertools
+import json
+import os
+import random
+import time
+
+DYNAMODB_TABLE = os.environ.get("DYNAMODB_TABLE", None)
+TAG_INDEX = os.environ.get("TAG_INDEX", "TagIndex")
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "50"))
+# Most index pages read by one request, so that a rare tag combination cannot read a whole tag
+MAX_QUERY_PAGES = int(os.environ.get("MAX_QUERY_PAGES", "10"))
+MAX_PAGE_SIZE = 1000
+BATCH_GET_SIZE = 100  # The BatchGetItem limit
+
+dynamodb = boto3.resource("dynamodb")
+dynamodb_table = dynamodb.Table(DYNAMODB_TABLE)
+
+
+def lambda_handler(event, context):
+    """
+    GET /images?tags=Cat,Dog&mode=and&min_confidence=97&limit=50&next_token=...
+    """
+    params = event.get('queryStringParameters') or {}
+    try:
+        tags = [tag.strip() for tag in params.get('tags', params.get('tag', '')).split(',') if tag.strip()]
+        if not tags:
+            raise ValueError("At least one tag is required")
+        min_confidence = params.get('min_confidence')
+        page = query_images(
+            tags,
+            mode=params.get('mode', 'and'),
+            min_confidence=parse_confidence(min_confidence) if min_confidence else None,
+            limit=int(params.get('limit', DEFAULT_PAGE_SIZE)),
+            next_token=params.get('next_token'),
+        )
+    except ValueError as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+
+    return {"statusCode": 200, "body": json.dumps(page, default=float)}
+
+
+def parse_confidence(value):
+    try:
+        confidence = Decimal(value)
+    except ArithmeticError:  # decimal.InvalidOperation
+        raise ValueError(f"Invalid min_confidence {value!r}")
+    if not confidence.is_finite():
+        raise ValueError(f"Invalid min_confidence {value!r}")
+    return confidence
+
+
+def query_images(tags, mode="and", min_confidence=None, limit=DEFAULT_PAGE_SIZE, next_token=None):
+    """
+    Return one page of the images labeled with all ("and") or any ("or") of the tags
+
+    Images come in decreasing confidence order; pass the returned
+    ``next_token`` back to get the next page, it is None on the last one.
+    Every page reads the tag index from where the previous one stopped, so
+    its cost depends on the page size and not on the size of the table. An
+    AND query walks the index of the first tag, so list the rarest tag first.
+    A request reads at most MAX_QUERY_PAGES index pages: when they hold too
+    few matches, the page is returned short, with a ``next_token`` to go on.
+    """
+    tags = list(dict.fromkeys(tags))
+    if mode not in ("and", "or"):
+        raise ValueError(f"Unknown mode {mode}, expected 'and' or 'or'")
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    positions = decode_token(next_token) if next_token else {}
+    # An AND query walks the first tag only and checks the other tags per image
+    walked = tags[:1] if mode == "and" else tags
+    if positions and set(positions) != set(walked):
+        raise ValueError("next_token does not belong to these tags")
+    streams = [TagStream(tag, min_confidence, positions.get(tag), page_size=limit) for tag in walked]
+
+    images = []
+    candidates = merge_streams(streams)
+    # No more candidates than the page still needs, and few enough to look
+    # up all of their other tags in one BatchGetItem call
+    max_chunk_size = max(1, BATCH_GET_SIZE // max(1, len(tags) - 1))
+    while True:
+        chunk = list(itertools.islice(candidates, min(max_chunk_size, limit - len(images))))
+        if not chunk:
+            return {"images": images, "next_token": None}
+        image_tags = get_image_tags(
+            [(item['image-id'], tag) for item, _ in chunk for tag in tags if tag != item['tag']],
+            min_confidence,
+        )
+        for item, positions in chunk:
+            found = dict(image_tags.get(item['image-id'], {}), **{item['tag']: item['conf']})
+            if mode == "and" and len(found) < len(tags):
+                continue
+            if mode == "or" and not is_best_match(item, found):
+                # The image is returned for the queried tag it has the highest confidence in
+                continue
+            images.append({"image-id": item['image-id'], "tags": found})
+            if len(images) == limit:
+                # Like a DynamoDB LastEvaluatedKey, the page after a full one may be empty
+                return {"images": images, "next_token": encode_token(positions)}
+        if sum(stream.pages for stream in streams) >= MAX_QUERY_PAGES:
+            # Like a DynamoDB LastEvaluatedKey, a short page does not mean the last one
+            return {"images": images, "next_token": encode_token(chunk[-1][1])}
+
+
+def is_best_match(item, found):
+    best = min(found.items(), key=lambda tag_conf: (-tag_conf[1], tag_conf[0]))
+    return best[0] == item['tag']
+
+
+def merge_streams(streams):
+    """
+    Yield the items of several tag streams in decreasing confidence order
+
+    Each item comes with the position of every stream right after it, to
+    resume the merge from there.
+    """
+    heap = []
+    for index, stream in enumerate(streams):
+        item = stream.peek()
+        if item is not None:
+            heap.append((-item['conf'], item['tag'], index))
+    heapq.heapify(heap)
+    while heap:
+        _, _, index = heapq.heappop(heap)
+        item = streams[index].pop()
+        yield item, {stream.tag: stream.position for stream in streams}
+        following = streams[index].peek()
+        if following is not None:
+            heapq.heappush(heap, (-following['conf'], following['tag'], index))
+
+
+class TagStream:
+    """
+    Read the images of one tag from the tag index, highest confidence first
+
+    ``position`` is the index key of the last item popped, so a later query
+    can resume right after it even if more items were already fetched.
+    """
+
+    def __init__(self, tag, min_confidence=None, position=None, page_size=DEFAULT_PAGE_SIZE):
+        self.tag = tag
+        self.min_confidence = min_confidence
+        self.position = position
+        self.page_size = page_size
+        self._buffer = []
+        self._start_key = position
+        self._last_page = False
+        self.pages = 0
+
+    def peek(self):
+        while not self._buffer and not self._last_page:
+            self._fetch()
+        return self._buffer[0] if self._buffer else None
+
+    def pop(self):
+        item = self.peek()
+        self._buffer.pop(0)
+        self.position = {"tag": item['tag'], "conf": item['conf'], "image-id": item['image-id']}
+        return item
+
+    def _fetch(self):
+        condition = Key('tag').eq(self.tag)
+        if self.min_confidence is not None:
+            condition = condition & Key('conf').gte(self.min_confidence)
+        request = {
+            "IndexName": TAG_INDEX,
+            "KeyConditionExpression": condition,
+            "ScanIndexForward": False,
+            "Limit": self.page_size,
+        }
+        if self._start_key:
+            request["ExclusiveStartKey"] = self._start_key
+        response = dynamodb_table.query(**request)
+        self.pages += 1
+        self._buffer = response.get('Items', [])
+        self._start_key = response.get('LastEvaluatedKey')
+        self._last_page = self._start_key is None
+
+
+def get_image_tags(pairs, min_confidence=None):
+    """
+    Look up (image-id, tag) pairs with BatchGetItem and return {image-id: {tag: conf}} of the existing ones
+    """
+    found = {}
+    # A BatchGetItem request must not contain the same key twice
+    keys = [{"image-id": image_id, "tag": tag} for image_id, tag in dict.fromkeys(pairs)]
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {DYNAMODB_TABLE: {"Keys": keys[start:start + BATCH_GET_SIZE]}}
+        attempt = 0
+        while request:
+            if attempt:
+                time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+            attempt += 1
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(DYNAMODB_TABLE, []):
+                if min_confidence is None or item['conf'] >= min_confidence:
+                    found.setdefault(item['image-id'], {})[item['tag']] = item['conf']
+            request = response.get('UnprocessedKeys')
+    return found
+
+
+def encode_token(positions):
+    positions = {tag: position and dict(position, conf=str(position['conf'])) for tag, position in positions.items()}
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+
+def decode_token(token):
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return {tag: position and dict(position, conf=Decimal(position['conf'])) for tag, position in positions.items()}
+    except (ValueError, TypeError, KeyError, AttributeError, ArithmeticError):
+        raise ValueError("Invalid next_token")
@@ -1,35 +1,229 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 import boto3
+from botocore.exceptions import ClientError
+import json
 import os
+import random
+import threading
+import time
 
 DYNAMODB_TABLE = os.environ.get("DYNAMODB_TABLE", None)
+LABEL_CACHE_TABLE = os.environ.get("LABEL_CACHE_TABLE", None)
+LOCAL_CACHE_SIZE = int(os.environ.get("LOCAL_CACHE_SIZE", "10000"))
+MAX_LABELS = int(os.environ.get("MAX_LABELS", "5"))
+MIN_CONFIDENCE = float(os.environ.get("MIN_CONFIDENCE", "96"))
+MAX_WRITE_ATTEMPTS = int(os.environ.get("MAX_WRITE_ATTEMPTS", "8"))
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "8"))
+BATCH_WRITE_SIZE = 25  # The BatchWriteItem limit
+
+# The clients are created once per container and reused by every invocation
+rekognition = boto3.client("rekognition")
 dynamodb = boto3.resource("dynamodb")
 dynamodb_table = dynamodb.Table(DYNAMODB_TABLE)
+label_cache_table = dynamodb.Table(LABEL_CACHE_TABLE) if LABEL_CACHE_TABLE else None
+
+# Labels of already seen image contents, keyed on content hash and labeling parameters
+local_label_cache = OrderedDict()
+local_label_cache_lock = threading.Lock()
+dedup_stats = {"images": 0, "rekognition_calls": 0}
+dedup_stats_lock = threading.Lock()  # Updated by the labeling threads
 
 
 def lambda_handler(event, context):
+    """
+    Label the images of a batch of SQS messages, each carrying an S3 notification
+
+    Returns the messages to retry, for an event source mapping with
+    ReportBatchItemFailures. A direct S3 event is accepted too; its failed
+    images raise, so that Lambda retries the invocation.
+    """
+    records = list(s3_records(event))
+    items = {}
+    failures = OrderedDict()
+
+    # Records with the same content are labeled once; records without an ETag are labeled on their own
+    groups = OrderedDict()
+    for index, (identifier, record) in enumerate(records):
+        groups.setdefault(dedup_key(record) or index, []).append((identifier, record))
+    calls_before = dedup_stats["rekognition_calls"]
+
+    # detect_labels is network bound, so the images are labeled in parallel threads
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENCY, len(groups)))) as executor:
+        futures = [(group, executor.submit(detect_image_labels, group[0][1])) for group in groups.values()]
+        for group, future in futures:
+            try:
+                labels = future.result()
+            except Exception as e:
+                for identifier, record in group:
+                    print(f"Could not label {record['s3']['object']['key']}: {e}")
+                    failures[identifier] = None
+                continue
+            for identifier, record in group:
+                key = record['s3']['object']['key']
+                for label in labels:
+                    # Keyed on the table's primary key, a batch must not contain the same item twice
+                    items[(key, label['Name'])] = {
+                        "image-id": key,
+                        "tag": label['Name'],
+                        "conf": Decimal(label['Confidence'])
+                    }
+
+    # The records whose labels could not all be written are retried as failures
+    unwritten = {item["image-id"] for item in write_items(list(items.values()))}
+    for identifier, record in records:
+        if record['s3']['object']['key'] in unwritten:
+            failures[identifier] = None
+
+    failed_images = sum(1 for identifier, _ in records if identifier in failures)
+    labeled = len(records) - failed_images
+    calls = dedup_stats["rekognition_calls"] - calls_before
+    with dedup_stats_lock:
+        dedup_stats["images"] += labeled
+    print(f"Labeled {labeled} of {len(records)} images with {calls} Rekognition calls, "
+          f"dedup hit rate {hit_rate(labeled, calls):.1%} (container: "
+          f"{hit_rate(dedup_stats['images'], dedup_stats['rekognition_calls']):.1%})")
+
+    if failures and not any('body' in record for record in event['Records']):
+        # S3 ignores the response, only an error makes Lambda retry the event
+        raise Exception(f"Could not label {failed_images} of {len(records)} images")
+    # Lets the SQS event source retry only the failed messages
+    return {"batchItemFailures": [{"itemIdentifier": identifier} for identifier in failures]}
+
+
+def s3_records(event):
+    """
+    Yield the (item identifier, S3 record) of every image in the event
+
+    An SQS message carries the S3 notification JSON-encoded in its body and
+    is identified by its message ID. The s3:TestEvent sent when the
+    notification is set up has no records.
+    """
     for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-
-        rekognition = boto3.client("rekognition")
-        response = rekognition.detect_labels(
-            Image={
-                "S3Object": {
-                    "Bucket": bucket,
-                    "Name": key,
-                }
-            },
-            MaxLabels=5,
-            MinConfidence=96,
-        )
-
-        labels = response.get('Labels', None)
-
-        for label in labels:
-            dynamodb_table.put_item(Item={
-                "image-id": key,
-                "tag": label['Name'],
-                "conf": Decimal(label['Confidence'])
-            })
+        if 'body' in record:
+            for s3_record in json.loads(record['body']).get('Records', []):
+                yield record['messageId'], s3_record
+        else:
+            yield record['s3']['object']['key'], record
+
+
+def hit_rate(images, rekognition_calls):
+    return 1 - rekognition_calls / images if images else 0.0
+
+
+def dedup_key(record):
+    """
+    Identify the image content and the labeling parameters of an S3 record
+    """
+    etag = record['s3']['object'].get('eTag')
+    if not etag:
+        return None
+    return f"{etag}#{MAX_LABELS}#{MIN_CONFIDENCE}"
+
+
+def detect_image_labels(record):
+    """
+    Return the labels of the image in an S3 record
+
+    Images whose content was labeled before, under any key, are answered
+    from the container's local index or from the label cache table instead
+    of calling Rekognition again.
+    """
+    content_key = dedup_key(record)
+    if content_key:
+        labels = get_cached_labels(content_key)
+        if labels is not None:
+            return labels
+
+    response = rekognition.detect_labels(
+        Image={
+            "S3Object": {
+                "Bucket": record['s3']['bucket']['name'],
+                "Name": record['s3']['object']['key'],
+            }
+        },
+        MaxLabels=MAX_LABELS,
+        MinConfidence=MIN_CONFIDENCE,
+    )
+    with dedup_stats_lock:
+        dedup_stats["rekognition_calls"] += 1
+
+    labels = [
+        {"Name": label['Name'], "Confidence": Decimal(label['Confidence'])}
+        for label in response.get('Labels', [])
+    ]
+    if content_key:
+        put_cached_labels(content_key, labels)
+    return labels
+
+
+def get_cached_labels(content_key):
+    with local_label_cache_lock:
+        labels = local_label_cache.get(content_key)
+        if labels is not None:
+            local_label_cache.move_to_end(content_key)
+            return labels
+
+    if label_cache_table is None:
+        return None
+    try:
+        item = label_cache_table.get_item(Key={"content-hash": content_key}).get('Item')
+    except Exception as e:
+        # The cache only saves Rekognition calls, so an error is handled as a miss
+        print(f"Could not read the label cache for {content_key}: {e}")
+        return None
+    if item is None:
+        return None
+    remember_labels(content_key, item['labels'])
+    return item['labels']
+
+
+def put_cached_labels(content_key, labels):
+    remember_labels(content_key, labels)
+    if label_cache_table is not None:
+        try:
+            label_cache_table.put_item(Item={"content-hash": content_key, "labels": labels})
+        except Exception as e:
+            print(f"Could not write the label cache for {content_key}: {e}")
+
+
+def remember_labels(content_key, labels):
+    with local_label_cache_lock:
+        local_label_cache[content_key] = labels
+        local_label_cache.move_to_end(content_key)
+        while len(local_label_cache) > LOCAL_CACHE_SIZE:
+            local_label_cache.popitem(last=False)
+
+
+def write_items(items, table_name=DYNAMODB_TABLE, max_attempts=None):
+    """
+    Write the items with BatchWriteItem, 25 per request, and return those that could not be written
+
+    DynamoDB may return part of a batch as UnprocessedItems when it is
+    throttling, or reject the whole request; those items are resent with
+    exponential backoff and jitter, up to max_attempts times
+    (MAX_WRITE_ATTEMPTS by default).
+    """
+    max_attempts = max_attempts or MAX_WRITE_ATTEMPTS
+    unwritten = []
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        requests = [{"PutRequest": {"Item": item}} for item in items[start:start + BATCH_WRITE_SIZE]]
+        attempt = 0
+        while True:
+            try:
+                response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+                requests = response.get("UnprocessedItems", {}).get(table_name, [])
+            except ClientError as e:
+                # The whole request was rejected, e.g. throttled: the same items are resent
+                print(f"BatchWriteItem of {len(requests)} items failed: {e}")
+            if not requests:
+                break
+            attempt += 1
+            if attempt >= max_attempts:
+                print(f"{len(requests)} items were still unprocessed after {attempt} attempts")
+                unwritten.extend(request["PutRequest"]["Item"] for request in requests)
+                break
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+    return unwritten
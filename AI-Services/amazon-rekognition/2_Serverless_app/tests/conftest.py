@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The function code is deployed flat from src/, so import it the same way here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# Creating the boto3 clients at import time needs a region, but nothing is sent to AWS
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+os.environ.setdefault("DYNAMODB_TABLE", "AppImageTable")
@@ -0,0 +1,156 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import query_images
+
+IMAGES = {
+    "beach.jpg": {"Sea": 99, "Sand": 98, "Person": 97},
+    "cat.jpg": {"Cat": 99, "Person": 96.5},
+    "dog.jpg": {"Dog": 98.5, "Sand": 97.5},
+    "harbour.jpg": {"Sea": 97, "Boat": 99},
+    "lake.jpg": {"Sea": 96, "Person": 98},
+}
+
+
+def key_conditions(condition):
+    """ Return {attribute: (operator, value)} of a boto3 key condition """
+    expression = condition.get_expression()
+    if expression["operator"] == "AND":
+        return dict(key_conditions(expression["values"][0]), **key_conditions(expression["values"][1]))
+    key, value = expression["values"]
+    return {key.name: (expression["operator"], value)}
+
+
+class StubImageTable:
+    """ Local stand-in for AppImageTable and its TagIndex """
+
+    def __init__(self, images):
+        self.items = {
+            (image_id, tag): {"image-id": image_id, "tag": tag, "conf": Decimal(str(conf))}
+            for image_id, tags in images.items() for tag, conf in tags.items()
+        }
+        self.queries = 0
+
+    def query(self, IndexName, KeyConditionExpression, ScanIndexForward, Limit, ExclusiveStartKey=None):
+        assert IndexName == "TagIndex" and not ScanIndexForward
+        self.queries += 1
+        conditions = key_conditions(KeyConditionExpression)
+        items = [item for item in self.items.values() if item["tag"] == conditions["tag"][1]]
+        if "conf" in conditions:
+            items = [item for item in items if item["conf"] >= conditions["conf"][1]]
+        # Like a GSI: sorted on the index key, ties in an arbitrary but stable order
+        items.sort(key=lambda item: (item["conf"], item["image-id"]), reverse=True)
+        if ExclusiveStartKey:
+            start = (ExclusiveStartKey["conf"], ExclusiveStartKey["image-id"])
+            items = [item for item in items if (item["conf"], item["image-id"]) < start]
+        page = items[:Limit]
+        response = {"Items": [dict(item) for item in page]}
+        if len(items) > Limit:
+            response["LastEvaluatedKey"] = {key: page[-1][key] for key in ("tag", "conf", "image-id")}
+        return response
+
+    def batch_get_item(self, RequestItems):
+        (table_name, request), = RequestItems.items()
+        keys = [(key["image-id"], key["tag"]) for key in request["Keys"]]
+        assert len(keys) <= 100 and len(set(keys)) == len(keys)
+        return {"Responses": {table_name: [dict(self.items[key]) for key in keys if key in self.items]}}
+
+
+@pytest.fixture()
+def table(monkeypatch):
+    stub = StubImageTable(IMAGES)
+    monkeypatch.setattr(query_images, "dynamodb_table", stub)
+    monkeypatch.setattr(query_images, "dynamodb", stub)
+    monkeypatch.setattr(query_images, "DYNAMODB_TABLE", "AppImageTable")
+    return stub
+
+
+def all_pages(tags, **kwargs):
+    images, next_token = [], None
+    while True:
+        page = query_images.query_images(tags, next_token=next_token, **kwargs)
+        images.extend(image["image-id"] for image in page["images"])
+        next_token = page["next_token"]
+        if next_token is None:
+            return images
+
+
+def test_single_tag_in_confidence_order(table):
+    page = query_images.query_images(["Sea"])
+
+    assert [image["image-id"] for image in page["images"]] == ["beach.jpg", "harbour.jpg", "lake.jpg"]
+    assert page["images"][0]["tags"] == {"Sea": Decimal("99")}
+    assert page["next_token"] is None
+
+
+def test_pages_resume_where_the_previous_one_stopped(table):
+    assert all_pages(["Person"], limit=1) == ["lake.jpg", "beach.jpg", "cat.jpg"]
+    assert all_pages(["Person"], limit=2) == ["lake.jpg", "beach.jpg", "cat.jpg"]
+
+
+def test_and_query_returns_images_with_every_tag(table):
+    page = query_images.query_images(["Sea", "Person"], mode="and")
+
+    assert [image["image-id"] for image in page["images"]] == ["beach.jpg", "lake.jpg"]
+    assert page["images"][1]["tags"] == {"Sea": Decimal("96"), "Person": Decimal("98")}
+    assert all_pages(["Sea", "Person"], mode="and", limit=1) == ["beach.jpg", "lake.jpg"]
+
+
+def test_or_query_returns_every_image_once(table):
+    expected = ["beach.jpg", "cat.jpg", "harbour.jpg", "lake.jpg", "dog.jpg"]
+
+    page = query_images.query_images(["Sea", "Person", "Cat", "Sand", "Boat"], mode="or")
+
+    assert sorted(image["image-id"] for image in page["images"]) == sorted(expected)
+    for limit in (1, 2, 3):
+        images = all_pages(["Sea", "Person", "Cat", "Sand", "Boat"], mode="or", limit=limit)
+        assert sorted(images) == sorted(expected)
+
+
+def test_min_confidence_applies_to_every_tag(table):
+    assert all_pages(["Sea"], min_confidence=Decimal("97")) == ["beach.jpg", "harbour.jpg"]
+    assert all_pages(["Sea", "Person"], mode="and", min_confidence=Decimal("97")) == ["beach.jpg"]
+
+
+def test_a_page_reads_only_the_index_it_needs(table):
+    for index in range(1000):
+        table.items[("other-{}.jpg".format(index), "Tree")] = {"image-id": "other-{}.jpg".format(index), "tag": "Tree", "conf": Decimal("99")}
+
+    query_images.query_images(["Sea"], limit=2)
+
+    assert table.queries == 1
+
+
+def test_rare_combination_reads_a_bounded_number_of_pages(table, monkeypatch):
+    monkeypatch.setattr(query_images, "MAX_QUERY_PAGES", 2)
+    for index in range(100):
+        table.items[("tree-{}.jpg".format(index), "Tree")] = {"image-id": "tree-{}.jpg".format(index), "tag": "Tree", "conf": Decimal("99")}
+    table.items[("lake.jpg", "Tree")] = {"image-id": "lake.jpg", "tag": "Tree", "conf": Decimal("90")}
+
+    page = query_images.query_images(["Tree", "Sea"], mode="and", limit=5)
+
+    assert page["images"] == [] and page["next_token"]
+    assert table.queries == 2
+    # The following pages go on from there, and find the image at the end of the index
+    assert all_pages(["Tree", "Sea"], mode="and", limit=5) == ["lake.jpg"]
+
+
+def test_handler_validates_the_request(table):
+    bad_requests = [
+        {},
+        {"tags": "Sea", "mode": "xor"},
+        {"tags": "Sea", "limit": "0"},
+        {"tags": "Sea", "next_token": "not-a-token"},
+        {"tags": "Sea", "min_confidence": "abc"},
+        {"tags": "Sea", "min_confidence": "NaN"},
+    ]
+    for params in bad_requests:
+        assert query_images.lambda_handler({"queryStringParameters": params}, None)["statusCode"] == 400
+
+    response = query_images.lambda_handler({"queryStringParameters": {"tags": "Sea,Person", "limit": "1"}}, None)
+    body = json.loads(response["body"])
+    assert response["statusCode"] == 200
+    assert body["images"] == [{"image-id": "beach.jpg", "tags": {"Sea": 99.0, "Person": 97.0}}]
+    assert body["next_token"]
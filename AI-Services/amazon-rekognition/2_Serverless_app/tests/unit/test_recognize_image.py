@@ -0,0 +1,275 @@
+import collections
+import json
+import threading
+import time
+import types
+
+import pytest
+from botocore.exceptions import ClientError
+
+import recognize_image
+
+
+class StubRekognition:
+    """ Local stand-in for Rekognition with a fixed round trip per call """
+
+    def __init__(self, latency=0.0, failing_keys=()):
+        self.latency = latency
+        self.failing_keys = set(failing_keys)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def detect_labels(self, Image, MaxLabels, MinConfidence):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        key = Image["S3Object"]["Name"]
+        if key in self.failing_keys:
+            raise RuntimeError("InvalidImageFormatException")
+        return {"Labels": [{"Name": "Cat", "Confidence": 99.1}, {"Name": key, "Confidence": 97.0}]}
+
+
+class StubDynamoDB:
+    """ Local stand-in for the DynamoDB resource """
+
+    def __init__(self, unprocessed_batches=0):
+        self.unprocessed_batches = unprocessed_batches
+        self.rejected_requests = 0
+        self.rejected_images = set()
+        self.requests = []
+        self.items = {}
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        self.requests.append(requests)
+        # When throttled as a whole, nothing of the batch is written
+        image_ids = {request["PutRequest"]["Item"]["image-id"] for request in requests}
+        if self.rejected_requests or image_ids & self.rejected_images:
+            self.rejected_requests = max(0, self.rejected_requests - 1)
+            error = {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "Throughput exceeded"}}
+            raise ClientError(error, "BatchWriteItem")
+        # When throttled, only the first item of the batch is written
+        unprocessed = []
+        if self.unprocessed_batches:
+            self.unprocessed_batches -= 1
+            requests, unprocessed = requests[:1], requests[1:]
+        for request in requests:
+            item = request["PutRequest"]["Item"]
+            self.items[(item["image-id"], item["tag"])] = item
+        return {"UnprocessedItems": {table_name: unprocessed} if unprocessed else {}}
+
+
+class StubTable:
+    """ Local stand-in for the label cache table """
+
+    def __init__(self, failing=False):
+        self.items = {}
+        self.failing = failing
+
+    def get_item(self, Key):
+        if self.failing:
+            raise RuntimeError("ProvisionedThroughputExceededException")
+        item = self.items.get(Key["content-hash"])
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item):
+        if self.failing:
+            raise RuntimeError("ProvisionedThroughputExceededException")
+        self.items[Item["content-hash"]] = Item
+
+
+def s3_event(keys, etags=None):
+    records = [{"s3": {"bucket": {"name": "image-bucket"}, "object": {"key": key}}} for key in keys]
+    for record, etag in zip(records, etags or []):
+        record["s3"]["object"]["eTag"] = etag
+    return {"Records": records}
+
+
+def sqs_event(*s3_events):
+    return {"Records": [
+        {"messageId": "message-{}".format(index), "body": json.dumps(body)} for index, body in enumerate(s3_events)
+    ]}
+
+
+@pytest.fixture()
+def dynamodb(monkeypatch):
+    stub = StubDynamoDB()
+    monkeypatch.setattr(recognize_image, "dynamodb", stub)
+    monkeypatch.setattr(recognize_image, "label_cache_table", None)
+    monkeypatch.setattr(recognize_image, "local_label_cache", collections.OrderedDict())
+    monkeypatch.setattr(recognize_image, "dedup_stats", {"images": 0, "rekognition_calls": 0})
+    # No backoff delays in the tests
+    monkeypatch.setattr(recognize_image, "random", types.SimpleNamespace(uniform=lambda low, high: 0))
+    return stub
+
+
+def run(monkeypatch, rekognition, keys, concurrency):
+    monkeypatch.setattr(recognize_image, "rekognition", rekognition)
+    monkeypatch.setattr(recognize_image, "MAX_CONCURRENCY", concurrency)
+    start = time.perf_counter()
+    result = recognize_image.lambda_handler(sqs_event(*[s3_event([key]) for key in keys]), None)
+    return result, time.perf_counter() - start
+
+
+def test_labels_are_written_in_batches(monkeypatch, dynamodb):
+    keys = ["image-{}.jpg".format(i) for i in range(20)]
+
+    result, _ = run(monkeypatch, StubRekognition(), keys, concurrency=4)
+
+    assert result == {"batchItemFailures": []}
+    # 20 shared "Cat" labels + 20 per-image labels, in two BatchWriteItem calls
+    assert len(dynamodb.items) == 40
+    assert [len(requests) for requests in dynamodb.requests] == [25, 15]
+
+
+def test_unprocessed_items_are_retried(monkeypatch, dynamodb):
+    dynamodb.unprocessed_batches = 2
+
+    run(monkeypatch, StubRekognition(), ["a.jpg", "b.jpg"], concurrency=2)
+
+    assert [len(requests) for requests in dynamodb.requests] == [4, 3, 2]
+    assert len(dynamodb.items) == 4
+
+
+def test_records_whose_labels_are_not_written_fail(monkeypatch, dynamodb):
+    monkeypatch.setattr(recognize_image, "MAX_WRITE_ATTEMPTS", 2)
+    # Throttled on every request: one item is written per BatchWriteItem call
+    dynamodb.unprocessed_batches = 100
+
+    result, _ = run(monkeypatch, StubRekognition(), ["a.jpg", "b.jpg"], concurrency=1)
+
+    assert result == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    assert set(dynamodb.items) == {("a.jpg", "Cat"), ("a.jpg", "a.jpg")}
+
+
+def test_rejected_batches_are_retried(monkeypatch, dynamodb):
+    dynamodb.rejected_requests = 2
+
+    result, _ = run(monkeypatch, StubRekognition(), ["a.jpg", "b.jpg"], concurrency=2)
+
+    assert result == {"batchItemFailures": []}
+    assert [len(requests) for requests in dynamodb.requests] == [4, 4, 4]
+    assert len(dynamodb.items) == 4
+
+
+def test_rejected_batches_only_fail_their_records(monkeypatch, dynamodb):
+    monkeypatch.setattr(recognize_image, "MAX_WRITE_ATTEMPTS", 2)
+    monkeypatch.setattr(recognize_image, "BATCH_WRITE_SIZE", 2)
+    dynamodb.rejected_images = {"b.jpg"}
+
+    result, _ = run(monkeypatch, StubRekognition(), ["a.jpg", "b.jpg", "c.jpg"], concurrency=1)
+
+    # The chunk of b.jpg is rejected on every attempt, the chunks after it are still written
+    assert result == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    assert {image_id for image_id, _ in dynamodb.items} == {"a.jpg", "c.jpg"}
+
+
+def test_failed_records_are_reported_individually(monkeypatch, dynamodb):
+    result, _ = run(monkeypatch, StubRekognition(failing_keys=["broken.jpg"]), ["ok.jpg", "broken.jpg"], concurrency=2)
+
+    assert result == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    assert set(dynamodb.items) == {("ok.jpg", "Cat"), ("ok.jpg", "ok.jpg")}
+
+
+def test_sqs_messages_carry_s3_notifications(monkeypatch, dynamodb):
+    monkeypatch.setattr(recognize_image, "rekognition", StubRekognition(failing_keys=["broken.jpg"]))
+    event = sqs_event(s3_event(["a.jpg", "broken.jpg"]), {"Event": "s3:TestEvent"}, s3_event(["b.jpg"]))
+
+    result = recognize_image.lambda_handler(event, None)
+
+    # A message fails once, whatever the number of its failed images
+    assert result == {"batchItemFailures": [{"itemIdentifier": "message-0"}]}
+    assert {key for key, _ in dynamodb.items} == {"a.jpg", "b.jpg"}
+
+
+def test_direct_s3_event_raises_on_failure(monkeypatch, dynamodb):
+    monkeypatch.setattr(recognize_image, "rekognition", StubRekognition(failing_keys=["broken.jpg"]))
+
+    with pytest.raises(Exception, match="1 of 2 images"):
+        recognize_image.lambda_handler(s3_event(["ok.jpg", "broken.jpg"]), None)
+    # The other image is labeled before the invocation fails
+    assert set(dynamodb.items) == {("ok.jpg", "Cat"), ("ok.jpg", "ok.jpg")}
+
+
+def test_concurrent_labeling_is_faster_than_sequential(monkeypatch, dynamodb):
+    keys = ["image-{}.jpg".format(i) for i in range(8)]
+
+    _, sequential = run(monkeypatch, StubRekognition(latency=0.05), keys, concurrency=1)
+    _, concurrent = run(monkeypatch, StubRekognition(latency=0.05), keys, concurrency=8)
+
+    assert sequential >= 8 * 0.05
+    assert concurrent < sequential / 3
+
+
+def test_identical_contents_are_labeled_once(monkeypatch, dynamodb):
+    rekognition = StubRekognition()
+    monkeypatch.setattr(recognize_image, "rekognition", rekognition)
+    event = s3_event(["a.jpg", "copy-of-a.jpg", "b.jpg"], etags=["etag-a", "etag-a", "etag-b"])
+
+    result = recognize_image.lambda_handler(event, None)
+
+    assert result == {"batchItemFailures": []}
+    assert rekognition.calls == 2
+    # The copy gets the labels of the image it duplicates
+    assert dynamodb.items[("copy-of-a.jpg", "a.jpg")]["tag"] == "a.jpg"
+    assert dynamodb.items[("copy-of-a.jpg", "Cat")]["image-id"] == "copy-of-a.jpg"
+
+
+def test_labels_are_reused_across_invocations(monkeypatch, dynamodb):
+    rekognition = StubRekognition()
+    monkeypatch.setattr(recognize_image, "rekognition", rekognition)
+
+    recognize_image.lambda_handler(s3_event(["a.jpg"], etags=["etag-a"]), None)
+    recognize_image.lambda_handler(s3_event(["again.jpg"], etags=["etag-a"]), None)
+
+    assert rekognition.calls == 1
+    assert recognize_image.dedup_stats == {"images": 2, "rekognition_calls": 1}
+    assert recognize_image.hit_rate(2, 1) == 0.5
+
+
+def test_label_cache_table_is_shared_between_containers(monkeypatch, dynamodb):
+    table = StubTable()
+    rekognition = StubRekognition()
+    monkeypatch.setattr(recognize_image, "rekognition", rekognition)
+    monkeypatch.setattr(recognize_image, "label_cache_table", table)
+
+    recognize_image.lambda_handler(s3_event(["a.jpg"], etags=["etag-a"]), None)
+    # A new container starts with an empty local index
+    recognize_image.local_label_cache.clear()
+    recognize_image.lambda_handler(s3_event(["again.jpg"], etags=["etag-a"]), None)
+
+    assert rekognition.calls == 1
+    assert list(table.items) == ["etag-a#5#96.0"]
+
+
+def test_changed_labeling_parameters_miss_the_cache(monkeypatch, dynamodb):
+    rekognition = StubRekognition()
+    monkeypatch.setattr(recognize_image, "rekognition", rekognition)
+
+    recognize_image.lambda_handler(s3_event(["a.jpg"], etags=["etag-a"]), None)
+    monkeypatch.setattr(recognize_image, "MAX_LABELS", 10)
+    recognize_image.lambda_handler(s3_event(["a.jpg"], etags=["etag-a"]), None)
+
+    assert rekognition.calls == 2
+
+
+def test_label_cache_errors_fall_back_to_rekognition(monkeypatch, dynamodb):
+    rekognition = StubRekognition()
+    monkeypatch.setattr(recognize_image, "rekognition", rekognition)
+    monkeypatch.setattr(recognize_image, "label_cache_table", StubTable(failing=True))
+
+    result = recognize_image.lambda_handler(s3_event(["a.jpg", "b.jpg"], etags=["etag-a", "etag-b"]), None)
+
+    assert result == {"batchItemFailures": []}
+    assert rekognition.calls == 2
+    assert len(dynamodb.items) == 4
+
+
+def test_rekognition_calls_are_counted_across_threads(monkeypatch, dynamodb):
+    keys = ["image-{}.jpg".format(i) for i in range(200)]
+    monkeypatch.setattr(recognize_image, "rekognition", StubRekognition())
+    monkeypatch.setattr(recognize_image, "MAX_CONCURRENCY", 16)
+
+    recognize_image.lambda_handler(s3_event(keys, etags=keys), None)
+
+    assert recognize_image.dedup_stats == {"images": 200, "rekognition_calls": 200}
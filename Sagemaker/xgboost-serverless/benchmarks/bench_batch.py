@@ -0,0 +1,54 @@
+"""
+Compare rows/sec of the predictor for JSON matrix and base64 float32 batches
+
+Usage:
+    python benchmarks/bench_batch.py --sizes 1 100 1000 10000 --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from events import build_event, stub_secrets  # also puts iris_model_predictor on sys.path
+
+import app
+
+
+def run(event, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = app.lambda_handler(event, None)
+        timings.append(time.perf_counter() - start)
+        assert response["statusCode"] == 200, response["body"]
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    # Keep the per-request logging out of the measurements
+    sys.stdout, stdout = open(os.devnull, "w"), sys.stdout
+    try:
+        stub_secrets()
+        app.model_registry.load()
+        results = []
+        for rows in args.sizes:
+            for name in ["json", "base64"]:
+                seconds = run(build_event(rows, name), args.repeat)
+                results.append((rows, name, seconds))
+    finally:
+        sys.stdout = stdout
+
+    print("{:>8} {:>8} {:>12} {:>14}".format("rows", "format", "median ms", "rows/sec"))
+    for rows, name, seconds in results:
+        print("{:>8} {:>8} {:>12.3f} {:>14.0f}".format(rows, name, seconds * 1000, rows / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compare the pickle + DMatrix path with the native model + inplace_predict path
+
+The pickle is produced from the native model at startup, so both paths
+always score the same booster with the installed xgboost version.
+
+Usage:
+    python benchmarks/bench_model_format.py --sizes 1 100 10000 --repeat 50
+"""
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import xgboost
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iris_model_predictor", "model")
+
+
+def median_seconds(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def load_native(path):
+    booster = xgboost.Booster()
+    booster.load_model(path)
+    return booster
+
+
+def load_pickle(path):
+    with open(path, "rb") as model_file:
+        return pickle.load(model_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=os.path.join(MODEL_DIR, "iris_model.json"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    booster = load_native(args.model)
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = os.path.join(tmp, "model.pkl")
+        ubj_path = os.path.join(tmp, "model.ubj")
+        with open(pickle_path, "wb") as model_file:
+            pickle.dump(booster, model_file)
+        booster.save_model(ubj_path)
+
+        print("{:<24} {:>12}".format("load", "median ms"))
+        for name, loader, path in [
+            ("pickle", load_pickle, pickle_path),
+            ("native json", load_native, args.model),
+            ("native ubj", load_native, ubj_path),
+        ]:
+            seconds = median_seconds(lambda: loader(path), args.repeat)
+            print("{:<24} {:>12.3f}".format(name, seconds * 1000))
+        pickled = load_pickle(pickle_path)
+
+    print()
+    print("{:>8} {:>20} {:>20} {:>10}".format("rows", "DMatrix ms", "inplace ms", "speedup"))
+    rng = np.random.default_rng(0)
+    for rows in args.sizes:
+        data = rng.uniform(0.1, 8.0, size=(rows, 4)).astype(np.float32)
+        dmatrix = median_seconds(lambda: pickled.predict(xgboost.DMatrix(data)), args.repeat)
+        inplace = median_seconds(lambda: booster.inplace_predict(data), args.repeat)
+        np.testing.assert_allclose(pickled.predict(xgboost.DMatrix(data)), booster.inplace_predict(data), rtol=1e-5)
+        print("{:>8} {:>20.3f} {:>20.3f} {:>9.1f}x".format(rows, dmatrix * 1000, inplace * 1000, dmatrix / inplace))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Shared helpers to invoke the predictor in-process, without AWS
+"""
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+PREDICTOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iris_model_predictor")
+API_KEY = "benchmark-key"
+
+sys.path.insert(0, PREDICTOR_DIR)
+os.environ.setdefault("MODEL_PATH", os.path.join(PREDICTOR_DIR, "model", "iris_model.json"))
+
+
+class StubSecretsManager:
+    """
+    Local stand-in for Secrets Manager, with an optional round-trip delay
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def get_secret_value(self, SecretId):
+        time.sleep(self.latency)
+        return {"SecretString": json.dumps({"token": API_KEY})}
+
+
+def stub_secrets(latency=0.0):
+    """
+    Point the authorizer at the local Secrets Manager stand-in
+    """
+    import authorizer
+
+    authorizer.secret_cache = authorizer.SecretCache("benchmark", client=StubSecretsManager(latency))
+
+
+def feature_rows(rows, seed=0):
+    return np.random.default_rng(seed).uniform(0.1, 8.0, size=(rows, 4)).astype("<f4")
+
+
+def build_event(rows, body_format="json", seed=0):
+    """
+    Build an API Gateway proxy event carrying ``rows`` random iris rows
+    """
+    data = feature_rows(rows, seed)
+    if body_format == "base64":
+        body = {"data_b64": base64.b64encode(data.tobytes()).decode(), "num_features": data.shape[1]}
+    else:
+        body = {"data": data.tolist()}
+    return {
+        "resource": "/predict/",
+        "path": "/predict/",
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json", "x-api-key": API_KEY},
+        "queryStringParameters": None,
+        "requestContext": {"resourcePath": "/predict/", "httpMethod": "POST", "stage": "v1"},
+        "body": json.dumps(body),
+        "isBase64Encoded": False,
+    }
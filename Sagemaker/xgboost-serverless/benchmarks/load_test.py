@@ -0,0 +1,166 @@
+"""
+Load test the predictor in-process and report throughput and latency percentiles
+
+Cold invocations run in a fresh interpreter (import + first request); warm
+invocations are sent concurrently to an already initialized handler, for
+every batch size. Secrets Manager is replaced by a local stub.
+
+Usage:
+    python benchmarks/load_test.py --save-baseline baseline.json
+    python benchmarks/load_test.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from events import PREDICTOR_DIR, build_event, stub_secrets  # also puts iris_model_predictor on sys.path
+
+COLD_START_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {benchmarks_dir!r})
+start = time.perf_counter()
+from events import build_event, stub_secrets
+import app
+stub_secrets(latency={secret_latency!r})
+imported = time.perf_counter()
+response = app.lambda_handler(build_event(1), None)
+assert response["statusCode"] == 200, response["body"]
+done = time.perf_counter()
+print(json.dumps({{"init": imported - start, "first_request": done - imported}}))
+"""
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def run_cold(invocations, secret_latency):
+    """
+    Time the import and first request of fresh interpreters
+    """
+    script = COLD_START_SCRIPT.format(
+        benchmarks_dir=os.path.dirname(os.path.abspath(__file__)),
+        secret_latency=secret_latency,
+    )
+    totals, inits = [], []
+    for _ in range(invocations):
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=PREDICTOR_DIR, stderr=subprocess.DEVNULL)
+        timings = json.loads(output.decode().strip().splitlines()[-1])
+        inits.append(timings["init"])
+        totals.append(timings["init"] + timings["first_request"])
+    result = {"invocations": invocations, "init_p50_ms": round(float(np.median(inits)) * 1000, 3)}
+    result.update(percentiles(totals))
+    return result
+
+
+def run_warm(app, rows, requests, concurrency, body_format):
+    """
+    Send ``requests`` events of ``rows`` rows with ``concurrency`` workers
+    """
+    event = build_event(rows, body_format)
+
+    def invoke(_):
+        start = time.perf_counter()
+        response = app.lambda_handler(event, None)
+        latency = time.perf_counter() - start
+        assert response["statusCode"] == 200, response["body"]
+        return latency
+
+    invoke(None)  # warm up, so the first request's secret fetch is not counted
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        latencies = list(executor.map(invoke, range(requests)))
+        elapsed = time.perf_counter() - start
+
+    result = {
+        "rows": rows,
+        "format": body_format,
+        "requests": requests,
+        "concurrency": concurrency,
+        "requests_per_sec": round(requests / elapsed, 1),
+        "rows_per_sec": round(requests * rows / elapsed, 1),
+    }
+    result.update(percentiles(latencies))
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a message for every p95 latency that regressed beyond ``tolerance``
+    """
+    regressions = []
+    if results["cold"]["p95_ms"] > baseline["cold"]["p95_ms"] * (1 + tolerance):
+        regressions.append("cold p95 {} ms > baseline {} ms".format(results["cold"]["p95_ms"], baseline["cold"]["p95_ms"]))
+    baseline_warm = {(run["rows"], run["format"]): run for run in baseline["warm"]}
+    for run in results["warm"]:
+        reference = baseline_warm.get((run["rows"], run["format"]))
+        if reference and run["p95_ms"] > reference["p95_ms"] * (1 + tolerance):
+            regressions.append("warm {} rows ({}) p95 {} ms > baseline {} ms".format(
+                run["rows"], run["format"], run["p95_ms"], reference["p95_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 1000, 10000])
+    parser.add_argument("--formats", nargs="+", default=["json", "base64"], choices=["json", "base64"])
+    parser.add_argument("--requests", type=int, default=200, help="warm requests per batch size")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--cold", type=int, default=5, help="cold invocations")
+    parser.add_argument("--secret-latency", type=float, default=0.05, help="simulated Secrets Manager round trip (s)")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 regression, as a fraction")
+    args = parser.parse_args()
+
+    # Keep the per-request logging out of the measurements
+    sys.stdout, stdout = open(os.devnull, "w"), sys.stdout
+    try:
+        results = {"cold": run_cold(args.cold, args.secret_latency), "warm": []}
+
+        import app
+        stub_secrets(args.secret_latency)
+        app.model_registry.load()
+        for rows in args.sizes:
+            for body_format in args.formats:
+                results["warm"].append(run_warm(app, rows, args.requests, args.concurrency, body_format))
+    finally:
+        sys.stdout = stdout
+
+    cold = results["cold"]
+    print("cold: {} invocations, init p50 {} ms, total p50/p95/p99 {}/{}/{} ms".format(
+        cold["invocations"], cold["init_p50_ms"], cold["p50_ms"], cold["p95_ms"], cold["p99_ms"]))
+    print("{:>8} {:>8} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+        "rows", "format", "req/sec", "rows/sec", "p50 ms", "p95 ms", "p99 ms"))
+    for run in results["warm"]:
+        print("{:>8} {:>8} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+            run["rows"], run["format"], run["requests_per_sec"], run["rows_per_sec"],
+            run["p50_ms"], run["p95_ms"], run["p99_ms"]))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("Baseline saved to {}".format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,24 @@
 import json
-from authorizer import is_authorized
-import pickle
-import xgboost
-import numpy as np
+import os
+from profiling import phase, report_once, timed_import
+
+# xgboost, boto3 and pyarrow are imported lazily, the first time they are needed
+np = timed_import("numpy")
+with phase("import app modules"):
+    from authorizer import is_authorized
+    from model_registry import MODEL_PATH, ModelRegistry
+    from payloads import PayloadError, check_features, decode_event, encode_response, get_header, iter_chunks, negotiate
+    from prediction_cache import PREDICTION_CACHE_SIZE, PredictionCache
+
+
+# Loaded once per container and reused by every warm invocation
+model_registry = ModelRegistry(MODEL_PATH)
+
+if os.environ.get("MODEL_PRELOAD", "false").lower() == "true":
+    model_registry.load()
+
+# Repeated feature rows are answered from memory when PREDICTION_CACHE_SIZE > 0
+prediction_cache = PredictionCache() if PREDICTION_CACHE_SIZE > 0 else None
 
 
 def lambda_handler(event, context):
@@ -26,27 +42,55 @@ def lambda_handler(event, context):
 
         Return doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
     """
-    print('Received event: ' + json.dumps(event, indent=2))
-
-    print("Loading model...")
-    model = pickle.load(open('iris_model.pkl', 'rb'))
-    print("model loaded")
+    print('Received event: ' + json.dumps({key: value for key, value in event.items() if key != "body"}, indent=2))
 
     if not is_authorized(event.get("headers", {})):
-        return {
-            "body": json.dumps({"message": "Invalid API key"}),
-            "statusCode": 400,
-            "headers": {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"},
-        }
-    data = np.array(json.loads(event["body"])["data"])
-    input_data = xgboost.DMatrix(data)
+        return error_response("Invalid API key", 400)
+    model = model_registry.get()
+    report_once()
 
-    predictions_local = model.predict(input_data)
-    result = np.round(predictions_local).tolist()
+    try:
+        data, chunk_size = decode_event(event)
+        check_features(data, model.num_features())
+        response_type = negotiate(get_header(event.get("headers"), "Accept"))
+    except PayloadError as e:
+        return error_response(str(e), e.status_code)
 
-    print("Returning: {}".format(result))
+    if prediction_cache is None:
+        result_chunks = predict_chunks(model, data, chunk_size)
+    else:
+        result = prediction_cache.predict(
+            data, model_registry.digest, lambda rows: np.concatenate(list(predict_chunks(model, rows, chunk_size)))
+        )
+        result_chunks = iter_chunks(result, chunk_size)
+        print("Prediction cache: {}".format(json.dumps(prediction_cache.stats())))
+    body, is_base64 = encode_response(result_chunks, response_type)
+
+    print("Returning {} predictions as {}".format(data.shape[0], response_type))
 
     return {
         "statusCode": 200,
-        "body": json.dumps({"result": result})
+        "body": body,
+        "isBase64Encoded": is_base64,
+        "headers": {"Content-Type": response_type},
+    }
+
+
+def error_response(message, status_code):
+    return {
+        "body": json.dumps({"message": message}),
+        "statusCode": status_code,
+        "headers": {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"},
     }
+
+
+def predict_chunks(model, data, chunk_size):
+    """
+    Score ``data`` in fixed-size blocks and yield the rounded predictions
+
+    ``inplace_predict`` reads the NumPy blocks directly instead of copying
+    them into a DMatrix first. Only one block is materialized at a time,
+    which bounds peak memory for large batches.
+    """
+    for chunk in iter_chunks(data, chunk_size):
+        yield np.round(model.inplace_predict(chunk))
@@ -1,21 +1,136 @@
 """
 Helper module for request authentication
 """
-import boto3
+import hmac
 import json
+import os
+import threading
+import time
 
+from profiling import phase, timed_import
 
-secret_manager = boto3.client("secretsmanager", region_name='eu-central-1')
-get_secret_value_response = secret_manager.get_secret_value(
-    SecretId="tunisia_pydata_demo"
-)
 
+API_KEY_SECRET_ID = os.environ.get("API_KEY_SECRET_ID", "tunisia_pydata_demo")
+API_KEY_SECRET_REGION = os.environ.get("API_KEY_SECRET_REGION", os.environ.get("AWS_REGION", "eu-central-1"))
+API_KEY_SECRET_TTL = float(os.environ.get("API_KEY_SECRET_TTL", "300"))
+# First delay before retrying a failed refresh, doubled after every failure up to the TTL
+API_KEY_SECRET_RETRY = float(os.environ.get("API_KEY_SECRET_RETRY", "5"))
+API_KEY_HEADER = "x-api-key"
 
-API_KEY = json.loads(get_secret_value_response['SecretString'])["token"]
 
+def parse_api_keys(secret_string):
+    """
+    Return every API key that is currently valid
+
+    The secret holds the current key in ``token``. While a key is being
+    rotated the old one can be kept in ``previous_token``, and any number of
+    keys can be listed in ``tokens``.
+    """
+    secret = json.loads(secret_string)
+    keys = [secret.get("token"), secret.get("previous_token")] + list(secret.get("tokens", []))
+    return tuple(key.encode("utf-8") for key in keys if key)
+
+
+class SecretCache:
+    """
+    Keep the API keys in memory and refresh them from Secrets Manager
+
+    The secret is fetched on first use, not at import time. Once it is older
+    than ``ttl`` seconds the cached keys keep being served while a background
+    thread fetches the new ones, so requests never wait on a refresh. A
+    failed refresh is retried after ``retry`` seconds, doubled after every
+    further failure, so an outage of Secrets Manager is not hit by every
+    request.
+    """
+
+    def __init__(self, secret_id, region_name=API_KEY_SECRET_REGION, ttl=API_KEY_SECRET_TTL,
+                 client=None, retry=API_KEY_SECRET_RETRY):
+        self.secret_id = secret_id
+        self.region_name = region_name
+        self.ttl = ttl
+        self.retry = retry
+        self._client = client
+        self._keys = None
+        self._loaded_at = 0.0
+        self._retry_at = 0.0
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            boto3 = timed_import("boto3")
+            self._client = boto3.client("secretsmanager", region_name=self.region_name)
+        return self._client
+
+    def keys(self):
+        """
+        Return the valid API keys, loading them on the first call
+        """
+        keys = self._keys
+        if keys is None:
+            with self._lock:
+                if self._keys is None:
+                    with phase("secret fetch"):
+                        self.refresh()
+                keys = self._keys
+        else:
+            now = time.monotonic()
+            if now - self._loaded_at >= self.ttl and now >= self._retry_at:
+                self._refresh_in_background()
+        return keys
 
-def is_authorized(headers):
+    def refresh(self):
+        """
+        Fetch the secret and replace the cached keys
+        """
+        response = self.client.get_secret_value(SecretId=self.secret_id)
+        self._keys = parse_api_keys(response["SecretString"])
+        self._loaded_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._safe_refresh, daemon=True)
+            self._refresh_thread.start()
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self._failures += 1
+            delay = min(max(self.ttl, self.retry), self.retry * 2 ** (self._failures - 1))
+            self._retry_at = time.monotonic() + delay
+            print("Could not refresh the API keys, keeping the cached ones and retrying in {:.0f} s: {}".format(delay, e))
+        else:
+            self._failures = 0
+            self._retry_at = 0.0
+
+
+secret_cache = SecretCache(API_KEY_SECRET_ID)
+
+
+def get_api_key(headers):
     """
-    Verify that a request contains the correct API key
+    Return the API key header, whatever its capitalization
+    """
+    for name, value in (headers or {}).items():
+        if name.lower() == API_KEY_HEADER:
+            return value or ""
+    return ""
+
+
+def is_authorized(headers, cache=None):
+    """
+    Verify that a request contains a valid API key
+
+    Every key is compared in constant time, so the response time does not
+    reveal how much of a key matched or which key it was compared with.
     """
-    return headers.get("x-api-key", "") == API_KEY or headers.get("X-Api-Key", "") == API_KEY
+    presented = get_api_key(headers).encode("utf-8")
+    authorized = False
+    for key in (cache or secret_cache).keys():
+        authorized |= hmac.compare_digest(presented, key)
+    return bool(presented) and authorized
@@ -0,0 +1,100 @@
+"""
+Helper module for loading the model once per container
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from profiling import phase, timed_import
+
+
+MODEL_PATH = os.environ.get("MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "iris_model.json"))
+MODEL_CHECK_INTERVAL = float(os.environ.get("MODEL_CHECK_INTERVAL", "30"))
+
+
+def load_model(path):
+    """
+    Load a model artifact, picking the format from the file extension
+
+    ``.json`` and ``.ubj`` files are loaded with XGBoost's native loader,
+    which is faster than unpickling and does not depend on the exact xgboost
+    version that wrote the file. ``.pkl`` files are still supported.
+    """
+    if path.endswith((".json", ".ubj")):
+        xgboost = timed_import("xgboost")
+        booster = xgboost.Booster()
+        booster.load_model(path)
+        return booster
+    with open(path, "rb") as model_file:
+        return pickle.load(model_file)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Return the sha256 hex digest of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as model_file:
+        for chunk in iter(lambda: model_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Keep a loaded model for the lifetime of the container
+
+    The artifact is loaded on the first call to ``get`` (or on ``load``) and
+    reused afterwards. At most every ``check_interval`` seconds the file's
+    mtime and size are checked; when they change the file is hashed and, if
+    the content is different, the new model is loaded and swapped in.
+    """
+
+    def __init__(self, path, loader=load_model, check_interval=MODEL_CHECK_INTERVAL):
+        self.path = path
+        self.loader = loader
+        self.check_interval = check_interval
+        self.model = None
+        self.digest = None
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the current model, loading or reloading it if needed
+        """
+        if self.model is None or time.monotonic() - self._last_check >= self.check_interval:
+            self.refresh()
+        return self.model
+
+    def load(self):
+        """
+        Eagerly load the model, e.g. during the Lambda init phase
+        """
+        return self.get()
+
+    def refresh(self):
+        """
+        Reload the model if the artifact on disk has changed
+        """
+        with self._lock:
+            self._last_check = time.monotonic()
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if self.model is not None and signature == self._signature:
+                return False
+
+            digest = file_digest(self.path)
+            if self.model is not None and digest == self.digest:
+                self._signature = signature
+                return False
+
+            print("Loading model from {} ({})".format(self.path, digest[:12]))
+            with phase("model load" if self.model is None else "model reload"):
+                model = self.loader(self.path)
+            self.model, self.digest, self._signature = model, digest, signature
+            print("model loaded")
+            return True
@@ -0,0 +1,317 @@
+"""
+Helper module for decoding prediction requests and encoding responses
+
+Requests and responses are negotiated with the ``Content-Type`` and
+``Accept`` headers:
+
+* ``application/json`` - ``{"data": [[...]]}`` or ``{"data_b64": ..., "num_features": n}``
+* ``application/x-npy`` - a NumPy ``.npy`` file holding a 2-D float array
+* ``application/x-float32`` - two little-endian uint32 (rows, columns) followed by the float32 values
+* ``application/vnd.apache.arrow.stream`` - Arrow IPC stream, either one
+  fixed-size list column per row or one float column per feature
+
+Binary bodies are decoded as NumPy views over the request buffer where the
+layout allows it, so no intermediate Python objects are created.
+"""
+import base64
+import importlib.util
+import io
+import json
+import os
+import struct
+
+import numpy as np
+
+
+MAX_BATCH_ROWS = int(os.environ.get("MAX_BATCH_ROWS", "10000"))
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", "1024"))
+
+JSON = "application/json"
+NPY = "application/x-npy"
+FLOAT32 = "application/x-float32"
+ARROW = "application/vnd.apache.arrow.stream"
+
+FLOAT32_HEADER = struct.Struct("<II")
+
+
+class PayloadError(ValueError):
+    """
+    Raised when a request body cannot be turned into a feature matrix
+    """
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_header(headers, name, default=""):
+    """
+    Case-insensitive header lookup
+    """
+    name = name.lower()
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+def media_type(header_value):
+    """
+    Strip parameters such as ``charset`` from a media type
+    """
+    return header_value.split(";", 1)[0].strip().lower()
+
+
+def decode_event(event, max_rows=MAX_BATCH_ROWS):
+    """
+    Decode an API Gateway proxy event into a feature matrix and a chunk size
+    """
+    headers = event.get("headers") or {}
+    content_type = media_type(get_header(headers, "Content-Type", JSON)) or JSON
+    body = event.get("body") or ""
+
+    if content_type == JSON:
+        if event.get("isBase64Encoded"):
+            body = base64.b64decode(body)
+        try:
+            body = json.loads(body)
+        except ValueError as e:
+            raise PayloadError("Invalid JSON body: {}".format(e))
+        if not isinstance(body, dict):
+            raise PayloadError("Request body must be a JSON object")
+        return decode_request(body, max_rows), chunk_size_for(body)
+
+    decoder = BINARY_DECODERS.get(content_type)
+    if decoder is None:
+        raise PayloadError("Unsupported Content-Type: {}".format(content_type), status_code=415)
+
+    try:
+        buffer = base64.b64decode(body) if event.get("isBase64Encoded") else body.encode("latin-1")
+    except ValueError as e:
+        # An undecodable text body, or invalid base64
+        raise PayloadError("{} payloads must be base64-encoded: {}".format(content_type, e))
+    data = check_matrix(decoder(buffer), max_rows)
+    return data, chunk_size_for(event.get("queryStringParameters") or {})
+
+
+def decode_request(body, max_rows=MAX_BATCH_ROWS):
+    """
+    Turn a parsed JSON body into a 2-D float32 feature matrix
+
+    The body either carries the rows as a JSON matrix in ``data`` or as a
+    base64 encoded little-endian float32 buffer in ``data_b64`` together with
+    ``num_features``. A single row may be sent as a flat list.
+    """
+    if "data_b64" in body:
+        try:
+            buffer = base64.b64decode(body["data_b64"], validate=True)
+            num_features = int(body["num_features"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise PayloadError("Invalid base64 payload: {}".format(e))
+        if num_features <= 0 or len(buffer) % (4 * num_features):
+            raise PayloadError("Buffer size does not match num_features")
+        data = np.frombuffer(buffer, dtype="<f4").reshape(-1, num_features)
+    elif "data" in body:
+        try:
+            data = np.asarray(body["data"], dtype=np.float32)
+        except (TypeError, ValueError) as e:
+            raise PayloadError("Invalid data matrix: {}".format(e))
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+    else:
+        raise PayloadError("Request body must contain 'data' or 'data_b64'")
+
+    return check_matrix(data, max_rows)
+
+
+def check_matrix(data, max_rows):
+    """
+    Validate the shape of a decoded feature matrix
+    """
+    if data.ndim != 2 or data.size == 0:
+        raise PayloadError("Expected a non-empty 2-D feature matrix")
+    if data.shape[0] > max_rows:
+        raise PayloadError("Batch of {} rows exceeds the limit of {}".format(data.shape[0], max_rows))
+    return data
+
+
+def check_features(data, num_features):
+    """
+    Validate that every row of a feature matrix has the model's number of features
+    """
+    if data.shape[1] != num_features:
+        raise PayloadError("Expected {} features per row, got {}".format(num_features, data.shape[1]))
+    return data
+
+
+def decode_npy(buffer):
+    """
+    Decode a ``.npy`` buffer as a view, without going through ``np.load``
+    """
+    stream = io.BytesIO(buffer)
+    try:
+        version = np.lib.format.read_magic(stream)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+        else:
+            raise ValueError("unsupported npy version {}".format(version))
+    except ValueError as e:
+        raise PayloadError("Invalid npy payload: {}".format(e))
+    if dtype.kind != "f" or len(shape) != 2:
+        raise PayloadError("npy payload must be a 2-D float array")
+
+    count = shape[0] * shape[1]
+    if len(buffer) - stream.tell() != count * dtype.itemsize:
+        raise PayloadError("npy payload is truncated")
+    data = np.frombuffer(buffer, dtype=dtype, count=count, offset=stream.tell())
+    if fortran_order:
+        return data.reshape(shape[::-1]).T
+    return data.reshape(shape)
+
+
+def decode_float32(buffer):
+    """
+    Decode a raw little-endian float32 buffer prefixed with its shape
+    """
+    if len(buffer) < FLOAT32_HEADER.size:
+        raise PayloadError("float32 payload is missing its shape header")
+    rows, columns = FLOAT32_HEADER.unpack_from(buffer)
+    if len(buffer) - FLOAT32_HEADER.size != rows * columns * 4:
+        raise PayloadError("float32 payload size does not match its shape header")
+    return np.frombuffer(buffer, dtype="<f4", offset=FLOAT32_HEADER.size).reshape(rows, columns)
+
+
+def decode_arrow(buffer):
+    """
+    Decode an Arrow IPC stream
+
+    A single fixed-size list column is mapped zero-copy onto a row-major
+    matrix; one numeric column per feature is stacked into a new matrix.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise PayloadError("Arrow payloads are not supported by this deployment", status_code=415)
+
+    try:
+        table = pa.ipc.open_stream(buffer).read_all()
+    except pa.ArrowInvalid as e:
+        raise PayloadError("Invalid Arrow payload: {}".format(e))
+
+    if table.num_columns == 1 and pa.types.is_fixed_size_list(table.column(0).type):
+        column = table.column(0).combine_chunks()
+        if column.null_count:
+            raise PayloadError("Arrow feature column must not contain nulls")
+        return column.flatten().to_numpy(zero_copy_only=False).reshape(-1, column.type.list_size)
+    try:
+        return np.column_stack([column.to_numpy() for column in table.columns]).astype(np.float32, copy=False)
+    except (pa.ArrowInvalid, TypeError, ValueError) as e:
+        raise PayloadError("Arrow columns must be numeric: {}".format(e))
+
+
+BINARY_DECODERS = {
+    NPY: decode_npy,
+    FLOAT32: decode_float32,
+    ARROW: decode_arrow,
+}
+
+
+def chunk_size_for(params, default=BATCH_CHUNK_SIZE):
+    """
+    Return the requested chunk size, falling back to the configured default
+    """
+    try:
+        chunk_size = int(params.get("chunk_size", default))
+    except (TypeError, ValueError):
+        raise PayloadError("chunk_size must be an integer")
+    if chunk_size <= 0:
+        raise PayloadError("chunk_size must be positive")
+    return chunk_size
+
+
+def iter_chunks(data, chunk_size):
+    """
+    Yield fixed-size row blocks of ``data`` as views, without copying
+    """
+    for start in range(0, data.shape[0], chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def negotiate(accept_header):
+    """
+    Pick the response media type from an ``Accept`` header
+    """
+    for candidate in (accept_header or JSON).split(","):
+        candidate = media_type(candidate)
+        if candidate in ("*/*", "application/*", JSON):
+            return JSON
+        if candidate == ARROW and importlib.util.find_spec("pyarrow") is None:
+            continue
+        if candidate in BINARY_ENCODERS:
+            return candidate
+    raise PayloadError("None of the accepted media types are supported", status_code=406)
+
+
+def encode_response(result_chunks, response_type):
+    """
+    Encode result blocks for ``response_type``
+
+    Returns the body and whether it is base64 encoded, as expected by the
+    API Gateway proxy integration.
+    """
+    if response_type == JSON:
+        return encode_result(result_chunks), False
+    chunks = [chunk for chunk in result_chunks if len(chunk)]
+    result = np.concatenate(chunks) if chunks else np.empty((0, 0), dtype=np.float32)
+    body = BINARY_ENCODERS[response_type](result.astype("<f4", copy=False))
+    return base64.b64encode(body).decode("ascii"), True
+
+
+def encode_result(result_chunks):
+    """
+    Encode result blocks as ``{"result": [...]}``, one block at a time
+
+    The output is identical to ``json.dumps({"result": rows})`` but only one
+    block is converted to Python lists at any point.
+    """
+    parts = ['{"result": [']
+    first = True
+    for chunk in result_chunks:
+        if not len(chunk):
+            continue
+        if not first:
+            parts.append(", ")
+        parts.append(json.dumps(chunk.tolist())[1:-1])
+        first = False
+    parts.append("]}")
+    return "".join(parts)
+
+
+def encode_npy(result):
+    output = io.BytesIO()
+    np.save(output, result)
+    return output.getvalue()
+
+
+def encode_float32(result):
+    return FLOAT32_HEADER.pack(*result.shape) + result.tobytes()
+
+
+def encode_arrow(result):
+    import pyarrow as pa
+
+    values = pa.array(result.reshape(-1))
+    table = pa.table({"result": pa.FixedSizeListArray.from_arrays(values, result.shape[1])})
+    output = pa.BufferOutputStream()
+    with pa.ipc.new_stream(output, table.schema) as writer:
+        writer.write_table(table)
+    return output.getvalue().to_pybytes()
+
+
+BINARY_ENCODERS = {
+    NPY: encode_npy,
+    FLOAT32: encode_float32,
+    ARROW: encode_arrow,
+}
@@ -0,0 +1,68 @@
+"""
+Helper module for measuring the cold start of the container
+
+Every phase records its wall time and the process RSS before and after, so
+the first invocation's log shows where the init time and memory go:
+
+    {"cold_start": [{"phase": "import numpy", "seconds": 0.081, "rss_mb": 31.2, "rss_delta_mb": 11.9}, ...]}
+"""
+import importlib
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+
+PHASES = []
+_reported = False
+
+
+def current_rss_mb():
+    """
+    Return the resident set size of the process in MB
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Peak RSS, in KB on Linux, is the closest fallback outside of /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def phase(name):
+    """
+    Record the time and RSS growth of the wrapped block
+    """
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rss_after = current_rss_mb()
+        PHASES.append({
+            "phase": name,
+            "seconds": round(time.perf_counter() - start, 4),
+            "rss_mb": round(rss_after, 1),
+            "rss_delta_mb": round(rss_after - rss_before, 1),
+        })
+
+
+def timed_import(module_name):
+    """
+    Import a module inside a phase named after it
+    """
+    with phase("import " + module_name):
+        return importlib.import_module(module_name)
+
+
+def report_once():
+    """
+    Print the recorded phases, once per container
+    """
+    global _reported
+    if _reported:
+        return
+    _reported = True
+    print(json.dumps({"cold_start": PHASES}))
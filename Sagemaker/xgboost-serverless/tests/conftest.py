@@ -0,0 +1,8 @@
+import os
+import sys
+
+PREDICTOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iris_model_predictor")
+
+# The Lambda modules are copied flat into the container, so import them the same way here
+sys.path.insert(0, PREDICTOR_DIR)
+os.environ.setdefault("MODEL_PATH", os.path.join(PREDICTOR_DIR, "model", "iris_model.json"))
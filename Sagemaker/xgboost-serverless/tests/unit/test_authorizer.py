@@ -0,0 +1,104 @@
+import json
+import time
+
+import pytest
+
+from authorizer import SecretCache, is_authorized
+
+
+class StubSecretsManager:
+    """ Local stand-in for the Secrets Manager client """
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        return {"Name": SecretId, "SecretString": json.dumps(self.secret)}
+
+
+@pytest.fixture()
+def secrets_manager():
+    return StubSecretsManager({"token": "current-key"})
+
+
+@pytest.fixture()
+def cache(secrets_manager):
+    return SecretCache("test-secret", ttl=300, client=secrets_manager)
+
+
+def test_secret_is_loaded_lazily_and_once(secrets_manager, cache):
+    assert secrets_manager.calls == 0
+
+    assert is_authorized({"x-api-key": "current-key"}, cache)
+    assert is_authorized({"x-api-key": "current-key"}, cache)
+    assert secrets_manager.calls == 1
+
+
+@pytest.mark.parametrize("header", ["x-api-key", "X-Api-Key", "X-API-KEY"])
+def test_header_name_is_case_insensitive(cache, header):
+    assert is_authorized({header: "current-key"}, cache)
+
+
+@pytest.mark.parametrize("headers", [{}, None, {"x-api-key": ""}, {"x-api-key": "wrong-key"}, {"x-api-key": None}])
+def test_invalid_keys_are_rejected(cache, headers):
+    assert not is_authorized(headers, cache)
+
+
+def test_all_keys_are_valid_during_rotation(secrets_manager, cache):
+    secrets_manager.secret = {"token": "new-key", "previous_token": "current-key", "tokens": ["partner-key"]}
+    cache.refresh()
+
+    for key in ["new-key", "current-key", "partner-key"]:
+        assert is_authorized({"x-api-key": key}, cache)
+
+
+def test_expired_keys_are_refreshed_in_the_background(secrets_manager, cache):
+    cache.keys()
+    secrets_manager.secret = {"token": "rotated-key"}
+    cache.ttl = 0
+
+    # The stale key is still served while the refresh runs
+    assert is_authorized({"x-api-key": "current-key"}, cache)
+    cache._refresh_thread.join(timeout=5)
+
+    assert is_authorized({"x-api-key": "rotated-key"}, cache)
+    assert not is_authorized({"x-api-key": "current-key"}, cache)
+
+
+def test_failed_refresh_keeps_the_cached_keys(secrets_manager, cache):
+    cache.keys()
+    secrets_manager.get_secret_value = lambda SecretId: (_ for _ in ()).throw(RuntimeError("throttled"))
+    cache.ttl = 0
+
+    cache.keys()
+    cache._refresh_thread.join(timeout=5)
+
+    assert is_authorized({"x-api-key": "current-key"}, cache)
+
+
+def test_failed_refresh_is_retried_with_backoff(secrets_manager, cache):
+    cache.keys()
+    calls = []
+
+    def throttled(SecretId):
+        calls.append(SecretId)
+        raise RuntimeError("throttled")
+
+    secrets_manager.get_secret_value = throttled
+    cache.retry = 60
+    cache._loaded_at = time.monotonic() - cache.ttl
+
+    for _ in range(20):
+        cache.keys()
+        cache._refresh_thread.join(timeout=5)
+
+    # One refresh, then none until the retry delay has passed
+    assert len(calls) == 1
+    cache._retry_at = 0.0
+    cache.keys()
+    cache._refresh_thread.join(timeout=5)
+    assert len(calls) == 2
+    assert cache._failures == 2
+    assert cache._retry_at - time.monotonic() > 60
@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+
+PREDICTOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "iris_model_predictor")
+IMPORT_TIME_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", "0.5"))
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}))
+"""
+
+
+def import_app():
+    """ Import app.py in a fresh interpreter, the way a cold start does """
+    env = dict(os.environ, MODEL_PRELOAD="false")
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], cwd=PREDICTOR_DIR, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_import_time_is_within_budget():
+    # Best of three, so a busy machine does not fail the build
+    seconds = min(import_app()["seconds"] for _ in range(3))
+
+    assert seconds < IMPORT_TIME_BUDGET, "importing app took {:.3f}s, budget is {}s".format(seconds, IMPORT_TIME_BUDGET)
+
+
+def test_heavy_modules_are_imported_lazily():
+    modules = set(import_app()["modules"])
+
+    for module in ["xgboost", "boto3", "pyarrow", "pandas", "sklearn"]:
+        assert module not in modules
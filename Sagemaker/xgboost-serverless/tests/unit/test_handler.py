@@ -2,7 +2,22 @@ import json
 
 import pytest
 
-from hello_world import app
+import app
+import authorizer
+
+API_KEY = "test-key"
+
+
+class StubSecretsManager:
+    """ Local stand-in for the Secrets Manager client """
+
+    def get_secret_value(self, SecretId):
+        return {"SecretString": json.dumps({"token": API_KEY})}
+
+
+@pytest.fixture(autouse=True)
+def stub_secrets(monkeypatch):
+    monkeypatch.setattr(authorizer, "secret_cache", authorizer.SecretCache("test", client=StubSecretsManager()))
 
 
 @pytest.fixture()
@@ -10,7 +25,7 @@ def apigw_event():
     """ Generates API GW Event"""
 
     return {
-        "body": '{ "test": "body"}',
+        "body": json.dumps({"data": [[5.1, 3.5, 1.4, 0.2], [6.7, 3.0, 5.2, 2.3]]}),
         "resource": "/{proxy+}",
         "requestContext": {
             "resourceId": "123456",
@@ -43,7 +58,7 @@ def apigw_event():
             "CloudFront-Is-Mobile-Viewer": "false",
             "X-Forwarded-For": "127.0.0.1, 127.0.0.2",
             "CloudFront-Viewer-Country": "US",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+            "Accept": "application/json",
             "Upgrade-Insecure-Requests": "1",
             "X-Forwarded-Port": "443",
             "Host": "1234567890.execute-api.us-east-1.amazonaws.com",
@@ -54,6 +69,8 @@ def apigw_event():
             "User-Agent": "Custom User Agent String",
             "CloudFront-Forwarded-Proto": "https",
             "Accept-Encoding": "gzip, deflate, sdch",
+            "Content-Type": "application/json",
+            "x-api-key": API_KEY,
         },
         "pathParameters": {"proxy": "/examplepath"},
         "httpMethod": "POST",
@@ -62,12 +79,37 @@ def apigw_event():
     }
 
 
-def test_lambda_handler(apigw_event, mocker):
+def test_lambda_handler(apigw_event):
 
     ret = app.lambda_handler(apigw_event, "")
     data = json.loads(ret["body"])
 
     assert ret["statusCode"] == 200
-    assert "message" in ret["body"]
-    assert data["message"] == "hello world"
-    # assert "location" in data.dict_keys()
+    assert ret["headers"]["Content-Type"] == "application/json"
+    assert data["result"] == [[1.0, 0.0, 0.0], [0.0, 0.0, 1.0]]
+
+
+def test_lambda_handler_rejects_invalid_api_key(apigw_event):
+    apigw_event["headers"]["x-api-key"] = "wrong-key"
+
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 400
+    assert json.loads(ret["body"])["message"] == "Invalid API key"
+
+
+def test_lambda_handler_rejects_invalid_body(apigw_event):
+    apigw_event["body"] = json.dumps({"test": "body"})
+
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 400
+
+
+def test_lambda_handler_rejects_rows_with_the_wrong_number_of_features(apigw_event):
+    apigw_event["body"] = json.dumps({"data": [[5.1, 3.5, 1.4]]})
+
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 400
+    assert json.loads(ret["body"])["message"] == "Expected 4 features per row, got 3"
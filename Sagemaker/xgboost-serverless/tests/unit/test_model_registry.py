@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from model_registry import ModelRegistry
+
+
+@pytest.fixture()
+def artifact(tmp_path):
+    path = tmp_path / "model.txt"
+    path.write_text("v1")
+    return path
+
+
+def test_model_is_loaded_once(artifact):
+    calls = []
+
+    def loader(path):
+        calls.append(path)
+        return open(path).read()
+
+    registry = ModelRegistry(str(artifact), loader=loader, check_interval=0)
+
+    assert registry.get() == "v1"
+    assert registry.get() == "v1"
+    assert len(calls) == 1
+
+
+def test_model_is_swapped_when_artifact_changes(artifact):
+    registry = ModelRegistry(str(artifact), loader=lambda path: open(path).read(), check_interval=0)
+    assert registry.get() == "v1"
+    old_digest = registry.digest
+
+    artifact.write_text("v2 with a different size")
+    stat = os.stat(artifact)
+    os.utime(artifact, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert registry.get() == "v2 with a different size"
+    assert registry.digest != old_digest
+
+
+def test_touched_artifact_with_same_content_is_not_reloaded(artifact):
+    calls = []
+
+    def loader(path):
+        calls.append(path)
+        return open(path).read()
+
+    registry = ModelRegistry(str(artifact), loader=loader, check_interval=0)
+    registry.get()
+
+    stat = os.stat(artifact)
+    os.utime(artifact, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert registry.refresh() is False
+    assert len(calls) == 1
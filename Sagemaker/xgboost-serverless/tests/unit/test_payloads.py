@@ -0,0 +1,134 @@
+import base64
+import io
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from payloads import (
+    ARROW, FLOAT32, JSON, NPY, PayloadError, decode_event, decode_request, encode_response, encode_result,
+    iter_chunks, negotiate,
+)
+
+
+def test_decode_json_matrix():
+    data = decode_request({"data": [[5.1, 3.5, 1.4, 0.2], [6.7, 3.0, 5.2, 2.3]]})
+
+    assert data.shape == (2, 4)
+    assert data.dtype == np.float32
+
+
+def test_decode_single_row():
+    assert decode_request({"data": [5.1, 3.5, 1.4, 0.2]}).shape == (1, 4)
+
+
+def test_decode_base64_buffer():
+    rows = np.arange(12, dtype="<f4").reshape(3, 4)
+    body = {"data_b64": base64.b64encode(rows.tobytes()).decode(), "num_features": 4}
+
+    np.testing.assert_array_equal(decode_request(body), rows)
+
+
+@pytest.mark.parametrize("body", [
+    {},
+    {"data": []},
+    {"data_b64": base64.b64encode(b"\x00" * 6).decode(), "num_features": 4},
+    {"data": [[1.0, 2.0]] * 3},
+])
+def test_decode_rejects_invalid_bodies(body):
+    with pytest.raises(PayloadError):
+        decode_request(body, max_rows=2)
+
+
+def test_encode_result_matches_json_dumps():
+    result = np.round(np.random.default_rng(0).uniform(size=(10, 3)))
+
+    encoded = encode_result(iter_chunks(result, 3))
+
+    assert encoded == json.dumps({"result": result.tolist()})
+
+
+def binary_event(content_type, payload, accept=None):
+    headers = {"content-type": content_type}
+    if accept:
+        headers["Accept"] = accept
+    return {"headers": headers, "body": base64.b64encode(payload).decode(), "isBase64Encoded": True}
+
+
+def test_decode_npy_is_a_view_over_the_body():
+    rows = np.arange(8, dtype=np.float32).reshape(2, 4)
+    output = io.BytesIO()
+    np.save(output, rows)
+
+    data, _ = decode_event(binary_event(NPY, output.getvalue()))
+
+    np.testing.assert_array_equal(data, rows)
+    assert not data.flags.owndata
+
+
+def test_decode_float32_with_shape_header():
+    rows = np.arange(12, dtype="<f4").reshape(3, 4)
+    event = binary_event(FLOAT32, struct.pack("<II", 3, 4) + rows.tobytes())
+    event["queryStringParameters"] = {"chunk_size": "2"}
+
+    data, chunk_size = decode_event(event)
+
+    np.testing.assert_array_equal(data, rows)
+    assert chunk_size == 2
+
+
+def test_decode_arrow_fixed_size_list():
+    pa = pytest.importorskip("pyarrow")
+    rows = np.arange(8, dtype=np.float32).reshape(2, 4)
+    table = pa.table({"features": pa.FixedSizeListArray.from_arrays(pa.array(rows.reshape(-1)), 4)})
+    output = pa.BufferOutputStream()
+    with pa.ipc.new_stream(output, table.schema) as writer:
+        writer.write_table(table)
+
+    data, _ = decode_event(binary_event(ARROW, output.getvalue().to_pybytes()))
+
+    np.testing.assert_array_equal(data, rows)
+
+
+@pytest.mark.parametrize("body, is_base64", [("\u20ac\u20ac", False), ("not base64!", True)])
+def test_binary_body_must_be_base64(body, is_base64):
+    event = {"headers": {"Content-Type": FLOAT32}, "body": body, "isBase64Encoded": is_base64}
+
+    with pytest.raises(PayloadError, match="must be base64-encoded") as error:
+        decode_event(event)
+
+    assert error.value.status_code == 400
+
+
+def test_unsupported_content_type():
+    with pytest.raises(PayloadError) as error:
+        decode_event({"headers": {"Content-Type": "text/csv"}, "body": "1,2,3"})
+
+    assert error.value.status_code == 415
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, JSON),
+    ("*/*", JSON),
+    ("application/x-float32, application/json;q=0.5", FLOAT32),
+])
+def test_negotiate(accept, expected):
+    assert negotiate(accept) == expected
+
+
+def test_negotiate_rejects_unknown_types():
+    with pytest.raises(PayloadError) as error:
+        negotiate("text/html")
+
+    assert error.value.status_code == 406
+
+
+def test_encode_float32_response_round_trips():
+    result = np.eye(3, dtype=np.float32)
+
+    body, is_base64 = encode_response(iter_chunks(result, 2), FLOAT32)
+
+    assert is_base64
+    payload = base64.b64decode(body)
+    np.testing.assert_array_equal(np.frombuffer(payload[8:], dtype="<f4").reshape(3, 3), result)
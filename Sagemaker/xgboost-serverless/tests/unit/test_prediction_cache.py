@@ -0,0 +1,71 @@
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+class CountingModel:
+    """ Scores a row as its sum and remembers which rows it saw """
+
+    def __init__(self):
+        self.scored = []
+
+    def __call__(self, rows):
+        self.scored.append(rows.copy())
+        return rows.sum(axis=1, keepdims=True)
+
+
+def test_partial_hits_only_score_misses_in_original_order():
+    cache, model = PredictionCache(max_size=10, ttl=60), CountingModel()
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    cache.predict(data[[0, 2]], "model-v1", model)
+
+    result = cache.predict(data, "model-v1", model)
+
+    np.testing.assert_array_equal(result, data.sum(axis=1, keepdims=True))
+    np.testing.assert_array_equal(model.scored[-1], data[[1]])
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 3
+
+
+def test_full_hit_does_not_call_the_model():
+    cache, model = PredictionCache(max_size=10, ttl=60), CountingModel()
+    data = np.ones((2, 4), dtype=np.float32)
+    cache.predict(data, "model-v1", model)
+
+    cache.predict(data, "model-v1", model)
+
+    assert len(model.scored) == 1
+
+
+def test_least_recently_used_rows_are_evicted():
+    cache, model = PredictionCache(max_size=2, ttl=60), CountingModel()
+    rows = np.arange(12, dtype=np.float32).reshape(3, 4)
+    cache.predict(rows[[0]], "model-v1", model)
+    cache.predict(rows[[1]], "model-v1", model)
+    cache.predict(rows[[0]], "model-v1", model)
+    cache.predict(rows[[2]], "model-v1", model)
+
+    cache.predict(rows[[0, 1]], "model-v1", model)
+
+    assert len(cache) == 2
+    np.testing.assert_array_equal(model.scored[-1], rows[[1]])
+
+
+def test_expired_entries_are_rescored():
+    cache, model = PredictionCache(max_size=10, ttl=-1), CountingModel()
+    data = np.ones((1, 4), dtype=np.float32)
+    cache.predict(data, "model-v1", model)
+
+    cache.predict(data, "model-v1", model)
+
+    assert len(model.scored) == 2
+
+
+def test_new_model_invalidates_the_cache():
+    cache, model = PredictionCache(max_size=10, ttl=60), CountingModel()
+    data = np.ones((1, 4), dtype=np.float32)
+    cache.predict(data, "model-v1", model)
+
+    cache.predict(data, "model-v2", model)
+
+    assert len(model.scored) == 2
@@ -20,12 +20,25 @@ resource "aws_glue_job" "csv_to_parquet" {
 
   default_arguments = {
     "--job-language"                     = "python"
-    "--job-bookmark-option"              = "job-bookmark-enable"
+    # The job reads with Spark DataFrames, which bookmarks do not track; see --manifest_path
+    "--job-bookmark-option"              = "job-bookmark-disable"
     "--enable-metrics"                   = "true"
     "--enable-continuous-cloudwatch-log" = "true"
     "--TempDir"                          = "s3://${module.parquet_bucket.s3_bucket_id}/temp/"
     "--input_path"  = "s3://${module.raw_bucket.s3_bucket_id}/input/"
     "--output_path" = "s3://${module.parquet_bucket.s3_bucket_id}/data/"
+    # Schemas inferred from the first lines of the CSV input, reused for inputs with the same header
+    "--schema_sample_rows"   = "10000"
+    "--schema_registry_path" = "s3://${module.artifacts_bucket.s3_bucket_id}/schemas/"
+    # Output layout: Hive-style partitions (e.g. a date column), file size and compression codec
+    "--partition_keys"      = ""
+    "--target_file_size_mb" = "128"
+    "--compression"         = "snappy"
+    # Input files converted so far, so every run converts only the new or changed ones
+    "--manifest_path" = "s3://${module.artifacts_bucket.s3_bucket_id}/manifests/csv_to_parquet.json"
+    # Table the crawler creates for the data/ folder; the job adds new partitions to it while its schema matches
+    "--catalog_database" = aws_glue_catalog_database.parquet_db.name
+    "--catalog_table"    = "data"
   }
 
   execution_property {
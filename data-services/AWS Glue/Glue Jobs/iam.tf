@@ -98,7 +98,7 @@ resource "aws_iam_policy" "lambda_step_functions_policy" {
   })
 }
 
-# Data policy document for Step Functions to invoke Glue jobs and crawlers
+# Data policy document for Step Functions to invoke Glue jobs and crawlers, and read the job results
 data "aws_iam_policy_document" "step_functions_glue_policy" {
   statement {
     effect = "Allow"
@@ -115,4 +115,11 @@ data "aws_iam_policy_document" "step_functions_glue_policy" {
       "arn:aws:glue:${local.region}:*:crawler/${aws_glue_crawler.parquet_crawler.name}"
     ]
   }
+
+  # Result of the Glue job, telling whether the crawler must run
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:GetObject"]
+    resources = ["arn:aws:s3:::${module.artifacts_bucket.s3_bucket_id}/job-results/*"]
+  }
 }
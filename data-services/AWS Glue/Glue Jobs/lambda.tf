@@ -45,6 +45,8 @@ module "trigger_step_function" {
     GLUE_JOB_NAME     = aws_glue_job.csv_to_parquet.name
     OUTPUT_BUCKET     = module.parquet_bucket.s3_bucket_id
     STATE_MACHINE_ARN = module.etl_state_machine.state_machine_arn
+    # Files per execution, within the 256 KB Step Functions input limit
+    MAX_FILES_PER_EXECUTION = "500"
   }
 
   image_config_command = ["trigger_step_function.handler"]
@@ -54,25 +56,39 @@ module "trigger_step_function" {
   policies = [
     "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
     aws_iam_policy.lambda_glue_access.arn,
-    aws_iam_policy.lambda_step_functions_policy.arn
+    aws_iam_policy.lambda_step_functions_policy.arn,
+    "arn:aws:iam::aws:policy/service-role/AWSLambdaSQSQueueExecutionRole"
   ]
-  number_of_policies = 3
+  number_of_policies = 4
 
   tags = local.tags
 }
 
-# S3 event notification to trigger Lambda
+# S3 event notification to trigger Lambda, directly or through the upload queue
 resource "aws_s3_bucket_notification" "bucket_notification" {
   bucket = module.raw_bucket.s3_bucket_id
 
-  lambda_function {
-    lambda_function_arn = module.trigger_step_function.lambda_function_arn
-    events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = "input/"
-    filter_suffix       = ".csv"
+  dynamic "lambda_function" {
+    for_each = local.buffer_uploads ? [] : [1]
+    content {
+      lambda_function_arn = module.trigger_step_function.lambda_function_arn
+      events              = ["s3:ObjectCreated:*"]
+      filter_prefix       = "input/"
+      filter_suffix       = ".csv"
+    }
   }
 
-  depends_on = [aws_lambda_permission.allow_bucket]
+  dynamic "queue" {
+    for_each = local.buffer_uploads ? [1] : []
+    content {
+      queue_arn     = aws_sqs_queue.uploads[0].arn
+      events        = ["s3:ObjectCreated:*"]
+      filter_prefix = "input/"
+      filter_suffix = ".csv"
+    }
+  }
+
+  depends_on = [aws_lambda_permission.allow_bucket, aws_sqs_queue_policy.uploads]
 }
 
 # Permission for S3 to invoke Lambda
@@ -83,3 +99,45 @@ resource "aws_lambda_permission" "allow_bucket" {
   principal     = "s3.amazonaws.com"
   source_arn    = "arn:aws:s3:::${module.raw_bucket.s3_bucket_id}"
 }
+
+# Queue buffering the upload notifications
+resource "aws_sqs_queue" "uploads" {
+  count = local.buffer_uploads ? 1 : 0
+
+  name = "${local.project_name}-uploads"
+  # At least 6 times the Lambda timeout, as recommended for SQS event sources
+  visibility_timeout_seconds = 1800
+  message_retention_seconds  = 345600
+
+  tags = local.tags
+}
+
+resource "aws_sqs_queue_policy" "uploads" {
+  count = local.buffer_uploads ? 1 : 0
+
+  queue_url = aws_sqs_queue.uploads[0].id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "s3.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.uploads[0].arn
+        Condition = {
+          ArnEquals = { "aws:SourceArn" = "arn:aws:s3:::${module.raw_bucket.s3_bucket_id}" }
+        }
+      }
+    ]
+  })
+}
+
+# Invoke the Lambda with up to upload_batch_size notifications at once
+resource "aws_lambda_event_source_mapping" "uploads" {
+  count = local.buffer_uploads ? 1 : 0
+
+  event_source_arn                   = aws_sqs_queue.uploads[0].arn
+  function_name                      = module.trigger_step_function.lambda_function_arn
+  batch_size                         = local.upload_batch_size
+  maximum_batching_window_in_seconds = local.upload_batch_window_seconds
+}
@@ -1,58 +1,97 @@
 import json
 import boto3
 import os
+import posixpath
+import re
 import urllib.parse
 from datetime import datetime
 
 # Initialize AWS clients
 step_functions = boto3.client('stepfunctions')
 
+# Most input files converted by one execution, to stay within the Step Functions input size
+MAX_FILES_PER_EXECUTION = int(os.environ.get('MAX_FILES_PER_EXECUTION', '500'))
+
 def handler(event, context):
-    
+    """
+    Start one ETL execution for all the files uploaded in the event
+
+    The event is either an S3 notification, or a batch of SQS messages that
+    each carry one, when the uploads are buffered in a queue.
+    """
     # Get the Step Functions state machine ARN from environment variable
     state_machine_arn = os.environ.get('STATE_MACHINE_ARN')
     output_bucket = os.environ.get('OUTPUT_BUCKET')
-    
+
     if not state_machine_arn:
         raise Exception("STATE_MACHINE_ARN environment variable is not set")
-    
-
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'])  
-    print(f"File uploaded: s3://{bucket}/{key}")
-        
-    # Prepare input and output paths for the state machine
-    input_path = f"s3://{bucket}/{key}"
-        
-    # Create an output path with a timestamp to avoid overwriting
+
+    uploads = uploaded_objects(event)
+    print(f"{len(uploads)} files uploaded")
+
+    execution_arns = []
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    file_name = key.split('/')[-1].split('.')[0]
-    output_path = f"s3://{output_bucket}/data/{file_name}_{timestamp}"
-        
-    print(f"Starting Step Functions state machine: {state_machine_arn}")
-    print(f"Input path: {input_path}")
-    print(f"Output path: {output_path}")
-        
-    # Prepare input for the state machine
-    state_machine_input = {
-        "input_path": input_path,
-        "output_path": output_path
-    }
-        
-    # Start the state machine execution
-    response = step_functions.start_execution(
-        stateMachineArn=state_machine_arn,
-        name=f"ETL-{file_name}-{timestamp}",
-        input=json.dumps(state_machine_input)
-    )
-        
-    execution_arn = response['executionArn']
-    print(f"Step Functions state machine started successfully. Execution ARN: {execution_arn}")
-        
+    request_id = context.aws_request_id[:8] if context else '0'
+    for bucket, keys in group_by_bucket(uploads).items():
+        for start in range(0, len(keys), MAX_FILES_PER_EXECUTION):
+            batch = keys[start:start + MAX_FILES_PER_EXECUTION]
+
+            # Prepare input and output paths for the state machine
+            input_paths = [f"s3://{bucket}/{key}" for key in batch]
+            input_prefix = posixpath.commonpath([posixpath.dirname(key) for key in batch])
+
+            # Create an output path with a timestamp to avoid overwriting
+            if len(batch) == 1:
+                batch_name = batch[0].split('/')[-1].split('.')[0]
+            else:
+                batch_name = f"{len(batch)}-files"
+            output_path = f"s3://{output_bucket}/data/{batch_name}_{timestamp}"
+
+            print(f"Starting Step Functions state machine: {state_machine_arn}")
+            print(f"Input paths: {input_paths}")
+            print(f"Output path: {output_path}")
+
+            # Prepare input for the state machine
+            state_machine_input = {
+                "input_path": f"s3://{bucket}/{input_prefix}/" if input_prefix else f"s3://{bucket}/",
+                "input_paths": input_paths,
+                "output_path": output_path
+            }
+
+            # Start the state machine execution
+            response = step_functions.start_execution(
+                stateMachineArn=state_machine_arn,
+                name=f"ETL-{re.sub(r'[^A-Za-z0-9_-]', '-', batch_name[:40])}-{timestamp}-{request_id}-{start // MAX_FILES_PER_EXECUTION}",
+                input=json.dumps(state_machine_input)
+            )
+
+            execution_arns.append(response['executionArn'])
+            print(f"Step Functions state machine started successfully. Execution ARN: {response['executionArn']}")
+
     return {
         'statusCode': 200,
         'body': json.dumps({
             'message': 'Step Functions state machine triggered successfully',
-            'executionArn': execution_arn
+            'executionArns': execution_arns
         })
     }
+
+def uploaded_objects(event):
+    """
+    Return the (bucket, key) of every object in an S3 event, or in the S3 events of an SQS batch
+    """
+    uploads = []
+    for record in event.get('Records', []):
+        if 'body' in record:
+            # SQS message wrapping an S3 notification; the s3:TestEvent sent on setup has no records
+            uploads.extend(uploaded_objects(json.loads(record['body'])))
+        elif 's3' in record:
+            uploads.append((record['s3']['bucket']['name'], urllib.parse.unquote_plus(record['s3']['object']['key'])))
+    # S3 notifications are delivered at least once
+    return list(dict.fromkeys(uploads))
+
+def group_by_bucket(uploads):
+    keys_by_bucket = {}
+    for bucket, key in uploads:
+        keys_by_bucket.setdefault(bucket, []).append(key)
+    return keys_by_bucket
@@ -3,6 +3,12 @@ locals {
   environment  = "<environment>"
   region       = "<region>"
 
+  # Buffer the uploads in an SQS queue and start one ETL execution per batch of files,
+  # instead of one per file. A batch is sent when it is full or its window has passed.
+  buffer_uploads              = true
+  upload_batch_size           = 100
+  upload_batch_window_seconds = 60
+
   # Common tags
   tags = {
     Project     = local.project_name
@@ -1,13 +1,9 @@
+import hashlib
+import json
 import logging
+import math
 import sys
-from urllib.parse import urlparse
-
-import boto3
-from awsglue.context import GlueContext
-from awsglue.job import Job
-from awsglue.transforms import ApplyMapping
-from awsglue.utils import getResolvedOptions
-from pyspark.context import SparkContext
+from urllib.parse import unquote, urlparse
 
 # Configure logging to suppress INFO logs
 logging.getLogger("py4j").setLevel(logging.ERROR)
@@ -15,146 +11,443 @@ logging.getLogger("org.apache.spark").setLevel(logging.ERROR)
 logging.getLogger("org.spark_project").setLevel(logging.ERROR)
 logging.getLogger("org.apache.hadoop").setLevel(logging.ERROR)
 
-sc = SparkContext()
-sc.setLogLevel("ERROR")
-glueContext = GlueContext(sc)
-spark = glueContext.spark_session
-job = Job(glueContext)
-
-# Get job parameters
-args = getResolvedOptions(sys.argv, ["JOB_NAME", "input_path", "output_path"])
-
-job.init(args["JOB_NAME"], args)
-
-# Log job parameters
-input_path = args["input_path"]
-output_path = args["output_path"]
-
-print(f"Input path: {input_path}")
-print(f"Output path: {output_path}")
-
-
-def get_glue_type_name(spark_type):
-    type_mapping = {
-        "StringType": "string",
-        "IntegerType": "int",
-        "LongType": "long",
-        "DoubleType": "double",
-        "FloatType": "float",
-        "DecimalType": "decimal",
-        "BooleanType": "boolean",
-        "TimestampType": "timestamp",
-        "DateType": "date",
-        "ArrayType": "array",
-        "MapType": "map",
-        "StructType": "struct",
-        "BinaryType": "binary",
-        "ShortType": "short",
-        "ByteType": "byte",
-    }
+# Optional job parameters and their defaults
+OPTIONAL_ARGS = {
+    # Number of CSV lines the schema is inferred from
+    "schema_sample_rows": "10000",
+    # s3:// prefix of the inferred schemas, keyed on a hash of the CSV header; empty disables it
+    "schema_registry_path": "",
+    # Comma-separated columns to partition the output by, in Hive-style column=value folders
+    "partition_keys": "",
+    # Size of the Parquet files to write
+    "target_file_size_mb": "128",
+    # Estimated size of the Parquet output relative to the CSV input, to size the files
+    "parquet_size_ratio": "0.25",
+    # Parquet compression codec: snappy, zstd, gzip, lz4 or none
+    "compression": "snappy",
+    # JSON list of the s3:// URIs of the files to convert, instead of everything under input_path
+    "input_paths": "",
+    # s3:// URI of the manifest of the converted input files and their ETags; empty converts all the input
+    "manifest_path": "",
+    # Catalog table of the output, where the job registers the new partitions while the schema matches;
+    # empty leaves the catalog to the crawler
+    "catalog_database": "",
+    "catalog_table": "",
+    # s3:// URI where the job writes its result, e.g. whether the crawler must run
+    "result_path": "",
+}
 
-    type_name = spark_type.__class__.__name__
-    return type_mapping.get(type_name, "string")
 
+def get_optional_args(argv, defaults):
+    """
+    Resolve the optional job parameters that were passed, and default the others
+    """
+    from awsglue.utils import getResolvedOptions
 
-def process_csv_to_parquet():
+    names = [name for name in defaults if f"--{name}" in argv]
+    resolved = getResolvedOptions(argv, names) if names else {}
+    return {name: resolved.get(name, default) for name, default in defaults.items()}
+
+
+def csv_reader(spark):
     """
-    Read CSV data from S3, transform it, and write as Parquet with optional partitioning
+    Return a DataFrame reader with the CSV options of the input files
     """
-    print(f"Reading CSV data from {input_path}")
-    spark_df = spark.read.option("header", "true").option("inferSchema", "true").csv(
-        input_path
-    )
-    column_names = spark_df.columns
-
-    # Get data types from Spark DataFrame
-    spark_schema = spark_df.schema
-    column_types = {field.name: field.dataType for field in spark_schema}
-
-    print("Inferred data types:")
-    for col, dtype in column_types.items():
-        print(f"  {col}: {dtype}")
-
-    # Use GlueContext to read the data
-    dynamic_frame = glueContext.create_dynamic_frame.from_options(
-        connection_type="s3",
-        connection_options={
-            "paths": [input_path],
-            "recurse": True,
-        },
-        format="csv",
-        format_options={
-            "withHeader": True,
-            "separator": ",",
-            "optimizePerformance": True,
-            "quoteChar": '"',
-            "escapeChar": "\\",
-            "columnNameOfCorruptRecord": "_corrupt_record",
-        },
+    return (
+        spark.read.option("header", "true")
+        .option("sep", ",")
+        .option("quote", '"')
+        .option("escape", "\\")
+        .option("recursiveFileLookup", "true")
     )
 
-    if dynamic_frame.count() == 0:
-        raise Exception("Dynamic frame is empty. Please check the input file.")
-
-    # Show sample records
-    print("Sample records:")
-    dynamic_frame.show(5)
-
-    # Get the schema from the dynamic frame
-    schema = dynamic_frame.schema()
-    field_names = [field.name for field in schema.fields]
-
-    # Create mapping to ensure column names and types are preserved
-    if len(field_names) == len(column_names):
-        # Create a mapping for ApplyMapping transform
-        mapping = []
-        for field_name, desired_name in zip(field_names, column_names):
-            # Get the correct data type from Spark DataFrame if available
-            if desired_name in column_types:
-                spark_type = column_types[desired_name]
-                glue_type = get_glue_type_name(spark_type)
-                mapping.append((field_name, glue_type, desired_name, glue_type))
-                print(
-                    f"Mapping {field_name} ({glue_type}) -> {desired_name} ({glue_type})"
-                )
-            else:
-                # Fallback to string if type cannot be determined
-                mapping.append((field_name, "string", desired_name, "string"))
-                print(f"Mapping {field_name} (string) -> {desired_name} (string)")
-
-        print(f"Applying mapping: {mapping}")
-        mapped_dyf = ApplyMapping.apply(frame=dynamic_frame, mappings=mapping)
-
-        # Verify the mapping worked
-        print("Schema after mapping:")
-        mapped_dyf.printSchema()
+
+def read_sample(spark, paths, sample_rows):
+    """
+    Return the header and up to ``sample_rows`` data lines of the CSV input
+
+    Spark stops reading once it has enough lines, so this is cheap however
+    large the input is. The headers of the other files are dropped.
+    """
+    lines = [row.value for row in spark.read.option("recursiveFileLookup", "true").text(paths).limit(sample_rows + 1).collect()]
+    if not lines:
+        return None, []
+    header = lines[0]
+    return header, [line for line in lines[1:] if line != header]
+
+
+def split_s3_uri(uri):
+    parsed = urlparse(uri)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def schema_registry_location(registry_path, header):
+    digest = hashlib.sha256(header.encode("utf-8")).hexdigest()
+    return split_s3_uri(f"{registry_path.rstrip('/')}/{digest}.json")
+
+
+def load_registered_schema(s3, registry_path, header):
+    from pyspark.sql.types import StructType
+
+    bucket, key = schema_registry_location(registry_path, header)
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    print(f"Using the schema registered at s3://{bucket}/{key}")
+    return StructType.fromJson(json.loads(body))
+
+
+def register_schema(s3, registry_path, header, schema):
+    bucket, key = schema_registry_location(registry_path, header)
+    s3.put_object(Bucket=bucket, Key=key, Body=schema.json().encode("utf-8"))
+    print(f"Registered the schema at s3://{bucket}/{key}")
+
+
+def get_schema(spark, s3, header, lines, registry_path=""):
+    """
+    Return the schema of the CSV input, inferred from a sample of its first lines
+
+    With a schema registry, the schema inferred for a header is reused by
+    every later input with the same header, so the column types of the
+    Parquet output stay the same from one drop to the next.
+    """
+    schema = load_registered_schema(s3, registry_path, header) if registry_path else None
+    if schema is None:
+        sample = spark.sparkContext.parallelize([header] + lines, 1)
+        schema = csv_reader(spark).option("inferSchema", "true").csv(sample).schema
+        if registry_path:
+            register_schema(s3, registry_path, header, schema)
+    return schema
+
+
+def input_size(spark, path):
+    """
+    Return the total size in bytes of the files under ``path``
+    """
+    hadoop_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    file_system = hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return file_system.getContentSummary(hadoop_path).getLength()
+
+
+def describe_input_files(s3, uris):
+    """
+    Return {s3 URI: (ETag, size)} of the given objects, skipping the deleted ones
+    """
+    files = {}
+    for uri in uris:
+        bucket, key = split_s3_uri(uri)
+        try:
+            response = s3.head_object(Bucket=bucket, Key=key)
+        except s3.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            print(f"Skipping {uri}, which no longer exists")
+            continue
+        files[uri] = (response["ETag"].strip('"'), response["ContentLength"])
+    return files
+
+
+def list_input_files(s3, input_path):
+    """
+    Return {s3 URI: (ETag, size)} of the objects under ``input_path``
+    """
+    bucket, prefix = split_s3_uri(input_path)
+    files = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            if not item["Key"].endswith("/"):
+                files[f"s3://{bucket}/{item['Key']}"] = (item["ETag"].strip('"'), item["Size"])
+    return files
+
+
+def load_manifest(s3, manifest_path):
+    """
+    Return {s3 URI: ETag} of the input files converted by the previous runs
+    """
+    bucket, key = split_s3_uri(manifest_path)
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except s3.exceptions.NoSuchKey:
+        return {}
+    return json.loads(body)["files"]
+
+
+def save_manifest(s3, manifest_path, files):
+    bucket, key = split_s3_uri(manifest_path)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps({"files": files}, sort_keys=True).encode("utf-8"))
+
+
+def select_new_files(input_files, manifest):
+    """
+    Return the input files that are not in the manifest, or whose ETag changed since
+    """
+    return {uri: (etag, size) for uri, (etag, size) in input_files.items() if manifest.get(uri) != etag}
+
+
+def plan_output_files(input_bytes, sample_lines, target_file_bytes, size_ratio):
+    """
+    Return the number of Parquet files to write, and the most records in one file
+
+    Both are estimated from the CSV size and the average length of the
+    sampled lines, scaled by the Parquet to CSV size ratio.
+    """
+    file_count = max(1, math.ceil(input_bytes * size_ratio / target_file_bytes))
+    sample_bytes = sum(len(line.encode("utf-8")) + 1 for line in sample_lines)
+    record_bytes = max(1.0, sample_bytes / max(1, len(sample_lines)) * size_ratio)
+    return file_count, max(1, int(target_file_bytes / record_bytes))
+
+
+def write_parquet(df, output_path, partition_keys, file_count, records_per_file, compression):
+    """
+    Write ``df`` as Parquet files of about ``records_per_file`` records each
+    """
+    if partition_keys:
+        # The records of one partition value go to the same task, which
+        # splits them in files of records_per_file instead of every task
+        # writing a small file in every partition
+        df = df.repartition(file_count, *partition_keys)
     else:
-        raise Exception(
-            "Column names do not match between Spark DataFrame and dynamic frame."
+        # Merges input splits without a shuffle
+        df = df.coalesce(file_count)
+    writer = (
+        df.write.mode("append")
+        .option("compression", compression)
+        .option("maxRecordsPerFile", records_per_file)
+    )
+    if partition_keys:
+        writer = writer.partitionBy(*partition_keys)
+    writer.parquet(output_path)
+
+
+def compare_schema(table, schema, partition_keys):
+    """
+    Return how the columns of the output differ from the catalog table, or None when they match
+    """
+    # The crawler lower-cases the column names
+    table_columns = {column["Name"].lower(): column["Type"].lower() for column in table["StorageDescriptor"]["Columns"]}
+    output_columns = {
+        field.name.lower(): field.dataType.simpleString().lower() for field in schema.fields if field.name not in partition_keys
+    }
+    if table_columns == output_columns:
+        return None
+    differences = [
+        f"{name} {table_columns.get(name, '(none)')} -> {output_columns.get(name, '(none)')}"
+        for name in sorted(set(table_columns) | set(output_columns))
+        if table_columns.get(name) != output_columns.get(name)
+    ]
+    return "Columns changed: " + ", ".join(differences)
+
+
+def list_output_directories(s3, output_path):
+    """
+    Return the s3:// URIs of the directories under ``output_path`` that hold Parquet files
+    """
+    bucket, prefix = split_s3_uri(output_path)
+    directories = set()
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            directory, _, name = item["Key"].rpartition("/")
+            if name.endswith(".parquet") and "/_temporary" not in f"/{directory}":
+                directories.add(f"s3://{bucket}/{directory}/")
+    return sorted(directories)
+
+
+def partition_values(table_location, directory, key_names):
+    """
+    Return the partition values of ``directory``, from its path under the table location
+
+    Hive-style ``key=value`` folders must be named after the partition key;
+    other folders are values of the crawler's ``partition_N`` keys. Returns
+    None when the directory does not fit the partition keys of the table.
+    """
+    location = table_location.rstrip("/") + "/"
+    if not directory.startswith(location):
+        return None
+    segments = directory[len(location):].strip("/").split("/")
+    if len(segments) != len(key_names):
+        return None
+    values = []
+    for segment, key_name in zip(segments, key_names):
+        name, separator, value = segment.partition("=")
+        if separator and name.lower() != key_name:
+            return None
+        # Spark escapes special characters in partition values
+        values.append(unquote(value) if separator else segment)
+    return values
+
+
+def register_partitions(glue, table, partitions):
+    """
+    Add {directory: values} partitions to the catalog table, and return the number of new ones
+    """
+    storage = table["StorageDescriptor"]
+    partition_inputs = [
+        {"Values": values, "StorageDescriptor": dict(storage, Location=directory)} for directory, values in partitions.items()
+    ]
+    added = 0
+    # The BatchCreatePartition limit
+    for start in range(0, len(partition_inputs), 100):
+        batch = partition_inputs[start:start + 100]
+        response = glue.batch_create_partition(
+            DatabaseName=table["DatabaseName"], TableName=table["Name"], PartitionInputList=batch
         )
+        errors = [error for error in response.get("Errors", []) if error["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException"]
+        if errors:
+            raise Exception(f"Could not create partitions: {errors}")
+        added += len(batch) - len(response.get("Errors", []))
+    return added
 
-    # Show sample records
-    print("Sample records:")
-    mapped_dyf.show(5)
 
-    # Write the data in Parquet format
-    glueContext.write_dynamic_frame.from_options(
-        frame=mapped_dyf,
-        connection_type="s3",
-        connection_options={"path": output_path},
-        format="parquet",
-        transformation_ctx="write_parquet",
+def update_catalog(glue, s3, database, table_name, output_path, schema, partition_keys):
+    """
+    Register the partitions written to ``output_path`` in the catalog table, if the output still matches it
+
+    Returns whether the crawler must run instead, because the table is
+    missing or its columns or partition keys differ from the output.
+    """
+    try:
+        table = glue.get_table(DatabaseName=database, Name=table_name)["Table"]
+    except glue.exceptions.EntityNotFoundException:
+        return {"schema_changed": True, "reason": f"Table {database}.{table_name} does not exist", "partitions_added": 0}
+
+    reason = compare_schema(table, schema, partition_keys)
+    if reason:
+        return {"schema_changed": True, "reason": reason, "partitions_added": 0}
+
+    key_names = [key["Name"].lower() for key in table.get("PartitionKeys", [])]
+    partitions = {}
+    if key_names:
+        for directory in list_output_directories(s3, output_path):
+            values = partition_values(table["StorageDescriptor"]["Location"], directory, key_names)
+            if values is None:
+                reason = f"{directory} does not fit the partition keys {key_names} of {database}.{table_name}"
+                return {"schema_changed": True, "reason": reason, "partitions_added": 0}
+            partitions[directory] = values
+    return {"schema_changed": False, "reason": None, "partitions_added": register_partitions(glue, table, partitions)}
+
+
+def process_csv_to_parquet(spark, s3, args, glue=None):
+    """
+    Read CSV data from S3 and write it as Parquet, in a single pass over the data
+
+    Returns the number of converted records, and whether the output schema
+    changed, in which case the crawler must update the catalog.
+    """
+    input_path = args["input_path"]
+    output_path = args["output_path"]
+    manifest_path = args["manifest_path"]
+    partition_keys = [key.strip() for key in args["partition_keys"].split(",") if key.strip()]
+    # The files uploaded since the previous execution, batched by the trigger Lambda
+    requested_paths = json.loads(args["input_paths"]) if args["input_paths"] else []
+
+    if manifest_path:
+        # Only the files added or overwritten since the last run are converted
+        if requested_paths:
+            input_files = describe_input_files(s3, requested_paths)
+        else:
+            input_files = list_input_files(s3, input_path)
+        manifest = load_manifest(s3, manifest_path)
+        new_files = select_new_files(input_files, manifest)
+        print(f"{len(new_files)} of {len(input_files)} input files are new or changed")
+        if not new_files:
+            print("Nothing to convert")
+            return {"records": 0, "schema_changed": False, "reason": None, "partitions_added": 0}
+        input_paths = sorted(new_files)
+        input_bytes = sum(size for _, size in new_files.values())
+    else:
+        input_paths = requested_paths or [input_path]
+        input_bytes = sum(input_size(spark, path) for path in input_paths)
+
+    print(f"Reading CSV data from {len(input_paths)} paths under {input_path}")
+    header, lines = read_sample(spark, input_paths, int(args["schema_sample_rows"]))
+    if not lines:
+        raise Exception("The input has no records. Please check the input file.")
+    schema = get_schema(spark, s3, header, lines, args["schema_registry_path"])
+    print("Schema:")
+    for field in schema.fields:
+        print(f"  {field.name}: {field.dataType.simpleString()}")
+    missing_keys = [key for key in partition_keys if key not in schema.fieldNames()]
+    if missing_keys:
+        raise Exception(f"Partition keys {missing_keys} are not columns of the input.")
+
+    file_count, records_per_file = plan_output_files(
+        input_bytes,
+        lines,
+        float(args["target_file_size_mb"]) * 1024 * 1024,
+        float(args["parquet_size_ratio"]),
     )
+    print(f"Writing {file_count} files of at most {records_per_file} records, partitioned by {partition_keys}")
+
+    # Spark is only needed once there is something to convert, the manifest and catalog steps run without it
+    from pyspark.sql import Observation
+    from pyspark.sql import functions as F
+
+    # The records are counted while they are written, not by another scan
+    observation = Observation("csv_to_parquet")
+    df = csv_reader(spark).schema(schema).csv(input_paths).observe(observation, F.count(F.lit(1)).alias("records"))
+
+    # Write the data in Parquet format
+    write_parquet(df, output_path, partition_keys, file_count, records_per_file, args["compression"])
 
-    # Get record count
-    record_count = mapped_dyf.count()
+    record_count = observation.get["records"]
     print(
         f"Successfully converted {record_count} records from CSV to Parquet at {output_path}"
     )
 
+    if manifest_path:
+        # Saved once the output is written: a failed run converts the same files again
+        save_manifest(s3, manifest_path, dict(manifest, **{uri: etag for uri, (etag, _) in new_files.items()}))
+
+    result = {"records": record_count}
+    if args["catalog_table"]:
+        result.update(update_catalog(
+            glue, s3, args["catalog_database"], args["catalog_table"], output_path, schema, partition_keys
+        ))
+    else:
+        result.update(schema_changed=True, reason="No catalog table to compare with", partitions_added=0)
+    if result["schema_changed"]:
+        print(f"The crawler must update the catalog: {result['reason']}")
+    else:
+        print(f"Added {result['partitions_added']} partitions to {args['catalog_database']}.{args['catalog_table']}")
+    return result
+
+
+def main():
+    import boto3
+    from awsglue.context import GlueContext
+    from awsglue.job import Job
+    from awsglue.utils import getResolvedOptions
+    from pyspark.context import SparkContext
+
+    sc = SparkContext()
+    sc.setLogLevel("ERROR")
+    glueContext = GlueContext(sc)
+    spark = glueContext.spark_session
+    job = Job(glueContext)
+
+    # Get job parameters
+    args = getResolvedOptions(sys.argv, ["JOB_NAME", "input_path", "output_path"])
+    args.update(get_optional_args(sys.argv, OPTIONAL_ARGS))
+
+    job.init(args["JOB_NAME"], args)
+
+    # Log job parameters
+    print(f"Input path: {args['input_path']}")
+    print(f"Output path: {args['output_path']}")
+
+    # Execute the job
+    s3 = boto3.client("s3")
+    result = process_csv_to_parquet(spark, s3, args, boto3.client("glue"))
+
+    # Read by the state machine, to run the crawler only when the schema changed
+    if args["result_path"]:
+        bucket, key = split_s3_uri(args["result_path"])
+        s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(result).encode("utf-8"))
+
+    # Commit the job
+    job.commit()
 
-# Execute the job
-process_csv_to_parquet()
 
-# Commit the job
-job.commit() 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
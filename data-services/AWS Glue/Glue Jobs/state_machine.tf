@@ -9,9 +9,27 @@ module "etl_state_machine" {
   policy_json        = data.aws_iam_policy_document.step_functions_glue_policy.json
 
   definition = jsonencode({
-    Comment = "ETL workflow to process CSV to Parquet and crawl the data",
-    StartAt = "StartGlueJob",
+    Comment = "ETL workflow to process CSV to Parquet, and crawl the data when its schema changed",
+    StartAt = "HasInputPaths",
     States = {
+      # Executions started by hand may only name the input_path, the job then converts everything under it
+      "HasInputPaths" = {
+        Type = "Choice",
+        Choices = [
+          {
+            Variable  = "$.input_paths",
+            IsPresent = true,
+            Next      = "StartGlueJob"
+          }
+        ],
+        Default = "DefaultInputPaths"
+      },
+      "DefaultInputPaths" = {
+        Type       = "Pass",
+        Result     = [],
+        ResultPath = "$.input_paths",
+        Next       = "StartGlueJob"
+      },
       "StartGlueJob" = {
         Type     = "Task",
         Resource = "arn:aws:states:::glue:startJobRun.sync",
@@ -19,11 +37,49 @@ module "etl_state_machine" {
           JobName = aws_glue_job.csv_to_parquet.name,
           Arguments = {
             "--input_path.$"  = "$.input_path",
-            "--output_path.$" = "$.output_path"
+            "--input_paths.$" = "States.JsonToString($.input_paths)",
+            "--output_path.$" = "$.output_path",
+            "--result_path.$" = "States.Format('s3://${module.artifacts_bucket.s3_bucket_id}/job-results/{}.json', $$.Execution.Name)"
           }
         },
+        # The job runs one at a time, executions started together wait for the running one to finish
+        Retry = [
+          {
+            ErrorEquals     = ["Glue.ConcurrentRunsExceededException"],
+            IntervalSeconds = 60,
+            BackoffRate     = 1.5,
+            MaxDelaySeconds = 600,
+            JitterStrategy  = "FULL",
+            MaxAttempts     = 12
+          }
+        ],
         ResultPath = "$.glueJobResult",
-        Next       = "StartGlueCrawler"
+        Next       = "GetJobResult"
+      },
+      "GetJobResult" = {
+        Type     = "Task",
+        Resource = "arn:aws:states:::aws-sdk:s3:getObject",
+        Parameters = {
+          Bucket  = module.artifacts_bucket.s3_bucket_id,
+          "Key.$" = "States.Format('job-results/{}.json', $$.Execution.Name)"
+        },
+        ResultSelector = {
+          "result.$" = "States.StringToJson($.Body)"
+        },
+        ResultPath = "$.jobResult",
+        Next       = "IsSchemaChanged"
+      },
+      # The job registers the new partitions itself while the schema is unchanged
+      "IsSchemaChanged" = {
+        Type = "Choice",
+        Choices = [
+          {
+            Variable      = "$.jobResult.result.schema_changed",
+            BooleanEquals = true,
+            Next          = "StartGlueCrawler"
+          }
+        ],
+        Default = "Success"
       },
       "StartGlueCrawler" = {
         Type     = "Task",
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The Glue job script runs from scripts/ and the Lambda from lambdas/, so import them the same way here
+for directory in ("scripts", "lambdas"):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", directory))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+
+
+@pytest.fixture(scope="session")
+def spark():
+    """ Local Spark session, standing in for the Glue job's """
+    pyspark_sql = pytest.importorskip("pyspark.sql")
+    session = (
+        pyspark_sql.SparkSession.builder.master("local[2]")
+        .config("spark.sql.shuffle.partitions", "4")
+        .config("spark.ui.enabled", "false")
+        .getOrCreate()
+    )
+    yield session
+    session.stop()
@@ -0,0 +1,320 @@
+import csv
+import glob
+import io
+import json
+import os
+import random
+import types
+
+import pytest
+
+# Only the tests using the spark fixture need pyspark, the S3 and catalog steps run on stubs
+import csv_to_parquet
+
+DATES = ["2024-05-01", "2024-05-02", "2024-05-03"]
+COMMENTS = ["", "gift wrap", "deliver to the back door", "call before delivery", "express"]
+
+
+def write_csv(path, rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["order_id", "event_date", "customer", "amount", "comment"])
+        for index in range(rows):
+            writer.writerow([
+                index,
+                DATES[index % len(DATES)],
+                "customer-{}".format(rng.randrange(10000)),
+                round(rng.uniform(0, 1000), 2),
+                rng.choice(COMMENTS),
+            ])
+
+
+def job_args(input_path, output_path, **options):
+    args = dict(csv_to_parquet.OPTIONAL_ARGS, input_path=input_path, output_path=output_path)
+    args.update(options)
+    return args
+
+
+def test_plan_output_files_targets_the_file_size():
+    lines = ["x" * 99] * 10  # 100 bytes per record, 25 in Parquet
+
+    assert csv_to_parquet.plan_output_files(100 * 1024 * 1024, lines, 10 * 1024 * 1024, 0.25) == (3, 419430)
+    assert csv_to_parquet.plan_output_files(1000, lines, 10 * 1024 * 1024, 0.25) == (1, 419430)
+
+
+class StubDataFrame:
+    """ Records the calls of write_parquet on a Spark DataFrame and its writer """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.calls.append((name,) + args)
+            return self
+        return record
+
+    @property
+    def write(self):
+        self.calls.append(("write",))
+        return self
+
+
+def test_partitioned_output_is_split_by_partition_value():
+    df = StubDataFrame()
+
+    csv_to_parquet.write_parquet(df, "s3://parquet/data/", ["event_date"], 3, 1000, "zstd")
+
+    assert df.calls == [
+        ("repartition", 3, "event_date"), ("write",), ("mode", "append"), ("option", "compression", "zstd"),
+        ("option", "maxRecordsPerFile", 1000), ("partitionBy", "event_date"), ("parquet", "s3://parquet/data/"),
+    ]
+
+
+def test_unpartitioned_output_is_coalesced_without_a_shuffle():
+    df = StubDataFrame()
+
+    csv_to_parquet.write_parquet(df, "s3://parquet/data/", [], 1, 1000, "snappy")
+
+    assert df.calls[0] == ("coalesce", 1)
+    assert ("option", "compression", "snappy") in df.calls
+    assert not any(call[0] in ("repartition", "partitionBy") for call in df.calls)
+
+
+def test_partitioned_files_of_the_target_size(spark, tmp_path):
+    input_path = tmp_path / "input"
+    input_path.mkdir()
+    for part in range(2):
+        write_csv(str(input_path / "orders-{}.csv".format(part)), 60000, seed=part)
+    output_path = str(tmp_path / "output")
+    target_bytes = 256 * 1024
+
+    result = csv_to_parquet.process_csv_to_parquet(spark, None, job_args(
+        str(input_path), output_path, partition_keys="event_date", target_file_size_mb=str(target_bytes / (1024 * 1024)),
+        compression="zstd",
+    ))
+
+    assert result["records"] == 120000
+    assert sorted(name for name in os.listdir(output_path) if not name.startswith((".", "_"))) == [
+        "event_date={}".format(date) for date in DATES
+    ]
+    for date in DATES:
+        files = glob.glob(os.path.join(output_path, "event_date=" + date, "*.parquet"))
+        assert all(path.endswith(".zstd.parquet") for path in files)
+        sizes = sorted(os.path.getsize(path) for path in files)
+        # One partial file per partition at most, the others near the target size
+        assert len(sizes) > 1
+        assert all(target_bytes / 4 < size < target_bytes * 2 for size in sizes[1:])
+    output = spark.read.parquet(output_path)
+    assert output.count() == 120000
+    assert dict(output.dtypes)["amount"] == "double"
+
+
+def test_unpartitioned_output_is_coalesced(spark, tmp_path):
+    input_path = tmp_path / "input"
+    input_path.mkdir()
+    for part in range(8):
+        write_csv(str(input_path / "orders-{}.csv".format(part)), 100, seed=part)
+    output_path = str(tmp_path / "output")
+
+    result = csv_to_parquet.process_csv_to_parquet(spark, None, job_args(str(input_path), output_path))
+
+    assert result["records"] == 800
+    # Without a catalog table to compare with, the crawler runs
+    assert result["schema_changed"]
+    assert len(glob.glob(os.path.join(output_path, "*.parquet"))) == 1
+
+
+def test_unknown_partition_key(spark, tmp_path):
+    input_path = tmp_path / "input"
+    input_path.mkdir()
+    write_csv(str(input_path / "orders.csv"), 10)
+
+    with pytest.raises(Exception, match="not columns"):
+        csv_to_parquet.process_csv_to_parquet(spark, None, job_args(str(input_path), str(tmp_path / "output"), partition_keys="day"))
+
+
+class StubS3:
+    """ Local stand-in for the input bucket and the manifest """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+        class ClientError(Exception):
+            def __init__(self, code):
+                self.response = {"Error": {"Code": code}}
+
+    def __init__(self, objects, manifest=None):
+        self.objects = objects
+        self.manifest = manifest
+        self.saved = None
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        for start in range(0, len(keys), 2):
+            yield {"Contents": [{"Key": key, "ETag": '"{}"'.format(self.objects[key]), "Size": 100} for key in keys[start:start + 2]]}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.ClientError("404")
+        return {"ETag": '"{}"'.format(self.objects[Key]), "ContentLength": 100}
+
+    def get_object(self, Bucket, Key):
+        if self.manifest is None:
+            raise self.exceptions.NoSuchKey()
+        return {"Body": io.BytesIO(json.dumps({"files": self.manifest}).encode())}
+
+    def put_object(self, Bucket, Key, Body):
+        self.saved = json.loads(Body)["files"]
+
+
+def test_only_new_or_changed_files_are_selected():
+    s3 = StubS3({"input/a.csv": "1", "input/b.csv": "2", "input/c.csv": "3", "input/": "0"})
+    manifest = {"s3://raw/input/a.csv": "1", "s3://raw/input/b.csv": "old"}
+
+    new_files = csv_to_parquet.select_new_files(csv_to_parquet.list_input_files(s3, "s3://raw/input/"), manifest)
+
+    assert new_files == {"s3://raw/input/b.csv": ("2", 100), "s3://raw/input/c.csv": ("3", 100)}
+
+
+def test_nothing_to_convert_exits_before_reading():
+    s3 = StubS3({"input/a.csv": "1"}, manifest={"s3://raw/input/a.csv": "1"})
+
+    result = csv_to_parquet.process_csv_to_parquet(None, s3, job_args(
+        "s3://raw/input/", "s3://parquet/data/", manifest_path="s3://artifacts/manifests/csv_to_parquet.json",
+    ))
+
+    assert result == {"records": 0, "schema_changed": False, "reason": None, "partitions_added": 0}
+    assert s3.saved is None
+
+
+def test_only_the_listed_files_are_checked():
+    s3 = StubS3({"input/a.csv": "1", "input/b.csv": "2"}, manifest={"s3://raw/input/a.csv": "1"})
+
+    files = csv_to_parquet.describe_input_files(s3, ["s3://raw/input/a.csv", "s3://raw/input/deleted.csv"])
+    result = csv_to_parquet.process_csv_to_parquet(None, s3, job_args(
+        "s3://raw/input/", "s3://parquet/data/", input_paths=json.dumps(["s3://raw/input/a.csv"]),
+        manifest_path="s3://artifacts/manifests/csv_to_parquet.json",
+    ))
+
+    assert files == {"s3://raw/input/a.csv": ("1", 100)}
+    assert result["records"] == 0
+
+
+class StubGlue:
+    """ Local stand-in for the Glue catalog """
+
+    class exceptions:
+        class EntityNotFoundException(Exception):
+            pass
+
+    def __init__(self, table=None, existing=(), error_code=None):
+        self.table = table
+        self.partitions = {tuple(values) for values in existing}
+        self.error_code = error_code
+        self.calls = 0
+
+    def get_table(self, DatabaseName, Name):
+        if self.table is None:
+            raise self.exceptions.EntityNotFoundException()
+        return {"Table": dict(self.table, DatabaseName=DatabaseName, Name=Name)}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        assert len(PartitionInputList) <= 100
+        self.calls += 1
+        errors = []
+        for partition in PartitionInputList:
+            values = tuple(partition["Values"])
+            if values in self.partitions:
+                errors.append({"PartitionValues": list(values), "ErrorDetail": {"ErrorCode": "AlreadyExistsException"}})
+            elif self.error_code:
+                errors.append({"PartitionValues": list(values), "ErrorDetail": {"ErrorCode": self.error_code}})
+            self.partitions.add(values)
+        return {"Errors": errors}
+
+
+def catalog_table(columns, partition_keys):
+    return {
+        "StorageDescriptor": {
+            "Columns": [{"Name": name, "Type": column_type} for name, column_type in columns],
+            "Location": "s3://parquet/data/",
+            "SerdeInfo": {"SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"},
+        },
+        "PartitionKeys": [{"Name": name, "Type": "string"} for name in partition_keys],
+    }
+
+
+class StubDataType:
+    """ Spark data type, as compare_schema reads it """
+
+    def __init__(self, name):
+        self.name = name
+
+    def simpleString(self):
+        return self.name
+
+
+def output_schema():
+    """ The fields of the Spark schema of the output """
+    columns = [("Customer", "string"), ("amount", "double"), ("event_date", "string")]
+    return types.SimpleNamespace(fields=[
+        types.SimpleNamespace(name=name, dataType=StubDataType(data_type)) for name, data_type in columns
+    ])
+
+
+def test_partition_values_follow_the_table_location():
+    keys = ["partition_0", "event_date"]
+
+    assert csv_to_parquet.partition_values("s3://parquet/data/", "s3://parquet/data/orders_1/event_date=2024-05-01%2012/", keys) == [
+        "orders_1", "2024-05-01 12"
+    ]
+    assert csv_to_parquet.partition_values("s3://parquet/data", "s3://parquet/data/orders_1/", keys) is None
+    assert csv_to_parquet.partition_values("s3://parquet/data/", "s3://parquet/data/orders_1/day=2024-05-01/", keys) is None
+    assert csv_to_parquet.partition_values("s3://parquet/data/", "s3://parquet/other/a/event_date=1/", keys) is None
+
+
+def test_matching_schema_adds_the_partitions_directly():
+    s3 = StubS3({
+        "data/orders_1/event_date=2024-05-01/part-0.parquet": "1",
+        "data/orders_1/event_date=2024-05-01/part-1.parquet": "2",
+        "data/orders_1/event_date=2024-05-02/part-0.parquet": "3",
+        "data/orders_1/_SUCCESS": "4",
+    })
+    table = catalog_table([("customer", "string"), ("amount", "double")], ["partition_0", "event_date"])
+    glue = StubGlue(table, existing=[["orders_1", "2024-05-01"]])
+
+    result = csv_to_parquet.update_catalog(glue, s3, "db", "data", "s3://parquet/data/orders_1/", output_schema(), ["event_date"])
+
+    assert result == {"schema_changed": False, "reason": None, "partitions_added": 1}
+    assert glue.partitions == {("orders_1", "2024-05-01"), ("orders_1", "2024-05-02")}
+
+
+def test_schema_drift_leaves_the_catalog_to_the_crawler():
+    s3 = StubS3({"data/orders_1/event_date=2024-05-01/part-0.parquet": "1"})
+    changed = StubGlue(catalog_table([("customer", "string"), ("amount", "bigint")], ["partition_0", "event_date"]))
+    repartitioned = StubGlue(catalog_table([("customer", "string"), ("amount", "double")], ["partition_0"]))
+
+    for glue in (StubGlue(), changed, repartitioned):
+        result = csv_to_parquet.update_catalog(glue, s3, "db", "data", "s3://parquet/data/orders_1/", output_schema(), ["event_date"])
+        assert result["schema_changed"]
+        assert glue.calls == 0
+    assert csv_to_parquet.update_catalog(
+        changed, s3, "db", "data", "s3://parquet/data/orders_1/", output_schema(), ["event_date"]
+    )["reason"] == "Columns changed: amount bigint -> double"
+
+
+def test_partitions_are_created_in_batches():
+    table = dict(catalog_table([("customer", "string")], ["event_date"]), DatabaseName="db", Name="data")
+    partitions = {"s3://parquet/data/event_date={}/".format(day): [str(day)] for day in range(250)}
+    glue = StubGlue(table, existing=[["0"], ["1"]])
+
+    assert csv_to_parquet.register_partitions(glue, table, partitions) == 248
+    assert glue.calls == 3
+    with pytest.raises(Exception, match="ResourceNumberLimitExceededException"):
+        csv_to_parquet.register_partitions(StubGlue(table, error_code="ResourceNumberLimitExceededException"), table, partitions)
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import trigger_step_function
+
+
+class StubStepFunctions:
+    def __init__(self):
+        self.executions = []
+
+    def start_execution(self, stateMachineArn, name, input):
+        self.executions.append({"name": name, "input": json.loads(input)})
+        return {"executionArn": "arn:aws:states:eu-central-1:123456789012:execution:etl:" + name}
+
+
+class StubContext:
+    aws_request_id = "0f1e2d3c-aaaa-bbbb-cccc-000000000000"
+
+
+def s3_event(*keys, bucket="raw"):
+    return {"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}} for key in keys]}
+
+
+def sqs_event(*bodies):
+    return {"Records": [{"messageId": str(index), "body": json.dumps(body)} for index, body in enumerate(bodies)]}
+
+
+@pytest.fixture()
+def step_functions(monkeypatch):
+    stub = StubStepFunctions()
+    monkeypatch.setattr(trigger_step_function, "step_functions", stub)
+    monkeypatch.setenv("STATE_MACHINE_ARN", "arn:aws:states:eu-central-1:123456789012:stateMachine:etl")
+    monkeypatch.setenv("OUTPUT_BUCKET", "parquet")
+    return stub
+
+
+def test_every_record_of_the_event_is_converted(step_functions):
+    trigger_step_function.handler(s3_event("input/a.csv", "input/2024/b+c.csv", "input/a.csv"), StubContext())
+
+    execution, = step_functions.executions
+    assert execution["input"]["input_paths"] == ["s3://raw/input/a.csv", "s3://raw/input/2024/b c.csv"]
+    assert execution["input"]["input_path"] == "s3://raw/input/"
+    assert execution["input"]["output_path"].startswith("s3://parquet/data/2-files_")
+
+
+def test_buffered_notifications_start_one_execution(step_functions):
+    event = sqs_event(s3_event("input/a.csv"), {"Event": "s3:TestEvent"}, s3_event("input/b.csv", "input/c.csv"))
+
+    response = trigger_step_function.handler(event, StubContext())
+
+    execution, = step_functions.executions
+    assert execution["input"]["input_paths"] == ["s3://raw/input/a.csv", "s3://raw/input/b.csv", "s3://raw/input/c.csv"]
+    assert json.loads(response["body"])["executionArns"][0].endswith(execution["name"])
+
+
+def test_large_batches_are_split(step_functions, monkeypatch):
+    monkeypatch.setattr(trigger_step_function, "MAX_FILES_PER_EXECUTION", 2)
+
+    trigger_step_function.handler(s3_event("input/a.csv", "input/b.csv", "input/c.csv"), StubContext())
+
+    assert [len(execution["input"]["input_paths"]) for execution in step_functions.executions] == [2, 1]
+    assert len({execution["name"] for execution in step_functions.executions}) == 2
+    assert step_functions.executions[1]["input"]["output_path"].startswith("s3://parquet/data/c_")
@@ -0,0 +1,54 @@
+"""
+Time the report queries and rendering with the local DuckDB backend
+
+Synthetic CUR Parquet files are generated in a temporary directory, one
+Hive partition per billing period, and the whole report is produced from
+them without any AWS call.
+
+Usage:
+    python benchmarks/bench_local_report.py --rows 1000000 --periods 2024-04-01 2024-05-01
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas"))
+
+import untagged_resources_reporter as reporter
+import local_backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="CUR line items per billing period")
+    parser.add_argument("--periods", nargs="+", default=["2024-04-01", "2024-05-01"])
+    parser.add_argument("--tag-keys", nargs="+", default=["team", "owner"])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    reporter.DATABASE_NAME = reporter.DATABASE_NAME or "cur"
+    reporter.TABLE_NAME = reporter.TABLE_NAME or "cur_data"
+    reporter.BILLING_PERIODS = args.periods
+    reporter.TAG_KEYS_TO_ANALYZE = args.tag_keys
+    with tempfile.TemporaryDirectory() as cur_path:
+        start = time.perf_counter()
+        local_backend.write_synthetic_cur_files(cur_path, args.rows, args.periods)
+        print("{} rows x {} billing periods generated in {:.2f} s".format(
+            args.rows, len(args.periods), time.perf_counter() - start))
+
+        backend = local_backend.DuckDBBackend(cur_path)
+        print("{:>6} {:>10} {:>10} {:>12}".format("run", "queries s", "render s", "rows/sec"))
+        for run in range(args.runs):
+            start = time.perf_counter()
+            results = reporter.run_report_queries(backend, reporter.REPORT_QUERIES, time.monotonic() + 3600)
+            queried = time.perf_counter()
+            reporter.render_html_report(results["tagged_vs_untagged"], results["expensive_untagged"])
+            rendered = time.perf_counter()
+            print("{:>6} {:>10.3f} {:>10.3f} {:>12.0f}".format(
+                run + 1, queried - start, rendered - queried, args.rows * len(args.periods) / (queried - start)))
+
+
+if __name__ == "__main__":
+    main()
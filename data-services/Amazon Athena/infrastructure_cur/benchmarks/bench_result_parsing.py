@@ -0,0 +1,119 @@
+"""
+Compare the per-cell type guessing with the typed, column-oriented result parsing
+
+A synthetic Athena CSV output shaped like the most expensive untagged
+resources query is parsed both ways, from memory, so only parsing is timed.
+
+Usage:
+    python benchmarks/bench_result_parsing.py --rows 1000000
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas"))
+
+import untagged_resources_reporter as reporter
+
+COLUMNS = ["service", "resource_id", "region", "instance_type", "product_name", "usage_type", "cost"]
+TYPES = ["varchar", "varchar", "varchar", "varchar", "varchar", "varchar", "double"]
+
+
+class StubAthena:
+    """ Returns the column metadata of the synthetic result """
+
+    def get_query_results(self, QueryExecutionId, MaxResults):
+        column_info = [{"Name": name, "Type": column_type} for name, column_type in zip(COLUMNS, TYPES)]
+        return {"ResultSet": {"ResultSetMetadata": {"ColumnInfo": column_info}}}
+
+
+class StubS3:
+    """ Serves the synthetic CSV output from memory """
+
+    def __init__(self, body):
+        self.body = body
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.body)}
+
+
+def synthetic_csv(rows, seed=0):
+    rng = random.Random(seed)
+    output = io.StringIO()
+    writer = csv.writer(output, quoting=csv.QUOTE_ALL)
+    writer.writerow(COLUMNS)
+    for index in range(rows):
+        writer.writerow([
+            rng.choice(["AmazonEC2", "AmazonS3", "AmazonRDS", "AWSLambda"]),
+            # Resource IDs with dots and numeric-looking IDs, which the guessing parser mis-types
+            rng.choice(["my.bucket.{}".format(index), "{:012d}".format(index), "i-{:017x}".format(index)]),
+            rng.choice(["eu-central-1", "us-east-1"]),
+            rng.choice(["m5.large", ""]),
+            "Amazon Elastic Compute Cloud",
+            "EUC1-BoxUsage:m5.large",
+            repr(rng.uniform(0, 500)),
+        ])
+    return output.getvalue().encode("utf-8")
+
+
+def parse_guessing(body):
+    """ The former parser: a dict per row, and float() or int() tried on every cell """
+    results = []
+    for row in csv.DictReader(io.StringIO(body.decode("utf-8"))):
+        processed_row = {}
+        for key, value in row.items():
+            try:
+                if "." in value:
+                    processed_row[key] = float(value)
+                else:
+                    processed_row[key] = int(value)
+            except (ValueError, TypeError):
+                processed_row[key] = value
+        results.append(processed_row)
+    return results
+
+
+def parse_typed(body):
+    execution = {"QueryExecutionId": "benchmark", "ResultConfiguration": {"OutputLocation": "s3://bucket/benchmark.csv"}}
+    return reporter.fetch_query_results(StubAthena(), StubS3(body), execution)
+
+
+def measure(parse, body, memory):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = parse(body)
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--memory", action="store_true", help="also report the peak allocated memory (slower)")
+    args = parser.parse_args()
+
+    body = synthetic_csv(args.rows)
+    print("{} rows, {:.1f} MB of CSV".format(args.rows, len(body) / (1024 * 1024)))
+    print("{:>10} {:>10} {:>12} {:>10}".format("parser", "seconds", "rows/sec", "peak MB"))
+    results = {}
+    for name, parse in [("guessing", parse_guessing), ("typed", parse_typed)]:
+        results[name], seconds, peak_mb = measure(parse, body, args.memory)
+        print("{:>10} {:>10.2f} {:>12.0f} {:>10}".format(
+            name, seconds, args.rows / seconds, "-" if peak_mb is None else "{:.0f}".format(peak_mb)))
+
+    mistyped = sum(1 for row in results["guessing"] if not isinstance(row["resource_id"], str))
+    print("resource IDs turned into numbers by the guessing parser: {}".format(mistyped))
+
+
+if __name__ == "__main__":
+    main()
@@ -49,6 +49,11 @@ module "lambda_function" {
     SENDER_EMAIL       = local.sender_email
     RECIPIENT_EMAILS   = local.recipient_emails
     TAG_KEY_TO_ANALYZE = local.tag_key_to_analyze
+
+    # Reuse Athena results younger than this, and cache the report rows in the results bucket
+    # (the bucket's lifecycle rule expires the cache with the query results)
+    RESULT_REUSE_MAX_AGE_MINUTES = local.result_reuse_max_age_minutes
+    REPORT_CACHE_PREFIX          = "report-cache/"
   }
 
   # IAM policy statements
@@ -68,7 +73,9 @@ module "lambda_function" {
       actions = [
         "athena:StartQueryExecution",
         "athena:GetQueryExecution",
-        "athena:GetQueryResults"
+        "athena:BatchGetQueryExecution",
+        "athena:GetQueryResults",
+        "athena:StopQueryExecution"
       ],
       resources = ["*"]
     },
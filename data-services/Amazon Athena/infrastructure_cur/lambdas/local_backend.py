@@ -0,0 +1,172 @@
+"""
+Local query backend running the report SQL with DuckDB over CUR Parquet files
+
+The CUR files are laid out like the export in S3, with Hive-style partition
+folders, e.g. cur/BILLING_PERIOD=2024-05/part-0.parquet. The report queries
+are written in the SQL shared by Athena (Trino) and DuckDB, so the same
+queries run here without an Athena workgroup or network access:
+
+    QUERY_BACKEND=local LOCAL_CUR_PATH=./cur DATABASE_NAME=cur TABLE_NAME=cur_data \
+        python untagged_resources_reporter.py
+"""
+import os
+import time
+
+import duckdb
+
+import untagged_resources_reporter as reporter
+
+# Athena names of the DuckDB result types, so results look the same with both backends
+DUCKDB_TYPES = {
+    'BOOLEAN': 'boolean',
+    'TINYINT': 'tinyint',
+    'SMALLINT': 'smallint',
+    'INTEGER': 'integer',
+    'BIGINT': 'bigint',
+    'HUGEINT': 'bigint',
+    'FLOAT': 'real',
+    'DOUBLE': 'double',
+    'DATE': 'date',
+    'TIMESTAMP': 'timestamp',
+}
+
+# Columns of the synthetic CUR files, in the CUR 2.0 schema
+CUR_COLUMNS = {
+    'bill_billing_period_start_date': 'TIMESTAMP',
+    'line_item_product_code': 'VARCHAR',
+    'line_item_resource_id': 'VARCHAR',
+    'line_item_line_item_type': 'VARCHAR',
+    'line_item_usage_type': 'VARCHAR',
+    'line_item_unblended_cost': 'DOUBLE',
+    'product_region_code': 'VARCHAR',
+    'product': 'MAP(VARCHAR, VARCHAR)',
+    'resource_tags': 'MAP(VARCHAR, VARCHAR)',
+}
+
+
+def athena_type(duckdb_type):
+    duckdb_type = str(duckdb_type).upper()
+    if duckdb_type.startswith('DECIMAL'):
+        return 'decimal'
+    return DUCKDB_TYPES.get(duckdb_type, 'varchar')
+
+
+def parameter_value(parameter):
+    """
+    Return the value of an Athena execution parameter, which is a SQL literal
+    """
+    if len(parameter) >= 2 and parameter[0] == parameter[-1] == "'":
+        return parameter[1:-1].replace("''", "'")
+    return parameter
+
+
+class DuckDBBackend:
+    """
+    Run the report queries in-process with DuckDB over local CUR Parquet files
+
+    The files are exposed as the view "DATABASE_NAME"."TABLE_NAME", so the
+    queries reference the same table as in Athena.
+    """
+
+    def __init__(self, cur_path, database_name=None, table_name=None):
+        if not os.path.isdir(cur_path):
+            raise ValueError(f"LOCAL_CUR_PATH {cur_path!r} is not a directory of CUR Parquet files")
+        self.cur_path = cur_path
+        self.connection = duckdb.connect()
+        database_name = database_name or reporter.DATABASE_NAME
+        table_name = table_name or reporter.TABLE_NAME
+        files = os.path.join(cur_path, '**', '*.parquet').replace("'", "''")
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{database_name}"')
+        # Partition values stay strings, like the partition keys of a Glue table
+        self.connection.execute(f"""
+            CREATE VIEW "{database_name}"."{table_name}" AS
+            SELECT * FROM read_parquet('{files}', hive_partitioning = true, hive_types_autocast = false, union_by_name = true)
+        """)
+
+    def partition_keys(self):
+        """
+        Return the Hive partition keys of the CUR files, lower-cased like the Glue crawler does
+        """
+        for directory, _, files in os.walk(self.cur_path):
+            if any(name.endswith('.parquet') for name in files):
+                relative = os.path.relpath(directory, self.cur_path)
+                return [segment.split('=', 1)[0].lower() for segment in relative.split(os.sep) if '=' in segment]
+        return []
+
+    def fingerprint(self):
+        # Local runs are not cached
+        return None
+
+    def run_queries(self, queries, deadline):
+        results = {}
+        for name, (query, parameters) in queries.items():
+            if time.monotonic() > deadline:
+                raise Exception(f"Query {name} did not start before the deadline")
+            start = time.perf_counter()
+            cursor = self.connection.execute(query, [parameter_value(parameter) for parameter in parameters or []])
+            columns = [column[0] for column in cursor.description]
+            types = [athena_type(column[1]) for column in cursor.description]
+            rows = cursor.fetchall()
+            data = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+            results[name] = reporter.QueryResult(columns, types, data)
+            print(f"Query {name} ran locally in {time.perf_counter() - start:.3f} s, {len(rows)} rows")
+        return results
+
+
+def write_cur_files(cur_path, rows):
+    """
+    Write CUR line items, given as dictionaries, to Hive-partitioned Parquet files
+
+    Columns missing from a row are NULL. Meant for small, hand-written test
+    fixtures; see write_synthetic_cur_files for large ones.
+    """
+    connection = duckdb.connect()
+    columns = ', '.join(f'{name} {column_type}' for name, column_type in CUR_COLUMNS.items())
+    connection.execute(f'CREATE TABLE line_items ({columns})')
+    placeholders = ', '.join(['?'] * len(CUR_COLUMNS))
+    connection.executemany(
+        f'INSERT INTO line_items VALUES ({placeholders})',
+        [[row.get(name) for name in CUR_COLUMNS] for row in rows]
+    )
+    copy_partitioned(connection, 'line_items', cur_path)
+
+
+def write_synthetic_cur_files(cur_path, rows_per_period, billing_periods, seed=0):
+    """
+    Generate CUR line items for benchmarks, rows_per_period for each billing period (YYYY-MM-DD)
+
+    About a third of the resources are untagged, and the others carry the
+    "team" and "owner" tags in various combinations.
+    """
+    connection = duckdb.connect()
+    connection.execute(f'SELECT setseed({(seed % 1000) / 1000})')
+    periods = ', '.join(f"TIMESTAMP '{period}'" for period in billing_periods)
+    connection.execute(f"""
+        CREATE TABLE line_items AS
+        SELECT
+            period AS bill_billing_period_start_date,
+            ['AmazonEC2', 'AmazonS3', 'AmazonRDS', 'AWSLambda'][1 + (i % 4)] AS line_item_product_code,
+            'arn:aws:service:eu-central-1:123456789012:resource/r-' || (i % {max(1, rows_per_period // 10)}) AS line_item_resource_id,
+            CASE WHEN i % 50 = 0 THEN 'Credit' ELSE 'Usage' END AS line_item_line_item_type,
+            'EUC1-Usage' AS line_item_usage_type,
+            round(random() * 10, 6) AS line_item_unblended_cost,
+            'eu-central-1' AS product_region_code,
+            MAP {{'instance_type': 'm5.large', 'product_name': 'Amazon Elastic Compute Cloud'}} AS product,
+            CASE (i % {max(1, rows_per_period // 10)}) % 3
+                WHEN 0 THEN MAP {{}}::MAP(VARCHAR, VARCHAR)
+                WHEN 1 THEN MAP {{'team': 'analytics'}}
+                ELSE MAP {{'team': 'platform', 'owner': ''}}
+            END AS resource_tags
+        FROM range({rows_per_period}) AS line_item (i)
+        CROSS JOIN UNNEST([{periods}]) AS billing_periods (period)
+    """)
+    copy_partitioned(connection, 'line_items', cur_path)
+
+
+def copy_partitioned(connection, table, cur_path):
+    # CUR 2.0 exports are partitioned in BILLING_PERIOD=YYYY-MM folders
+    connection.execute(f"""
+        COPY (
+            SELECT *, strftime(bill_billing_period_start_date, '%Y-%m') AS BILLING_PERIOD FROM {table}
+        ) TO '{cur_path.replace("'", "''")}' (FORMAT PARQUET, PARTITION_BY (BILLING_PERIOD), OVERWRITE_OR_IGNORE)
+    """)
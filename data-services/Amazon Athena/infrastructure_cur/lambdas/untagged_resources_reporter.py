@@ -5,6 +5,11 @@ import os
 import csv
 import io
 import datetime
+import decimal
+import gzip
+import html
+import itertools
+import hashlib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -18,6 +23,30 @@ SENDER_EMAIL = os.environ.get('SENDER_EMAIL', '')
 RECIPIENT_EMAILS = os.environ.get('RECIPIENT_EMAILS', '').split(',')
 TAG_KEY_TO_ANALYZE = os.environ.get('TAG_KEY_TO_ANALYZE', '')
 BILLING_PERIOD = os.environ.get('BILLING_PERIOD', datetime.datetime.now().replace(day=1).strftime('%Y-%m-%d'))
+# Comma-separated lists, all covered by one scan per report section
+TAG_KEYS_TO_ANALYZE = [key.strip() for key in os.environ.get('TAG_KEYS_TO_ANALYZE', TAG_KEY_TO_ANALYZE).split(',')]
+BILLING_PERIODS = [period.strip() for period in os.environ.get('BILLING_PERIODS', BILLING_PERIOD).split(',')]
+
+QUERY_TIMEOUT_SECONDS = int(os.environ.get('QUERY_TIMEOUT_SECONDS', '300'))
+# Polling starts fast for short queries and backs off up to a cap for long ones
+POLL_INITIAL_SECONDS = float(os.environ.get('POLL_INITIAL_SECONDS', '0.05'))
+POLL_MAX_SECONDS = float(os.environ.get('POLL_MAX_SECONDS', '2'))
+# Time kept back from the Lambda timeout to render and send the report
+DEADLINE_MARGIN_SECONDS = 30
+# Athena returns the results of an identical query run within this age instead of scanning again (0 disables)
+RESULT_REUSE_MAX_AGE_MINUTES = int(os.environ.get('RESULT_REUSE_MAX_AGE_MINUTES', '60'))
+# Prefix in OUTPUT_BUCKET for the reporter's own result cache (empty disables)
+REPORT_CACHE_PREFIX = os.environ.get('REPORT_CACHE_PREFIX', 'report-cache/')
+# CSV attachments with more rows than this are gzip-compressed
+ATTACHMENT_GZIP_ROWS = int(os.environ.get('ATTACHMENT_GZIP_ROWS', '1000'))
+# Above this message size, the SES limit for raw emails, the CSV files are linked from S3 instead of attached
+MAX_MESSAGE_BYTES = int(os.environ.get('MAX_MESSAGE_BYTES', str(10 * 1024 * 1024)))
+# Prefix in OUTPUT_BUCKET for the CSV files that are too large to attach, and the validity of their links
+REPORT_FILES_PREFIX = os.environ.get('REPORT_FILES_PREFIX', 'report-files/')
+REPORT_LINK_EXPIRY_SECONDS = int(os.environ.get('REPORT_LINK_EXPIRY_SECONDS', str(7 * 24 * 3600)))
+# 'athena', or 'local' to run the report queries with DuckDB over the CUR Parquet files in LOCAL_CUR_PATH
+QUERY_BACKEND = os.environ.get('QUERY_BACKEND', 'athena')
+LOCAL_CUR_PATH = os.environ.get('LOCAL_CUR_PATH', './cur')
 
 def lambda_handler(event, context):
     """
@@ -25,20 +54,20 @@ def lambda_handler(event, context):
     """
     try:
         # Initialize clients
-        athena_client = boto3.client('athena')
         s3_client = boto3.client('s3')
         ses_client = boto3.client('ses')
         
         # Execute queries
         print("Starting Athena queries...")
-        tagged_vs_untagged_results = run_tagged_vs_untagged_query(athena_client, s3_client)
-        expensive_untagged_results = run_expensive_untagged_query(athena_client, s3_client)
+        backend = create_backend(s3_client)
+        fingerprint = backend.fingerprint() if REPORT_CACHE_PREFIX else None
+        results = run_report_queries(
+            backend, REPORT_QUERIES, query_deadline(context), fingerprint, s3_client
+        )
         
         # Generate and send email
         print("Generating and sending email report...")
-        # print(tagged_vs_untagged_results)
-        # print(expensive_untagged_results)
-        send_email_report(ses_client, tagged_vs_untagged_results, expensive_untagged_results)
+        send_email_report(ses_client, results['tagged_vs_untagged'], results['expensive_untagged'], s3_client)
         
         return {
             'statusCode': 200,
@@ -51,35 +80,295 @@ def lambda_handler(event, context):
             'body': json.dumps(f'Error: {str(e)}')
         }
 
-def run_tagged_vs_untagged_query(athena_client, s3_client):
+def create_backend(s3_client=None):
+    """
+    Return the query backend selected by QUERY_BACKEND
+    """
+    if QUERY_BACKEND == 'local':
+        # Only needed, and only installed, on a development machine
+        from local_backend import DuckDBBackend
+        return DuckDBBackend(LOCAL_CUR_PATH)
+    return AthenaBackend(boto3.client('athena'), s3_client or boto3.client('s3'), boto3.client('glue'))
+
+def query_deadline(context):
+    """
+    Return the monotonic time by which all report queries must have finished
+    """
+    timeout = QUERY_TIMEOUT_SECONDS
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+        timeout = max(0, min(timeout, remaining))
+    return time.monotonic() + timeout
+
+def run_report_queries(backend, report_queries, deadline, fingerprint=None, s3_client=None):
+    """
+    Run all report queries on a backend and return {name: QueryResult}
+    
+    With a table fingerprint, queries whose results are cached in S3 for the
+    same data are not run at all. The partition keys of the table are passed
+    to the query builders, to restrict the scan to the partitions of the
+    billing periods.
+    """
+    partition_keys = backend.partition_keys()
+    results = {}
+    cache_keys = {}
+    queries = {}
+    for name, build_query in report_queries.items():
+        query, parameters = build_query(partition_keys)
+        if fingerprint is not None:
+            cache_keys[name] = report_cache_key(query, parameters, fingerprint)
+            cached = load_cached_results(s3_client, cache_keys[name])
+            if cached is not None:
+                print(f"Query {name} served from the report cache, 0 bytes scanned")
+                results[name] = cached
+                continue
+        queries[name] = (query, parameters)
+    
+    for name, result in backend.run_queries(queries, deadline).items():
+        results[name] = result
+        if name in cache_keys:
+            save_cached_results(s3_client, cache_keys[name], result)
+    return {name: results[name] for name in report_queries}
+
+class AthenaBackend:
+    """
+    Run the report queries in Athena, over the CUR table of the Glue catalog
+    
+    A query backend provides partition_keys(), the partition columns of the
+    CUR table; fingerprint(), a digest of its data for the report cache or
+    None; and run_queries(), which runs {name: (query, parameters)} and
+    returns {name: QueryResult}.
+    """
+    
+    def __init__(self, athena_client, s3_client, glue_client):
+        self.athena_client = athena_client
+        self.s3_client = s3_client
+        self.glue_client = glue_client
+        self._table = None
+    
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self.glue_client.get_table(DatabaseName=DATABASE_NAME, Name=TABLE_NAME)['Table']
+        return self._table
+    
+    def partition_keys(self):
+        return [key['Name'] for key in self.table.get('PartitionKeys', [])]
+    
+    def fingerprint(self):
+        return table_fingerprint(self.table, self.s3_client)
+    
+    def run_queries(self, queries, deadline):
+        """
+        Submit all queries at once and wait for them together
+        
+        The queries run in parallel in Athena, so the wall time is the one of
+        the slowest query instead of the sum of all of them.
+        """
+        query_execution_ids = {}
+        try:
+            for name, (query, parameters) in queries.items():
+                query_execution_ids[name] = start_athena_query(self.athena_client, query, name, parameters)
+            executions = wait_for_queries(self.athena_client, list(query_execution_ids.values()), deadline)
+        except Exception:
+            stop_queries(self.athena_client, query_execution_ids.values())
+            raise
+        
+        results = {}
+        for name, query_execution_id in query_execution_ids.items():
+            log_query_statistics(name, executions[query_execution_id])
+            results[name] = fetch_query_results(self.athena_client, self.s3_client, executions[query_execution_id])
+        return results
+
+def log_query_statistics(name, query_execution):
+    """
+    Log the scanned bytes and engine time of a query, to track the scan cost of each report section
+    """
+    statistics = query_execution.get('Statistics', {})
+    print(json.dumps({
+        'query': name,
+        'query_execution_id': query_execution['QueryExecutionId'],
+        'data_scanned_bytes': statistics.get('DataScannedInBytes'),
+        'engine_execution_ms': statistics.get('EngineExecutionTimeInMillis'),
+        'total_execution_ms': statistics.get('TotalExecutionTimeInMillis'),
+        'reused_previous_result': statistics.get('ResultReuseInformation', {}).get('ReusedPreviousResult', False),
+    }))
+
+def table_fingerprint(table, s3_client, billing_periods=None):
+    """
+    Return a digest of the CUR table's definition and of the data files of the billing periods
+    
+    CUR exports rewrite the files of the current billing period in place,
+    so the fingerprint covers the ETag of every object under the partitions
+    of the queried billing periods. Files of other periods don't change the
+    report, so they are neither listed nor part of the fingerprint. A table
+    that is not partitioned by billing period is fingerprinted as a whole.
+    """
+    billing_periods = billing_periods or BILLING_PERIODS
+    digest = hashlib.sha256(str(table.get('UpdateTime', '')).encode('utf-8'))
+    bucket, location = table['StorageDescriptor']['Location'][len('s3://'):].split('/', 1)
+    location = location.rstrip('/') + '/' if location.strip('/') else ''
+    # The leading partition keys that map to the billing period, e.g. billing_period or year and month
+    known_keys = partition_values(billing_periods[0])
+    keys = list(itertools.takewhile(
+        lambda key: key in known_keys, [key['Name'].lower() for key in table.get('PartitionKeys', [])]
+    ))
+    if keys:
+        prefixes = [partition_prefix(s3_client, bucket, location, keys, partition_values(period)) for period in billing_periods]
+    else:
+        prefixes = [location]
+    
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix in prefixes:
+        if prefix is None:
+            # No data for this period yet, its first files change the fingerprint
+            continue
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                digest.update(f"{obj['Key']}:{obj['ETag']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def partition_prefix(s3_client, bucket, prefix, keys, values):
+    """
+    Return the S3 prefix of the partition folders holding the values of keys, or None if there is none
+    
+    Folder names are matched regardless of case, as the Glue crawler
+    lower-cases the partition keys of e.g. BILLING_PERIOD=YYYY-MM folders.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for key in keys:
+        folder = f"{key}={values[key]}/"
+        matches = [
+            common_prefix['Prefix']
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+            for common_prefix in page.get('CommonPrefixes', [])
+            if common_prefix['Prefix'][len(prefix):].lower() == folder
+        ]
+        if not matches:
+            return None
+        prefix = matches[0]
+    return prefix
+
+def report_cache_key(query, parameters, fingerprint):
+    """
+    Return the S3 key caching the results of a query over the fingerprinted data
+    """
+    normalized_query = ' '.join(query.split())
+    key = json.dumps([normalized_query, parameters, BILLING_PERIODS, fingerprint])
+    digest = hashlib.sha256(key.encode('utf-8'))
+    return f"{REPORT_CACHE_PREFIX}{digest.hexdigest()}.json"
+
+def load_cached_results(s3_client, cache_key):
+    """
+    Return the cached rows of a query, or None if they are not cached or can't be read
+    """
+    try:
+        response = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=cache_key)
+        return QueryResult.from_dict(json.load(response['Body']))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except (s3_client.exceptions.ClientError, ValueError, KeyError) as e:
+        # A miss only costs the query, so a denied, throttled or corrupt cache entry doesn't fail the report
+        print(f"Could not read the cached results under {cache_key}: {str(e)}")
+        return None
+
+def save_cached_results(s3_client, cache_key, result):
+    try:
+        body = json.dumps(result.to_dict(), default=str).encode('utf-8')
+        s3_client.put_object(Bucket=OUTPUT_BUCKET, Key=cache_key, Body=body)
+    except Exception as e:
+        # The report does not depend on the cache, so a failed write is only logged
+        print(f"Could not cache the results under {cache_key}: {str(e)}")
+
+def sql_string(value):
+    """
+    Return a value as an Athena string literal, for use as an execution parameter
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+def partition_values(billing_period):
+    """
+    Return the value of each known CUR partition key for a billing period (YYYY-MM-DD)
+    
+    CUR 2.0 exports are partitioned by BILLING_PERIOD=YYYY-MM folders, legacy
+    CUR exports by year=YYYY/month=M folders.
     """
-    Execute query 15 - Tagged vs. Untagged Resource Distribution by Service
+    period = datetime.date.fromisoformat(billing_period)
+    return {
+        'billing_period': f"{period.year}-{period.month:02d}",
+        'year': str(period.year),
+        'month': str(period.month),
+    }
+
+def sql_placeholders(count):
+    return ', '.join(['?'] * count)
+
+def billing_period_filter(partition_keys, billing_periods=None):
+    """
+    Return the SQL predicate selecting the billing periods, and its execution parameters
+    
+    The predicate on bill_billing_period_start_date is always kept for
+    correctness; the partition keys of the table that map to the billing
+    period add a predicate that lets Athena skip the other partitions.
     """
+    billing_periods = billing_periods or BILLING_PERIODS
+    predicates = [f"bill_billing_period_start_date IN ({', '.join(['CAST(? AS DATE)'] * len(billing_periods))})"]
+    parameters = [sql_string(period) for period in billing_periods]
+    
+    keys = [key for key in partition_keys if key.lower() in partition_values(billing_periods[0])]
+    if keys:
+        # One conjunction of the partition values per period, e.g. ("year" = ? AND "month" = ?)
+        conjunction = '(' + ' AND '.join(f'"{key}" = ?' for key in keys) + ')'
+        predicates.append('(' + ' OR '.join([conjunction] * len(billing_periods)) + ')')
+        for period in billing_periods:
+            values = partition_values(period)
+            parameters.extend(sql_string(values[key.lower()]) for key in keys)
+    return ' AND '.join(predicates), parameters
+
+def build_tagged_vs_untagged_query(partition_keys=()):
+    """
+    Query 15 - Tagged vs. Untagged Resource Distribution by Service
+    
+    One row per billing period, tag key and service. The CUR table is read
+    once: resources are aggregated first, with the tag keys they carry, and
+    only the aggregated resources are crossed with the tag keys to analyze.
+    """
+    period_filter, period_parameters = billing_period_filter(partition_keys)
     query = f"""
-    WITH tag_key_to_search AS (
-        SELECT '{TAG_KEY_TO_ANALYZE}' AS key
-    ),
-    resource_counts AS (
+    WITH resource_counts AS (
         SELECT
+            CAST(CAST(bill_billing_period_start_date AS DATE) AS VARCHAR) AS billing_period,
             line_item_product_code AS service,
             line_item_resource_id AS resource_id,
-            MAX(CASE WHEN CARDINALITY(MAP_KEYS(resource_tags)) > 0 THEN 1 ELSE 0 END) AS is_tagged,
-            MAX(CASE WHEN resource_tags[(SELECT key FROM tag_key_to_search)] IS NOT NULL 
-                     AND resource_tags[(SELECT key FROM tag_key_to_search)] <> '' 
-                     THEN 1 ELSE 0 END) AS has_specific_tag,
+            MAX(CASE WHEN CARDINALITY(resource_tags) > 0 THEN 1 ELSE 0 END) AS is_tagged,
+            -- The tag keys with a value on any line item of the resource
+            ARRAY_DISTINCT(FLATTEN(
+                ARRAY_AGG(FILTER(MAP_KEYS(resource_tags), k -> resource_tags[k] <> ''))
+                FILTER (WHERE resource_tags IS NOT NULL)
+            )) AS tag_keys,
             SUM(line_item_unblended_cost) AS resource_cost
-        FROM {DATABASE_NAME}.{TABLE_NAME}
+        FROM "{DATABASE_NAME}"."{TABLE_NAME}"
         WHERE
             line_item_resource_id <> '' AND
-            bill_billing_period_start_date = DATE '{BILLING_PERIOD}' AND
+            {period_filter} AND
             line_item_line_item_type != 'Credit' AND
             line_item_line_item_type != 'Refund' AND
             line_item_line_item_type = 'Usage' AND
             line_item_resource_id NOT LIKE '%management%' AND
             line_item_resource_id NOT LIKE '%overhead%'
-        GROUP BY 1, 2
+        GROUP BY 1, 2, 3
+    ),
+    resource_tag_keys AS (
+        SELECT
+            resource_counts.*,
+            tag_key,
+            CASE WHEN CONTAINS(tag_keys, tag_key) THEN 1 ELSE 0 END AS has_specific_tag
+        FROM resource_counts
+        CROSS JOIN UNNEST(ARRAY[{sql_placeholders(len(TAG_KEYS_TO_ANALYZE))}]) AS keys_to_analyze (tag_key)
     )
     SELECT
+        billing_period,
+        tag_key,
         service,
         COUNT(DISTINCT resource_id) AS total_resources,
         SUM(resource_cost) AS total_cost,
@@ -101,119 +390,379 @@ def run_tagged_vs_untagged_query(athena_client, s3_client):
         ROUND(100.0 * SUM(CASE WHEN has_specific_tag = 1 THEN 1 ELSE 0 END) / COUNT(DISTINCT resource_id), 2) AS specific_tag_resources_percent,
         SUM(CASE WHEN has_specific_tag = 1 THEN resource_cost ELSE 0 END) AS specific_tag_cost,
         ROUND(100.0 * SUM(CASE WHEN has_specific_tag = 1 THEN resource_cost ELSE 0 END) / SUM(resource_cost), 2) AS specific_tag_cost_percent
-    FROM resource_counts
-    GROUP BY 1
+    FROM resource_tag_keys
+    GROUP BY 1, 2, 3
     HAVING COUNT(DISTINCT resource_id) > 0
-    ORDER BY total_cost DESC
+    ORDER BY billing_period, tag_key, total_cost DESC
     """
     
-    return execute_athena_query(athena_client, s3_client, query, "tagged_vs_untagged")
+    # The parameters follow the order of the ? placeholders in the query
+    return query, period_parameters + [sql_string(key) for key in TAG_KEYS_TO_ANALYZE]
 
-def run_expensive_untagged_query(athena_client, s3_client):
+def build_expensive_untagged_query(partition_keys=()):
     """
-    Execute query for most expensive untagged resources
+    Query for the 50 most expensive untagged resources of each billing period
     """
+    period_filter, period_parameters = billing_period_filter(partition_keys)
     query = f"""
-    SELECT
-        line_item_product_code AS service,
-        line_item_resource_id AS resource_id,
-        product_region_code AS region,
-        product['instance_type'] AS instance_type,
-        product['product_name'] AS product_name,
-        line_item_usage_type AS usage_type,
-        SUM(line_item_unblended_cost) AS cost
-    FROM {DATABASE_NAME}.{TABLE_NAME}
-    WHERE
-        CARDINALITY(MAP_KEYS(resource_tags)) = 0 AND
-        line_item_resource_id <> '' AND
-        line_item_line_item_type = 'Usage' AND
-        bill_billing_period_start_date = DATE '{BILLING_PERIOD}' AND
-        line_item_resource_id NOT LIKE '%management%' AND
-        line_item_resource_id NOT LIKE '%overhead%'
-    GROUP BY 1, 2, 3, 4, 5, 6
-    HAVING SUM(line_item_unblended_cost) > 0
-    ORDER BY 7 DESC
-    LIMIT 50
-    """
-    
-    return execute_athena_query(athena_client, s3_client, query, "expensive_untagged")
-
-def execute_athena_query(athena_client, s3_client, query, query_name):
-    """
-    Execute an Athena query and wait for its completion
-    """
-    timestamp = int(time.time())
-    
-    # Start the query execution
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={
+    WITH untagged_costs AS (
+        SELECT
+            CAST(CAST(bill_billing_period_start_date AS DATE) AS VARCHAR) AS billing_period,
+            line_item_product_code AS service,
+            line_item_resource_id AS resource_id,
+            product_region_code AS region,
+            product['instance_type'] AS instance_type,
+            product['product_name'] AS product_name,
+            line_item_usage_type AS usage_type,
+            SUM(line_item_unblended_cost) AS cost
+        FROM "{DATABASE_NAME}"."{TABLE_NAME}"
+        WHERE
+            CARDINALITY(resource_tags) = 0 AND
+            line_item_resource_id <> '' AND
+            line_item_line_item_type = 'Usage' AND
+            {period_filter} AND
+            line_item_resource_id NOT LIKE '%management%' AND
+            line_item_resource_id NOT LIKE '%overhead%'
+        GROUP BY 1, 2, 3, 4, 5, 6, 7
+        HAVING SUM(line_item_unblended_cost) > 0
+    ),
+    ranked_costs AS (
+        SELECT
+            untagged_costs.*,
+            ROW_NUMBER() OVER (PARTITION BY billing_period ORDER BY cost DESC) AS cost_rank
+        FROM untagged_costs
+    )
+    SELECT billing_period, service, resource_id, region, instance_type, product_name, usage_type, cost
+    FROM ranked_costs
+    WHERE cost_rank <= 50
+    ORDER BY billing_period, cost DESC
+    """
+    
+    return query, period_parameters
+
+# The sections of the report, all queried in parallel. A new section only
+# needs its query builder registered here: it is called with the partition
+# keys of the table and returns the query and its execution parameters.
+REPORT_QUERIES = {
+    'tagged_vs_untagged': build_tagged_vs_untagged_query,
+    'expensive_untagged': build_expensive_untagged_query,
+}
+
+def start_athena_query(athena_client, query, query_name, parameters=None):
+    """
+    Start an Athena query execution and return its ID without waiting
+    
+    The values of the ? placeholders are passed as execution parameters,
+    Athena substitutes them instead of the query being built by string
+    interpolation.
+    """
+    request = {
+        'QueryString': query,
+        'QueryExecutionContext': {
             'Database': DATABASE_NAME
         },
-        WorkGroup=WORKGROUP
-    )
+        'WorkGroup': WORKGROUP
+    }
+    if parameters:
+        request['ExecutionParameters'] = parameters
+    if RESULT_REUSE_MAX_AGE_MINUTES > 0:
+        request['ResultReuseConfiguration'] = {
+            'ResultReuseByAgeConfiguration': {
+                'Enabled': True,
+                'MaxAgeInMinutes': RESULT_REUSE_MAX_AGE_MINUTES
+            }
+        }
+    response = athena_client.start_query_execution(**request)
     
     query_execution_id = response['QueryExecutionId']
-    print(f"Started query execution with ID: {query_execution_id}")
-    
-    # Wait for query to complete
-    state = 'RUNNING'
-    max_retries = 60  # 5 minutes with 5-second intervals
-    retry_count = 0
+    print(f"Started query {query_name} with execution ID: {query_execution_id}")
+    return query_execution_id
+
+def wait_for_queries(athena_client, query_execution_ids, deadline):
+    """
+    Wait until all the query executions succeeded, polling them together
     
-    while retry_count < max_retries and state in ['RUNNING', 'QUEUED']:
-        response = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-        state = response['QueryExecution']['Status']['State']
+    The poll interval doubles from POLL_INITIAL_SECONDS up to POLL_MAX_SECONDS,
+    so a query is noticed shortly after it finishes without flooding the API
+    while long ones run. Raises as soon as one of them fails, or when the
+    deadline has passed. Returns {query execution ID: query execution}.
+    """
+    pending = list(query_execution_ids)
+    finished = {}
+    interval = POLL_INITIAL_SECONDS
+    while pending:
+        # BatchGetQueryExecution accepts up to 50 IDs per call
+        executions = []
+        for start in range(0, len(pending), 50):
+            response = athena_client.batch_get_query_execution(QueryExecutionIds=pending[start:start + 50])
+            executions.extend(response['QueryExecutions'])
+        
+        for execution in executions:
+            state = execution['Status']['State']
+            if state in ['FAILED', 'CANCELLED']:
+                error_message = execution['Status'].get('StateChangeReason', 'Unknown error')
+                raise Exception(f"Query {execution['QueryExecutionId']} failed with state {state}: {error_message}")
+            if state == 'SUCCEEDED':
+                finished[execution['QueryExecutionId']] = execution
+        pending = [query_execution_id for query_execution_id in pending if query_execution_id not in finished]
+        if not pending:
+            break
         
-        if state in ['RUNNING', 'QUEUED']:
-            time.sleep(5)
-            retry_count += 1
-    
-    if state != 'SUCCEEDED':
-        error_message = response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown error')
-        raise Exception(f"Query failed with state {state}: {error_message}")
-    
-    # Get query results
-    result_key = f"{query_execution_id}.csv"
-    
-    # Read CSV from S3
-    response = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=result_key)
-    csv_content = response['Body'].read().decode('utf-8')
-    
-    # Parse CSV content using the csv module
-    csv_file = io.StringIO(csv_content)
-    csv_reader = csv.DictReader(csv_file)
-    
-    # Convert to list of dictionaries
-    results = []
-    for row in csv_reader:
-        # Convert numeric strings to appropriate types
-        processed_row = {}
-        for key, value in row.items():
-            # Try to convert to float or int if possible
-            try:
-                if '.' in value:
-                    processed_row[key] = float(value)
-                else:
-                    processed_row[key] = int(value)
-            except (ValueError, TypeError):
-                processed_row[key] = value
-        results.append(processed_row)
-    
-    return results
-
-def send_email_report(ses_client, tagged_vs_untagged_results, expensive_untagged_results):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"Queries {', '.join(pending)} did not finish before the deadline")
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, POLL_MAX_SECONDS)
+    
+    return finished
+
+def stop_queries(athena_client, query_execution_ids):
+    """
+    Cancel query executions that are no longer waited for, so they stop scanning
+    """
+    for query_execution_id in query_execution_ids:
+        try:
+            athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+        except Exception as e:
+            print(f"Could not stop query execution {query_execution_id}: {str(e)}")
+
+def parse_boolean(value):
+    return value == 'true'
+
+def parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value)
+
+# How each Athena column type is parsed from the CSV output. Types that are
+# not listed (varchar, char, json, arrays, maps, ...) are kept as strings.
+TYPE_CONVERTERS = {
+    'tinyint': int,
+    'smallint': int,
+    'integer': int,
+    'bigint': int,
+    'float': float,
+    'real': float,
+    'double': float,
+    'decimal': decimal.Decimal,
+    'boolean': parse_boolean,
+    'date': datetime.date.fromisoformat,
+    'timestamp': parse_timestamp,
+}
+# Types that JSON can't represent, written to the report cache as strings
+TEXT_ENCODED_TYPES = {'decimal', 'date', 'timestamp'}
+# Rows parsed per batch, converted one column at a time
+PARSE_BATCH_ROWS = 65536
+
+def column_converter(column_type):
+    """
+    Return the function parsing a CSV cell of an Athena column type, None for strings
+    """
+    convert = TYPE_CONVERTERS.get(column_type.lower())
+    if convert is None:
+        return None
+    
+    # Athena writes NULL as an empty field, which is only a value for strings
+    def convert_nullable(value):
+        return convert(value) if value else None
+    return convert_nullable
+
+class QueryResult:
+    """
+    Rows of a query result, held as one typed list per column
+    
+    Iterating or indexing yields the rows as dictionaries; column() gives
+    direct access to a whole column, e.g. to aggregate it.
+    """
+    
+    def __init__(self, columns, types, data):
+        self.columns = columns
+        self.types = types
+        self.data = data
+    
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+    
+    def __getitem__(self, index):
+        return {name: values[index] for name, values in zip(self.columns, self.data)}
+    
+    def __iter__(self):
+        for values in zip(*self.data):
+            yield dict(zip(self.columns, values))
+    
+    def column(self, name):
+        return self.data[self.columns.index(name)]
+    
+    def to_dict(self):
+        return {'columns': self.columns, 'types': self.types, 'data': self.data}
+    
+    @classmethod
+    def from_dict(cls, result):
+        data = result['data']
+        for index, column_type in enumerate(result['types']):
+            if column_type.lower() in TEXT_ENCODED_TYPES:
+                data[index] = list(map(column_converter(column_type), data[index]))
+        return cls(result['columns'], result['types'], data)
+
+def get_result_columns(athena_client, query_execution_id):
+    """
+    Return the names and types of the result columns from the ResultSetMetadata
+    """
+    response = athena_client.get_query_results(QueryExecutionId=query_execution_id, MaxResults=1)
+    column_info = response['ResultSet']['ResultSetMetadata']['ColumnInfo']
+    return [column['Name'] for column in column_info], [column['Type'] for column in column_info]
+
+def fetch_query_results(athena_client, s3_client, query_execution):
+    """
+    Read the results of a finished query execution into a QueryResult
+    
+    A converter is picked once per column from the Athena column types, then
+    each batch of rows is transposed and converted one whole column at a
+    time, instead of guessing the type of every cell.
+    """
+    columns, types = get_result_columns(athena_client, query_execution['QueryExecutionId'])
+    converters = [column_converter(column_type) for column_type in types]
+    data = [[] for _ in columns]
+    
+    rows = iter_query_results(s3_client, query_execution)
+    next(rows, None)  # The header, already known from the metadata
+    while True:
+        batch = list(itertools.islice(rows, PARSE_BATCH_ROWS))
+        if not batch:
+            break
+        for values, convert, raw_values in zip(data, converters, zip(*batch)):
+            values.extend(raw_values if convert is None else map(convert, raw_values))
+    
+    return QueryResult(columns, types, data)
+
+def iter_query_results(s3_client, query_execution):
+    """
+    Stream the rows of a finished query execution from its CSV output in S3
+    
+    The object body is decoded and parsed while it downloads, so only the
+    current row is held in memory instead of the whole file. Rows are lists
+    of strings, the first one being the header.
+    """
+    # The workgroup decides where the results go, so read the location from the execution
+    output_location = query_execution['ResultConfiguration']['OutputLocation']
+    bucket, key = output_location[len('s3://'):].split('/', 1)
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return csv.reader(io.TextIOWrapper(response['Body'], encoding='utf-8', newline=''))
+
+def column_total(rows, name):
+    return sum(row[name] for row in rows if row[name] is not None)
+
+def rows_by_value(result, name):
+    """
+    Group the rows of a query result on the value of one of its columns
+    """
+    groups = {}
+    for row in result:
+        groups.setdefault(row[name], []).append(row)
+    return groups
+
+def cell(value):
+    """
+    Return a value as HTML table cell content
+    """
+    return html.escape(str(value)) if value is not None else 'N/A'
+
+def send_email_report(ses_client, tagged_vs_untagged_results, expensive_untagged_results, s3_client=None):
     """
     Generate and send an email report with the query results
+    
+    The CSV files of the results are attached, gzip-compressed when they are
+    large; when the message would exceed MAX_MESSAGE_BYTES they are uploaded
+    to OUTPUT_BUCKET and linked with presigned URLs instead.
+    """
+    attachments = [
+        build_csv_attachment('tagged_vs_untagged.csv', tagged_vs_untagged_results),
+        build_csv_attachment('expensive_untagged.csv', expensive_untagged_results)
+    ]
+    attachments = [attachment for attachment in attachments if attachment is not None]
+    
+    # The size is the one of the encoded message, with base64 attachments, line breaks and MIME headers
+    html_body = render_html_report(tagged_vs_untagged_results, expensive_untagged_results)
+    raw_message = build_report_message(html_body, attachments).as_bytes()
+    if len(raw_message) > MAX_MESSAGE_BYTES:
+        s3_client = s3_client or boto3.client('s3')
+        links = [upload_report_file(s3_client, filename, content) for filename, content in attachments]
+        html_body = render_html_report(tagged_vs_untagged_results, expensive_untagged_results, links)
+        raw_message = build_report_message(html_body, []).as_bytes()
+    
+    # Send email
+    response = ses_client.send_raw_email(
+        Source=SENDER_EMAIL,
+        Destinations=RECIPIENT_EMAILS,
+        RawMessage={'Data': raw_message}
+    )
+    
+    print(f"Email sent! Message ID: {response['MessageId']}")
+    return response
+
+def build_report_message(html_body, attachments):
+    """
+    Return the MIME message of the report, with its (filename, bytes) attachments
     """
     # Create message container
     msg = MIMEMultipart()
-    msg['Subject'] = f'AWS Cost and Usage Report - Tagging Analysis ({BILLING_PERIOD})'
+    msg['Subject'] = f'AWS Cost and Usage Report - Tagging Analysis ({", ".join(BILLING_PERIODS)})'
     msg['From'] = SENDER_EMAIL
     msg['To'] = ', '.join(RECIPIENT_EMAILS)
     
-    # Create HTML email body
-    html_body = f"""
+    # Attach HTML part
+    msg.attach(MIMEText(html_body, 'html'))
+    
+    for filename, content in attachments:
+        attachment = MIMEApplication(content)
+        attachment['Content-Disposition'] = f'attachment; filename="{filename}"'
+        msg.attach(attachment)
+    return msg
+
+def build_csv_attachment(filename, result):
+    """
+    Return (filename, bytes) of a query result as CSV, or None if it has no rows
+    
+    The rows are written straight from the result's columns into the
+    output buffer, through gzip for results over ATTACHMENT_GZIP_ROWS rows.
+    """
+    if not len(result):
+        return None
+    
+    buffer = io.BytesIO()
+    compress = len(result) > ATTACHMENT_GZIP_ROWS
+    binary = gzip.GzipFile(filename=filename, mode='wb', fileobj=buffer) if compress else buffer
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(result.columns)
+    writer.writerows(zip(*result.data))
+    text.flush()
+    text.detach()
+    if compress:
+        binary.close()
+        filename += '.gz'
+    return filename, buffer.getvalue()
+
+def upload_report_file(s3_client, filename, content):
+    """
+    Upload a report file to OUTPUT_BUCKET and return (filename, presigned URL)
+    """
+    key = f"{REPORT_FILES_PREFIX}{datetime.datetime.now().strftime('%Y-%m-%dT%H%M%S')}/{filename}"
+    s3_client.put_object(Bucket=OUTPUT_BUCKET, Key=key, Body=content)
+    url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': OUTPUT_BUCKET, 'Key': key},
+        ExpiresIn=REPORT_LINK_EXPIRY_SECONDS
+    )
+    print(f"Report file {filename} is too large to attach, uploaded to s3://{OUTPUT_BUCKET}/{key}")
+    return filename, url
+
+def render_html_report(tagged_vs_untagged_results, expensive_untagged_results, links=()):
+    """
+    Render the HTML body of the report
+    
+    The parts are appended to a list and joined once at the end, instead of
+    growing one string, which copies the whole body on every row.
+    """
+    parts = [f"""
     <html>
     <head>
         <style>
@@ -247,143 +796,158 @@ def send_email_report(ses_client, tagged_vs_untagged_results, expensive_untagged
     </head>
     <body>
         <h1>AWS Cost and Usage Report - Tagging Analysis</h1>
-        <p>Billing Period: {BILLING_PERIOD}</p>
-        <p>Tag Key Analyzed: {TAG_KEY_TO_ANALYZE}</p>
-        
-        <h2>1. Tagged vs. Untagged Resources by Service</h2>
-    """
-    
-    # Calculate overall tagging metrics
-    total_resources = sum(int(item.get('total_resources', 0)) for item in tagged_vs_untagged_results)
-    total_cost = sum(float(item.get('total_cost', 0)) for item in tagged_vs_untagged_results)
-    tagged_resources = sum(int(item.get('tagged_resources', 0)) for item in tagged_vs_untagged_results)
-    tagged_cost = sum(float(item.get('tagged_cost', 0)) for item in tagged_vs_untagged_results)
-    untagged_resources = sum(int(item.get('untagged_resources', 0)) for item in tagged_vs_untagged_results)
-    untagged_cost = sum(float(item.get('untagged_cost', 0)) for item in tagged_vs_untagged_results)
-    
-    # Add summary section
-    tagged_resources_percent = round(100.0 * tagged_resources / total_resources, 2) if total_resources > 0 else 0
-    tagged_cost_percent = round(100.0 * tagged_cost / total_cost, 2) if total_cost > 0 else 0
-    
-    html_body += f"""
-        <div class="summary">
-            <h3>Overall Tagging Summary</h3>
-            <p>Total Resources: {total_resources} | Total Cost: ${total_cost:.2f}</p>
-            <p>Tagged Resources: {tagged_resources} ({tagged_resources_percent}%) | Tagged Cost: ${tagged_cost:.2f} ({tagged_cost_percent}%)</p>
-            <p>Untagged Resources: {untagged_resources} ({100-tagged_resources_percent:.2f}%) | Untagged Cost: ${untagged_cost:.2f} ({100-tagged_cost_percent:.2f}%)</p>
-            <p class="warning">Note: {untagged_resources} resources costing ${untagged_cost:.2f} are missing tags!</p>
-        </div>
-    """
-    
-    html_body += """
-        <h3>Tagging Details by Service</h3>
-        <table>
-            <tr>
-                <th>Service</th>
-                <th>Total Resources</th>
-                <th>Total Cost ($)</th>
-                <th>Tagged Resources</th>
-                <th>Tagged %</th>
-                <th>Tagged Cost ($)</th>
-                <th>Tagged Cost %</th>
-                <th>Untagged Resources</th>
-                <th>Untagged %</th>
-                <th>Untagged Cost ($)</th>
-                <th>Untagged Cost %</th>
-            </tr>
-    """
-    
-    # Add rows for tagged vs untagged services
-    for item in tagged_vs_untagged_results:
-        html_body += f"""
-            <tr>
-                <td>{item.get('service', 'N/A')}</td>
-                <td>{item.get('total_resources', 'N/A')}</td>
-                <td>{float(item.get('total_cost', 0)):.2f}</td>
-                <td>{item.get('tagged_resources', 'N/A')}</td>
-                <td>{item.get('tagged_resources_percent', 'N/A')}%</td>
-                <td>{float(item.get('tagged_cost', 0)):.2f}</td>
-                <td>{item.get('tagged_cost_percent', 'N/A')}%</td>
-                <td>{item.get('untagged_resources', 'N/A')}</td>
-                <td>{item.get('untagged_resources_percent', 'N/A')}%</td>
-                <td>{float(item.get('untagged_cost', 0)):.2f}</td>
-                <td>{item.get('untagged_cost_percent', 'N/A')}%</td>
-            </tr>
-        """
+        <p>Billing Periods: {cell(', '.join(BILLING_PERIODS))}</p>
+        <p>Tag Keys Analyzed: {cell(', '.join(TAG_KEYS_TO_ANALYZE))}</p>
+    """]
     
-    # Add expensive untagged resources section
-    html_body += """
-        </table>
+    tagged_by_period = rows_by_value(tagged_vs_untagged_results, 'billing_period')
+    expensive_by_period = rows_by_value(expensive_untagged_results, 'billing_period')
+    for billing_period in BILLING_PERIODS:
+        rows_by_tag_key = {}
+        for item in tagged_by_period.get(billing_period, []):
+            rows_by_tag_key.setdefault(item['tag_key'], []).append(item)
+        # Apart from the specific tag metrics, the rows are the same for every tag key
+        service_rows = rows_by_tag_key.get(TAG_KEYS_TO_ANALYZE[0], [])
         
-        <h2>2. Most Expensive Untagged Resources</h2>
-        <table>
-            <tr>
-                <th>Service</th>
-                <th>Resource ID</th>
-                <th>Product Name</th>
-                <th>Region</th>
-                <th>Usage Type</th>
-                <th>Cost ($)</th>
-            </tr>
-    """
-    
-    # Add rows for expensive untagged resources
-    for item in expensive_untagged_results:
-        html_body += f"""
-            <tr>
-                <td>{item.get('service', 'N/A')}</td>
-                <td>{item.get('resource_id', 'N/A')}</td>
-                <td>{item.get('product_name', 'N/A')}</td>
-                <td>{item.get('region', 'N/A')}</td>
-                <td>{item.get('usage_type', 'N/A')}</td>
-                <td>{float(item.get('cost', 0)):.2f}</td>
-            </tr>
-        """
-    html_body += "</table>"
-    
-    html_body += """
-        <p>This report was automatically generated. Please do not reply to this email.</p>
-    </body>
-    </html>
-    """
-    
-    # Attach HTML part
-    part = MIMEText(html_body, 'html')
-    msg.attach(part)
-    
-    # Generate CSV attachments
-    csv_attachments = [
-        ('tagged_vs_untagged.csv', tagged_vs_untagged_results),
-        ('expensive_untagged.csv', expensive_untagged_results)
-    ]
-    
-    for filename, data in csv_attachments:
-        if not data:
-            continue
+        # Calculate overall tagging metrics
+        total_resources = column_total(service_rows, 'total_resources')
+        total_cost = column_total(service_rows, 'total_cost')
+        tagged_resources = column_total(service_rows, 'tagged_resources')
+        tagged_cost = column_total(service_rows, 'tagged_cost')
+        untagged_resources = column_total(service_rows, 'untagged_resources')
+        untagged_cost = column_total(service_rows, 'untagged_cost')
+        tagged_resources_percent = round(100.0 * tagged_resources / total_resources, 2) if total_resources > 0 else 0
+        tagged_cost_percent = round(100.0 * tagged_cost / total_cost, 2) if total_cost > 0 else 0
+        
+        parts.append(f"""
+        <h2>Billing Period {cell(billing_period)}</h2>
+        
+        <h3>1. Tagged vs. Untagged Resources by Service</h3>
+            <div class="summary">
+                <h3>Overall Tagging Summary</h3>
+                <p>Total Resources: {total_resources} | Total Cost: ${total_cost:.2f}</p>
+                <p>Tagged Resources: {tagged_resources} ({tagged_resources_percent}%) | Tagged Cost: ${tagged_cost:.2f} ({tagged_cost_percent}%)</p>
+                <p>Untagged Resources: {untagged_resources} ({100-tagged_resources_percent:.2f}%) | Untagged Cost: ${untagged_cost:.2f} ({100-tagged_cost_percent:.2f}%)</p>
+                <p class="warning">Note: {untagged_resources} resources costing ${untagged_cost:.2f} are missing tags!</p>
+            </div>
             
-        # Create CSV content using the csv module
-        output = io.StringIO()
-        if data:
-            fieldnames = data[0].keys()
-            writer = csv.DictWriter(output, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(data)
+            <h3>Tagging Details by Service</h3>
+            <table>
+                <tr>
+                    <th>Service</th>
+                    <th>Total Resources</th>
+                    <th>Total Cost ($)</th>
+                    <th>Tagged Resources</th>
+                    <th>Tagged %</th>
+                    <th>Tagged Cost ($)</th>
+                    <th>Tagged Cost %</th>
+                    <th>Untagged Resources</th>
+                    <th>Untagged %</th>
+                    <th>Untagged Cost ($)</th>
+                    <th>Untagged Cost %</th>
+                </tr>
+        """)
+        
+        # Add rows for tagged vs untagged services
+        for item in service_rows:
+            parts.append(f"""
+                <tr>
+                    <td>{cell(item['service'])}</td>
+                    <td>{cell(item['total_resources'])}</td>
+                    <td>{float(item['total_cost'] or 0):.2f}</td>
+                    <td>{cell(item['tagged_resources'])}</td>
+                    <td>{cell(item['tagged_resources_percent'])}%</td>
+                    <td>{float(item['tagged_cost'] or 0):.2f}</td>
+                    <td>{cell(item['tagged_cost_percent'])}%</td>
+                    <td>{cell(item['untagged_resources'])}</td>
+                    <td>{cell(item['untagged_resources_percent'])}%</td>
+                    <td>{float(item['untagged_cost'] or 0):.2f}</td>
+                    <td>{cell(item['untagged_cost_percent'])}%</td>
+                </tr>
+            """)
+        
+        # Add the coverage of each analyzed tag key
+        parts.append("""
+            </table>
             
-        # Attach CSV
-        attachment = MIMEApplication(output.getvalue().encode('utf-8'))
-        attachment['Content-Disposition'] = f'attachment; filename="{filename}"'
-        msg.attach(attachment)
+            <h3>2. Resources Carrying Each Tag Key</h3>
+            <table>
+                <tr>
+                    <th>Tag Key</th>
+                    <th>Resources</th>
+                    <th>Resources %</th>
+                    <th>Cost ($)</th>
+                    <th>Cost %</th>
+                </tr>
+        """)
+        for tag_key in TAG_KEYS_TO_ANALYZE:
+            tag_key_rows = rows_by_tag_key.get(tag_key, [])
+            tag_resources = column_total(tag_key_rows, 'resources_with_specific_tag')
+            tag_cost = column_total(tag_key_rows, 'specific_tag_cost')
+            parts.append(f"""
+                <tr>
+                    <td>{cell(tag_key)}</td>
+                    <td>{tag_resources}</td>
+                    <td>{round(100.0 * tag_resources / total_resources, 2) if total_resources > 0 else 0}%</td>
+                    <td>{float(tag_cost):.2f}</td>
+                    <td>{round(100.0 * float(tag_cost) / float(total_cost), 2) if total_cost > 0 else 0}%</td>
+                </tr>
+            """)
+        
+        # Add expensive untagged resources section
+        parts.append("""
+            </table>
+            
+            <h3>3. Most Expensive Untagged Resources</h3>
+            <table>
+                <tr>
+                    <th>Service</th>
+                    <th>Resource ID</th>
+                    <th>Product Name</th>
+                    <th>Region</th>
+                    <th>Usage Type</th>
+                    <th>Cost ($)</th>
+                </tr>
+        """)
+        
+        # Add rows for expensive untagged resources
+        for item in expensive_by_period.get(billing_period, []):
+            parts.append(f"""
+                <tr>
+                    <td>{cell(item['service'])}</td>
+                    <td>{cell(item['resource_id'])}</td>
+                    <td>{cell(item['product_name'])}</td>
+                    <td>{cell(item['region'])}</td>
+                    <td>{cell(item['usage_type'])}</td>
+                    <td>{float(item['cost'] or 0):.2f}</td>
+                </tr>
+            """)
+        parts.append("</table>")
     
-    # Send email
-    response = ses_client.send_raw_email(
-        Source=SENDER_EMAIL,
-        Destinations=RECIPIENT_EMAILS,
-        RawMessage={'Data': msg.as_string()}
-    )
+    if links:
+        parts.append("""
+        <h2>Report Files</h2>
+        <p>The result files are too large to be attached. Download them here (the links expire):</p>
+        <ul>
+        """)
+        for filename, url in links:
+            parts.append(f'<li><a href="{html.escape(url)}">{cell(filename)}</a></li>')
+        parts.append("</ul>")
     
-    print(f"Email sent! Message ID: {response['MessageId']}")
-    return response
+    parts.append("""
+        <p>This report was automatically generated. Please do not reply to this email.</p>
+    </body>
+    </html>
+    """)
+    return ''.join(parts)
 
 if __name__ == "__main__":
     # For local testing
-    lambda_handler({}, None) 
\ No newline at end of file
+    if QUERY_BACKEND == 'local':
+        # Render the report of the local CUR files without sending it
+        results = run_report_queries(create_backend(), REPORT_QUERIES, query_deadline(None))
+        with open('report.html', 'w') as report_file:
+            report_file.write(render_html_report(results['tagged_vs_untagged'], results['expensive_untagged']))
+        print("Report written to report.html")
+    else:
+        lambda_handler({}, None) 
\ No newline at end of file
@@ -45,4 +45,7 @@ locals {
   # Docker image config
   ecr_repository_name = "${local.name}-lambda-image"
   tag_key_to_analyze  = "<the-tag-key-to-analyze>"
+
+  # Athena returns the results of an identical query run within this many minutes (0 disables)
+  result_reuse_max_age_minutes = 60
 }
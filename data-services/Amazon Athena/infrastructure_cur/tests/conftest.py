@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The function code is deployed flat from lambdas/, so import it the same way here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas"))
+
+os.environ.setdefault("DATABASE_NAME", "cur_db")
+os.environ.setdefault("TABLE_NAME", "cur_data")
+os.environ.setdefault("OUTPUT_BUCKET", "query-results")
@@ -0,0 +1,582 @@
+import csv
+import datetime
+import decimal
+import email
+import gzip
+import io
+import itertools
+import json
+import time
+
+import pytest
+
+import untagged_resources_reporter as reporter
+
+MAY = datetime.datetime(2024, 5, 1)
+APRIL = datetime.datetime(2024, 4, 1)
+
+LINE_ITEMS = [
+    # Tagged with "team", on two line items
+    {"bill_billing_period_start_date": MAY, "line_item_product_code": "AmazonEC2", "line_item_resource_id": "i-tagged",
+     "line_item_line_item_type": "Usage", "line_item_unblended_cost": 10.0, "resource_tags": {"team": "data"}},
+    {"bill_billing_period_start_date": MAY, "line_item_product_code": "AmazonEC2", "line_item_resource_id": "i-tagged",
+     "line_item_line_item_type": "Usage", "line_item_unblended_cost": 5.0, "resource_tags": {"team": "data"}},
+    # Untagged
+    {"bill_billing_period_start_date": MAY, "line_item_product_code": "AmazonEC2", "line_item_resource_id": "i-untagged",
+     "line_item_line_item_type": "Usage", "line_item_unblended_cost": 3.0, "resource_tags": {},
+     "product_region_code": "eu-central-1", "line_item_usage_type": "BoxUsage",
+     "product": {"instance_type": "m5.large", "product_name": "Amazon Elastic Compute Cloud"}},
+    # Tagged, but with an empty "team" value
+    {"bill_billing_period_start_date": MAY, "line_item_product_code": "AmazonS3", "line_item_resource_id": "my.bucket",
+     "line_item_line_item_type": "Usage", "line_item_unblended_cost": 2.0, "resource_tags": {"team": ""}},
+    # Excluded: credits and management resources
+    {"bill_billing_period_start_date": MAY, "line_item_product_code": "AmazonEC2", "line_item_resource_id": "i-untagged",
+     "line_item_line_item_type": "Credit", "line_item_unblended_cost": -2.0, "resource_tags": {}},
+    {"bill_billing_period_start_date": MAY, "line_item_product_code": "AmazonEC2", "line_item_resource_id": "management-1",
+     "line_item_line_item_type": "Usage", "line_item_unblended_cost": 7.0, "resource_tags": {}},
+    # Another billing period
+    {"bill_billing_period_start_date": APRIL, "line_item_product_code": "AmazonEC2", "line_item_resource_id": "i-tagged",
+     "line_item_line_item_type": "Usage", "line_item_unblended_cost": 1.0, "resource_tags": {"owner": "alice"}},
+]
+
+
+@pytest.fixture()
+def backend(tmp_path, monkeypatch):
+    # Only the DuckDB-backed tests need duckdb, the Athena ones run on stubs
+    pytest.importorskip("duckdb")
+    import local_backend
+
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-05-01", "2024-04-01"])
+    monkeypatch.setattr(reporter, "TAG_KEYS_TO_ANALYZE", ["team", "owner"])
+    local_backend.write_cur_files(str(tmp_path), LINE_ITEMS)
+    return local_backend.DuckDBBackend(str(tmp_path))
+
+
+def run_report(backend):
+    return reporter.run_report_queries(backend, reporter.REPORT_QUERIES, time.monotonic() + 60)
+
+
+def test_tagged_vs_untagged_for_every_period_and_tag_key(backend):
+    rows = {(row["billing_period"], row["tag_key"], row["service"]): row for row in run_report(backend)["tagged_vs_untagged"]}
+
+    ec2_team = rows[("2024-05-01", "team", "AmazonEC2")]
+    assert (ec2_team["total_resources"], ec2_team["total_cost"]) == (2, 18.0)
+    assert (ec2_team["tagged_resources"], ec2_team["tagged_cost"]) == (1, 15.0)
+    assert (ec2_team["untagged_resources"], ec2_team["untagged_cost"]) == (1, 3.0)
+    assert (ec2_team["resources_with_specific_tag"], ec2_team["specific_tag_cost"]) == (1, 15.0)
+    assert rows[("2024-05-01", "owner", "AmazonEC2")]["resources_with_specific_tag"] == 0
+    # An empty tag value does not count as carrying the tag
+    assert rows[("2024-05-01", "team", "AmazonS3")]["tagged_resources"] == 1
+    assert rows[("2024-05-01", "team", "AmazonS3")]["resources_with_specific_tag"] == 0
+    assert rows[("2024-04-01", "owner", "AmazonEC2")]["resources_with_specific_tag"] == 1
+    assert len(rows) == 6
+
+
+def test_expensive_untagged_resources(backend):
+    result = run_report(backend)["expensive_untagged"]
+
+    assert list(result) == [{
+        "billing_period": "2024-05-01", "service": "AmazonEC2", "resource_id": "i-untagged", "region": "eu-central-1",
+        "instance_type": "m5.large", "product_name": "Amazon Elastic Compute Cloud", "usage_type": "BoxUsage", "cost": 3.0,
+    }]
+
+
+def test_partition_predicates_select_the_billing_periods(backend, monkeypatch):
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-04-01"])
+    query, parameters = reporter.build_tagged_vs_untagged_query(backend.partition_keys())
+
+    assert backend.partition_keys() == ["billing_period"]
+    assert '"billing_period" = ?' in query
+    assert query.count("?") == len(parameters)
+    assert {row["billing_period"] for row in run_report(backend)["tagged_vs_untagged"]} == {"2024-04-01"}
+
+
+def tagged_vs_untagged_result(rows):
+    """ Query 15 rows from (period, tag key, service, resources, cost, tagged resources, tagged cost, with tag, with tag cost) """
+    results = []
+    for period, tag_key, service, resources, cost, tagged, tagged_cost, specific, specific_cost in rows:
+        results.append({
+            "billing_period": period, "tag_key": tag_key, "service": service,
+            "total_resources": resources, "total_cost": cost,
+            "tagged_resources": tagged, "tagged_resources_percent": round(100.0 * tagged / resources, 2),
+            "tagged_cost": tagged_cost, "tagged_cost_percent": round(100.0 * tagged_cost / cost, 2),
+            "untagged_resources": resources - tagged, "untagged_resources_percent": round(100.0 * (resources - tagged) / resources, 2),
+            "untagged_cost": cost - tagged_cost, "untagged_cost_percent": round(100.0 * (cost - tagged_cost) / cost, 2),
+            "resources_with_specific_tag": specific, "specific_tag_cost": specific_cost,
+        })
+    columns = list(results[0])
+    return reporter.QueryResult(columns, ["varchar"] * len(columns), [[row[name] for row in results] for name in columns])
+
+
+def test_every_tag_key_and_period_is_reported_from_one_scan(monkeypatch):
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-05-01", "2024-04-01"])
+    monkeypatch.setattr(reporter, "TAG_KEYS_TO_ANALYZE", ["team", "owner"])
+    tagged = tagged_vs_untagged_result([
+        ("2024-05-01", "team", "AmazonEC2", 4, 40.0, 3, 30.0, 2, 25.0),
+        ("2024-05-01", "owner", "AmazonEC2", 4, 40.0, 3, 30.0, 1, 5.0),
+        ("2024-04-01", "team", "AmazonEC2", 2, 8.0, 0, 0.0, 0, 0.0),
+        ("2024-04-01", "owner", "AmazonEC2", 2, 8.0, 0, 0.0, 0, 0.0),
+    ])
+    expensive = reporter.QueryResult(["billing_period"], ["varchar"], [[]])
+
+    query, _ = reporter.build_tagged_vs_untagged_query()
+    html_body = reporter.render_html_report(tagged, expensive)
+
+    assert query.count('FROM "cur_db"."cur_data"') == 1
+    may, april = " ".join(html_body.split()).split("Billing Period 2024-04-01")
+    # The service totals are counted once per period, not once per tag key
+    assert "Total Resources: 4 | Total Cost: $40.00" in may
+    assert "Total Resources: 2 | Total Cost: $8.00" in april
+    assert "<td>team</td> <td>2</td> <td>50.0%</td>" in may
+    assert "<td>owner</td> <td>1</td> <td>25.0%</td>" in may
+
+
+def test_legacy_partitions_are_pruned_by_year_and_month(monkeypatch):
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-05-01", "2023-12-01"])
+
+    predicate, parameters = reporter.billing_period_filter(["year", "month", "line_item_usage_account_id"])
+
+    assert '("year" = ? AND "month" = ?) OR ("year" = ? AND "month" = ?)' in predicate
+    assert "line_item_usage_account_id" not in predicate
+    assert parameters == ["'2024-05-01'", "'2023-12-01'", "'2024'", "'5'", "'2023'", "'12'"]
+
+
+def test_unpartitioned_table_filters_on_the_billing_period_only(monkeypatch):
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-05-01"])
+
+    predicate, parameters = reporter.billing_period_filter([])
+
+    assert predicate == "bill_billing_period_start_date IN (CAST(? AS DATE))"
+    assert parameters == ["'2024-05-01'"]
+
+
+@pytest.mark.parametrize("build_query", list(reporter.REPORT_QUERIES.values()))
+def test_query_values_are_execution_parameters(monkeypatch, build_query):
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-05-01", "2024-04-01"])
+    monkeypatch.setattr(reporter, "TAG_KEYS_TO_ANALYZE", ["team", "cost'center"])
+    athena = StubAthena()
+
+    query, parameters = build_query(["billing_period"])
+    reporter.start_athena_query(athena, query, "report", parameters)
+
+    # No value is interpolated into the query, a quote in a tag key is escaped in its literal
+    assert "cost'center" not in query and "2024-05" not in query
+    assert query.count("?") == len(parameters)
+    assert athena.started[0][1]["ExecutionParameters"] == parameters
+    if "tag_key" in query:
+        assert parameters[-2:] == ["'team'", "'cost''center'"]
+
+
+def test_report_renders_every_period(backend):
+    results = run_report(backend)
+
+    html_body = reporter.render_html_report(results["tagged_vs_untagged"], results["expensive_untagged"])
+
+    assert "Billing Period 2024-05-01" in html_body and "Billing Period 2024-04-01" in html_body
+    assert "i-untagged" in html_body
+
+
+class StubAthena:
+    """ Local stand-in for Athena, every query finishing after `polls` status checks """
+
+    def __init__(self, polls=1, failing=()):
+        self.polls = polls
+        self.failing = set(failing)
+        self.started = []
+        self.stopped = []
+        self.checks = 0
+        self._ids = itertools.count()
+
+    def start_query_execution(self, QueryString, QueryExecutionContext, WorkGroup, **kwargs):
+        query_execution_id = "q{}".format(next(self._ids))
+        self.started.append((query_execution_id, kwargs))
+        return {"QueryExecutionId": query_execution_id}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.checks += 1
+        executions = []
+        for query_execution_id in QueryExecutionIds:
+            status = {"State": "RUNNING" if self.checks < self.polls else "SUCCEEDED"}
+            if query_execution_id in self.failing:
+                status = {"State": "FAILED", "StateChangeReason": "COLUMN_NOT_FOUND"}
+            executions.append({
+                "QueryExecutionId": query_execution_id,
+                "Status": status,
+                "ResultConfiguration": {"OutputLocation": "s3://query-results/{}.csv".format(query_execution_id)},
+                "Statistics": {"DataScannedInBytes": 1024, "EngineExecutionTimeInMillis": 10},
+            })
+        return {"QueryExecutions": executions}
+
+    def get_query_results(self, QueryExecutionId, MaxResults):
+        column_info = [{"Name": "resource_id", "Type": "varchar"}, {"Name": "cost", "Type": "double"},
+                       {"Name": "resources", "Type": "bigint"}]
+        return {"ResultSet": {"ResultSetMetadata": {"ColumnInfo": column_info}}}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.stopped.append(QueryExecutionId)
+
+
+class StubS3:
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(b'"resource_id","cost","resources"\n"my.bucket","1.5","2"\n"000123","",""\n')}
+
+
+def test_athena_queries_are_submitted_together(monkeypatch):
+    monkeypatch.setattr(reporter, "POLL_INITIAL_SECONDS", 0.001)
+    athena = StubAthena(polls=3)
+    backend = reporter.AthenaBackend(athena, StubS3(), glue_client=None)
+
+    results = backend.run_queries({"a": ("SELECT 1", None), "b": ("SELECT ?", ["'x'"])}, time.monotonic() + 5)
+
+    # Both queries are polled together, so 3 checks in all and not 3 per query
+    assert [query_execution_id for query_execution_id, _ in athena.started] == ["q0", "q1"]
+    assert athena.checks == 3
+    assert athena.started[1][1]["ExecutionParameters"] == ["'x'"]
+    assert set(results) == {"a", "b"}
+
+
+def test_failed_athena_query_stops_the_others(monkeypatch):
+    monkeypatch.setattr(reporter, "POLL_INITIAL_SECONDS", 0.001)
+    athena = StubAthena(polls=5, failing=["q1"])
+    backend = reporter.AthenaBackend(athena, StubS3(), glue_client=None)
+
+    with pytest.raises(Exception, match="q1 failed"):
+        backend.run_queries({"a": ("SELECT 1", None), "b": ("SELECT 2", None)}, time.monotonic() + 5)
+    assert athena.stopped == ["q0", "q1"]
+
+
+def test_failed_query_raises_with_its_reason():
+    athena = StubAthena(failing=["q0"])
+    backend = reporter.AthenaBackend(athena, StubS3(), glue_client=None)
+
+    with pytest.raises(Exception, match="q0 failed with state FAILED: COLUMN_NOT_FOUND"):
+        backend.run_queries({"a": ("SELECT 1", None)}, time.monotonic() + 5)
+    assert athena.stopped == ["q0"]
+
+
+def test_query_past_the_deadline_is_stopped(monkeypatch):
+    sleeps = []
+    athena = StubAthena(polls=100)
+    deadline = time.monotonic() + 5
+    # Every poll takes the clock past the deadline
+    monkeypatch.setattr(reporter.time, "sleep", sleeps.append)
+    monkeypatch.setattr(reporter.time, "monotonic", iter([deadline - 0.01, deadline + 1]).__next__)
+
+    with pytest.raises(Exception, match="q0 did not finish before the deadline"):
+        reporter.wait_for_queries(athena, ["q0"], deadline)
+    # The last sleep is cut short to end at the deadline
+    assert sleeps == [pytest.approx(0.01)]
+    assert athena.checks == 2
+
+
+def test_poll_interval_backs_off_up_to_the_cap(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(reporter, "POLL_INITIAL_SECONDS", 0.05)
+    monkeypatch.setattr(reporter, "POLL_MAX_SECONDS", 0.3)
+    monkeypatch.setattr(reporter.time, "sleep", sleeps.append)
+    athena = StubAthena(polls=7)
+
+    executions = reporter.wait_for_queries(athena, ["q0"], time.monotonic() + 60)
+
+    assert sleeps == [0.05, 0.1, 0.2, 0.3, 0.3, 0.3]
+    assert executions["q0"]["Status"]["State"] == "SUCCEEDED"
+
+
+def test_result_rows_are_streamed_from_the_csv_output():
+    execution = {"QueryExecutionId": "q0", "ResultConfiguration": {"OutputLocation": "s3://query-results/q0.csv"}}
+
+    rows = reporter.iter_query_results(StubS3(), execution)
+
+    assert next(rows) == ["resource_id", "cost", "resources"]
+    assert list(rows) == [["my.bucket", "1.5", "2"], ["000123", "", ""]]
+
+
+class StubBucket:
+    """ In-memory S3 bucket holding the CUR files and the report cache """
+
+    class exceptions:
+        class ClientError(Exception):
+            pass
+
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self, etags=()):
+        self.etags = dict(etags)
+        self.objects = {}
+        self.errors = {}
+        self.listed = []
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        keys = [key for key in self.etags if key.startswith(Prefix)]
+        self.listed.append(Prefix)
+        if Delimiter:
+            names = {key[len(Prefix):].split(Delimiter, 1)[0] for key in keys if Delimiter in key[len(Prefix):]}
+            folders = [Prefix + name + Delimiter for name in sorted(names)]
+            return [{"CommonPrefixes": [{"Prefix": folder} for folder in folders]}]
+        return [{"Contents": [{"Key": key, "ETag": self.etags[key]} for key in keys]}]
+
+    def get_object(self, Bucket, Key):
+        if Key in self.errors:
+            raise self.errors[Key]
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+
+class StubGlue:
+    def __init__(self, table):
+        self.table = table
+
+    def get_table(self, DatabaseName, Name):
+        return {"Table": self.table}
+
+
+class StubSES:
+    def send_raw_email(self, Source, Destinations, RawMessage):
+        self.message = email.message_from_bytes(RawMessage["Data"])
+        return {"MessageId": "m0"}
+
+
+CUR_TABLE = {
+    "UpdateTime": "2024-05-02 10:00:00", "StorageDescriptor": {"Location": "s3://cur-bucket/cur/data/"},
+    "PartitionKeys": [{"Name": "billing_period", "Type": "string"}],
+}
+CUR_ETAGS = {
+    "cur/data/BILLING_PERIOD=2024-05/part-0.parquet": '"etag-0"',
+    "cur/data/BILLING_PERIOD=2024-04/part-0.parquet": '"etag-1"',
+}
+
+
+@pytest.fixture()
+def may_report(monkeypatch):
+    monkeypatch.setattr(reporter, "BILLING_PERIODS", ["2024-05-01"])
+
+
+def test_cached_results_skip_athena(monkeypatch, may_report):
+    monkeypatch.setattr(reporter, "POLL_INITIAL_SECONDS", 0.001)
+    bucket = StubBucket(CUR_ETAGS)
+    fingerprint = reporter.table_fingerprint(CUR_TABLE, bucket)
+
+    athena = StubAthena()
+    backend = reporter.AthenaBackend(athena, StubS3(), StubGlue(CUR_TABLE))
+    first = reporter.run_report_queries(backend, reporter.REPORT_QUERIES, time.monotonic() + 5, fingerprint, bucket)
+    assert len(athena.started) == 2 and len(bucket.objects) == 2
+
+    athena = StubAthena()
+    backend = reporter.AthenaBackend(athena, StubS3(), StubGlue(CUR_TABLE))
+    second = reporter.run_report_queries(backend, reporter.REPORT_QUERIES, time.monotonic() + 5, fingerprint, bucket)
+    assert athena.started == [] and athena.checks == 0
+    assert {name: list(result) for name, result in second.items()} == {name: list(result) for name, result in first.items()}
+
+
+def test_changed_cur_data_changes_the_cache_key(may_report):
+    query, parameters = reporter.build_expensive_untagged_query()
+    fingerprint = reporter.table_fingerprint(CUR_TABLE, StubBucket(CUR_ETAGS))
+    key = reporter.report_cache_key(query, parameters, fingerprint)
+
+    # Rewritten files of the billing period, or a changed table definition
+    rewritten = reporter.table_fingerprint(CUR_TABLE, StubBucket(dict(CUR_ETAGS, **{
+        "cur/data/BILLING_PERIOD=2024-05/part-0.parquet": '"etag-2"'
+    })))
+    altered = reporter.table_fingerprint(dict(CUR_TABLE, UpdateTime="2024-05-03 10:00:00"), StubBucket(CUR_ETAGS))
+
+    assert key.startswith(reporter.REPORT_CACHE_PREFIX)
+    assert reporter.report_cache_key(" ".join(query.split()), parameters, fingerprint) == key
+    assert reporter.report_cache_key(query, parameters, rewritten) != key
+    assert reporter.report_cache_key(query, parameters, altered) != key
+
+
+def test_only_the_queried_billing_periods_are_fingerprinted(may_report):
+    bucket = StubBucket(CUR_ETAGS)
+    fingerprint = reporter.table_fingerprint(CUR_TABLE, bucket)
+    other_period = StubBucket(dict(CUR_ETAGS, **{"cur/data/BILLING_PERIOD=2024-04/part-0.parquet": '"etag-2"'}))
+    legacy_table = dict(CUR_TABLE, PartitionKeys=[{"Name": "year"}, {"Name": "month"}])
+    legacy_bucket = StubBucket({"cur/data/year=2024/month=5/part-0.parquet": '"etag-0"'})
+
+    assert reporter.table_fingerprint(CUR_TABLE, other_period) == fingerprint
+    assert bucket.listed == ["cur/data/", "cur/data/BILLING_PERIOD=2024-05/"]
+    assert reporter.table_fingerprint(CUR_TABLE, StubBucket()) != fingerprint
+    may = reporter.partition_values("2024-05-01")
+    assert reporter.partition_prefix(legacy_bucket, "cur-bucket", "cur/data/", ["year", "month"], may) == "cur/data/year=2024/month=5/"
+    assert reporter.table_fingerprint(legacy_table, legacy_bucket) != reporter.table_fingerprint(legacy_table, StubBucket())
+
+
+def test_unreadable_cache_entries_are_misses():
+    result = reporter.QueryResult(["service"], ["varchar"], [["AmazonEC2"]])
+    bucket = StubBucket()
+    bucket.objects = {"corrupt": b'{"columns": ["service"', "incomplete": b'{"columns": ["service"]}'}
+    bucket.errors = {"denied": StubBucket.exceptions.ClientError("AccessDenied")}
+
+    for cache_key in ("missing", "denied", "corrupt", "incomplete"):
+        assert reporter.load_cached_results(bucket, cache_key) is None
+    reporter.save_cached_results(bucket, "cached", result)
+    assert list(reporter.load_cached_results(bucket, "cached")) == [{"service": "AmazonEC2"}]
+
+
+class StubBackend:
+    def __init__(self):
+        self.fingerprinted = False
+
+    def partition_keys(self):
+        return []
+
+    def fingerprint(self):
+        self.fingerprinted = True
+        return "fingerprint"
+
+    def run_queries(self, queries, deadline):
+        return {name: reporter.QueryResult(["billing_period"], ["varchar"], [[]]) for name in queries}
+
+
+@pytest.mark.parametrize("cache_prefix, cached", [("report-cache/", 2), ("", 0)])
+def test_empty_cache_prefix_bypasses_the_cache(monkeypatch, cache_prefix, cached):
+    backend, bucket, ses = StubBackend(), StubBucket(), StubSES()
+    monkeypatch.setattr(reporter, "REPORT_CACHE_PREFIX", cache_prefix)
+    monkeypatch.setattr(reporter, "create_backend", lambda s3_client=None: backend)
+    monkeypatch.setattr(reporter.boto3, "client", {"s3": bucket, "ses": ses}.get)
+
+    response = reporter.lambda_handler({}, None)
+
+    assert response["statusCode"] == 200
+    assert backend.fingerprinted == bool(cached)
+    assert len(bucket.objects) == cached
+
+
+class StubContext:
+    def __init__(self, remaining_seconds):
+        self.remaining_seconds = remaining_seconds
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_seconds * 1000
+
+
+def test_deadline_keeps_time_to_send_the_report(monkeypatch):
+    monkeypatch.setattr(reporter, "QUERY_TIMEOUT_SECONDS", 300)
+    now = time.monotonic()
+
+    assert reporter.query_deadline(None) == pytest.approx(now + 300, abs=1)
+    assert reporter.query_deadline(StubContext(100)) == pytest.approx(now + 100 - reporter.DEADLINE_MARGIN_SECONDS, abs=1)
+    # Never in the past, the queries then fail on their first status check
+    assert reporter.query_deadline(StubContext(10)) == pytest.approx(now, abs=1)
+
+
+def test_expired_deadline_stops_the_queries(monkeypatch):
+    monkeypatch.setattr(reporter, "POLL_INITIAL_SECONDS", 0.001)
+    athena = StubAthena(polls=100)
+    backend = reporter.AthenaBackend(athena, StubS3(), glue_client=None)
+
+    with pytest.raises(Exception, match="q0, q1 did not finish before the deadline"):
+        backend.run_queries({"a": ("SELECT 1", None), "b": ("SELECT 2", None)}, time.monotonic())
+    assert athena.checks == 1
+    assert athena.stopped == ["q0", "q1"]
+
+
+def test_results_are_typed_from_the_column_metadata():
+    execution = {"QueryExecutionId": "q0", "ResultConfiguration": {"OutputLocation": "s3://query-results/q0.csv"}}
+
+    result = reporter.fetch_query_results(StubAthena(), StubS3(), execution)
+
+    # IDs with dots or digits stay strings, empty numbers are NULL
+    assert result.column("resource_id") == ["my.bucket", "000123"]
+    assert result.column("cost") == [1.5, None]
+    assert result.column("resources") == [2, None]
+
+
+def test_cells_are_parsed_by_column_type():
+    assert reporter.column_converter("decimal")("12.50") == decimal.Decimal("12.50")
+    assert reporter.column_converter("BOOLEAN")("true") is True
+    assert reporter.column_converter("date")("2024-05-01") == datetime.date(2024, 5, 1)
+    assert reporter.column_converter("timestamp")("2024-05-01 10:30:00.000") == datetime.datetime(2024, 5, 1, 10, 30)
+    assert reporter.column_converter("bigint")("") is None
+    # Strings and the types without a converter are kept as they are
+    assert reporter.column_converter("varchar") is None
+    assert reporter.column_converter("map(varchar,varchar)") is None
+
+
+def test_query_result_rows_and_columns_survive_the_cache():
+    result = reporter.QueryResult(
+        ["service", "cost", "billing_period"], ["varchar", "decimal", "date"],
+        [["AmazonEC2", "AmazonS3"], [decimal.Decimal("1.25"), None], [datetime.date(2024, 5, 1)] * 2],
+    )
+
+    assert len(result) == 2
+    assert result[1] == {"service": "AmazonS3", "cost": None, "billing_period": datetime.date(2024, 5, 1)}
+    assert [row["service"] for row in result] == result.column("service")
+
+    cached = reporter.QueryResult.from_dict(json.loads(json.dumps(result.to_dict(), default=str)))
+    assert list(cached) == list(result)
+    assert cached.types == result.types
+
+
+def expensive_untagged_result(count):
+    columns = ["billing_period", "service", "resource_id", "region", "instance_type", "product_name", "usage_type", "cost"]
+    rows = [("2024-05-01", "AmazonEC2", "i-{:06d}".format(index), "eu-central-1", "m5.large", "EC2", "BoxUsage", 1.0)
+            for index in range(count)]
+    return reporter.QueryResult(columns, ["varchar"] * 7 + ["double"], [list(values) for values in zip(*rows)])
+
+
+def test_csv_attachments_over_the_row_limit_are_compressed(monkeypatch):
+    monkeypatch.setattr(reporter, "ATTACHMENT_GZIP_ROWS", 2)
+
+    assert reporter.build_csv_attachment("empty.csv", expensive_untagged_result(0)) is None
+    filename, content = reporter.build_csv_attachment("small.csv", expensive_untagged_result(2))
+    assert filename == "small.csv" and content.count(b"\r\n") == 3
+    filename, content = reporter.build_csv_attachment("large.csv", expensive_untagged_result(3))
+    rows = list(csv.reader(io.StringIO(gzip.decompress(content).decode("utf-8"))))
+    assert filename == "large.csv.gz" and rows[3][2] == "i-000002"
+
+
+class StubUploads:
+    def __init__(self):
+        self.keys = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.keys.append(Key)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return "https://example.com/{}".format(Params["Key"])
+
+
+@pytest.mark.parametrize("margin, attached", [(0, True), (-1, False)])
+def test_files_are_linked_when_the_encoded_message_is_too_large(monkeypatch, margin, attached):
+    tagged = tagged_vs_untagged_result([("2024-05-01", "team", "AmazonEC2", 4, 40.0, 3, 30.0, 2, 25.0)])
+    expensive = expensive_untagged_result(500)
+    attachments = [reporter.build_csv_attachment("tagged_vs_untagged.csv", tagged),
+                   reporter.build_csv_attachment("expensive_untagged.csv", expensive)]
+    html_body = reporter.render_html_report(tagged, expensive)
+    message_bytes = len(reporter.build_report_message(html_body, attachments).as_bytes())
+    # The base64 encoding and MIME headers, not the raw sizes, decide if the message fits
+    assert message_bytes > len(html_body) + sum(len(content) * 4 // 3 for _, content in attachments)
+    monkeypatch.setattr(reporter, "MAX_MESSAGE_BYTES", message_bytes + margin)
+    ses, uploads = StubSES(), StubUploads()
+
+    reporter.send_email_report(ses, tagged, expensive, uploads)
+
+    parts = ses.message.get_payload()
+    assert len(parts) == (3 if attached else 1)
+    assert len(uploads.keys) == (0 if attached else 2)
+
+
+def test_large_csv_files_are_compressed_or_linked(backend, monkeypatch):
+    results = run_report(backend)
+    monkeypatch.setattr(reporter, "ATTACHMENT_GZIP_ROWS", 1)
+
+    filename, content = reporter.build_csv_attachment("tagged_vs_untagged.csv", results["tagged_vs_untagged"])
+    assert filename == "tagged_vs_untagged.csv.gz"
+    rows = list(csv.reader(io.StringIO(gzip.decompress(content).decode("utf-8"))))
+    assert rows[0] == results["tagged_vs_untagged"].columns and len(rows) == 7
+    ses, uploads = StubSES(), StubUploads()
+    monkeypatch.setattr(reporter, "MAX_MESSAGE_BYTES", 1000)
+    reporter.send_email_report(ses, results["tagged_vs_untagged"], results["expensive_untagged"], uploads)
+
+    parts = ses.message.get_payload()
+    assert len(parts) == 1
+    assert len(uploads.keys) == 2
+    assert "https://example.com/" + uploads.keys[0] in parts[0].get_payload(decode=True).decode()